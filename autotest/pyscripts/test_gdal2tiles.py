@@ -29,9 +29,11 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import json
 import os
 import sys
 import shutil
+import sqlite3
 
 sys.path.append('../pymod')
 
@@ -105,6 +107,679 @@ def test_gdal2tiles_py_zoom_option():
     return 'success'
 
 
+def test_gdal2tiles_py_single_zoom_level():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    out_folder = 'tmp/out_gdal2tiles_smallworld_single_zoom'
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    # No overview level to build
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster -z 1 ../gdrivers/data/small_world.tif %s' % out_folder)
+
+    ret = 'success'
+    for tile in ('1/0/0', '1/1/0'):
+        if not os.path.exists('%s/%s.png' % (out_folder, tile)):
+            gdaltest.post_reason('missing tile %s' % tile)
+            ret = 'fail'
+    if os.path.exists('%s/0' % out_folder):
+        gdaltest.post_reason('unexpected overview tiles')
+        ret = 'fail'
+
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    return ret
+
+
+def _compare_tile_trees(ref_folder, test_folder, zoom_levels, ext='png'):
+    """Check that all the tiles of ref_folder exist in test_folder with the same content"""
+    for tz in zoom_levels:
+        for tx in os.listdir(os.path.join(ref_folder, str(tz))):
+            for filename in os.listdir(os.path.join(ref_folder, str(tz), tx)):
+                if not filename.endswith('.' + ext):
+                    continue
+                ref_ds = gdal.Open(os.path.join(ref_folder, str(tz), tx, filename))
+                test_ds = gdal.Open(os.path.join(test_folder, str(tz), tx, filename))
+                if test_ds is None:
+                    gdaltest.post_reason('missing tile %s/%s/%s' % (tz, tx, filename))
+                    return False
+                for i in range(ref_ds.RasterCount):
+                    ref_cs = ref_ds.GetRasterBand(i + 1).Checksum()
+                    test_cs = test_ds.GetRasterBand(i + 1).Checksum()
+                    if ref_cs != test_cs:
+                        gdaltest.post_reason('wrong checksum for tile %s/%s/%s band %d' %
+                                             (tz, tx, filename, i + 1))
+                        print(ref_cs, test_cs)
+                        return False
+    return True
+
+
+def _check_tile_container_with_gdal(filename, open_options, ref_folder, tz):
+    """Check that GDAL reads the tiles of ref_folder at zoom level tz from a tile container"""
+    ref_tiles = []
+    for tx in os.listdir(os.path.join(ref_folder, str(tz))):
+        for filename_ty in os.listdir(os.path.join(ref_folder, str(tz), tx)):
+            if filename_ty.endswith('.png'):
+                ref_tiles.append((int(tx), int(filename_ty[:-4])))
+    min_tx = min(tx for tx, _ in ref_tiles)
+    max_tx = max(tx for tx, _ in ref_tiles)
+    min_ty = min(ty for _, ty in ref_tiles)
+    max_ty = max(ty for _, ty in ref_tiles)
+
+    ds = gdal.OpenEx(filename, gdal.OF_RASTER, open_options=open_options)
+    if ds is None:
+        gdaltest.post_reason('cannot open %s' % filename)
+        return False
+    if ds.RasterCount != 4:
+        gdaltest.post_reason('wrong band count')
+        print(ds.RasterCount)
+        return False
+    if ds.RasterXSize != (max_tx - min_tx + 1) * 256 or \
+            ds.RasterYSize != (max_ty - min_ty + 1) * 256:
+        gdaltest.post_reason('wrong raster dimensions')
+        print(ds.RasterXSize, ds.RasterYSize)
+        return False
+
+    # The rows of the raster start from the top, the tile tree ones from the bottom
+    for tx, ty in ref_tiles:
+        ref_ds = gdal.Open(os.path.join(ref_folder, str(tz), str(tx), '%d.png' % ty))
+        for i in range(ref_ds.RasterCount):
+            ref_cs = ref_ds.GetRasterBand(i + 1).Checksum()
+            test_cs = ds.GetRasterBand(i + 1).Checksum(
+                (tx - min_tx) * 256, (max_ty - ty) * 256, 256, 256)
+            if ref_cs != test_cs:
+                gdaltest.post_reason('wrong checksum for tile %d/%d/%d band %d' %
+                                     (tz, tx, ty, i + 1))
+                print(ref_cs, test_cs)
+                return False
+    return True
+
+
+def test_gdal2tiles_py_overviews_multiprocess():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    # Issue with multiprocessing in the chroot
+    if os.environ.get('BUILD_NAME', '') == 'trusty_32bit':
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_ref'
+    out_folder = 'tmp/out_gdal2tiles_smallworld_mp'
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q -z 0-3 ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q --processes=3 -z 0-3 ../gdrivers/data/small_world.tif %s' % out_folder)
+
+    ret = 'success'
+    if not _compare_tile_trees(ref_folder, out_folder, range(0, 4)):
+        ret = 'fail'
+
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return ret
+
+
+def test_gdal2tiles_py_gpkg_container():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    # Issue with multiprocessing in the chroot
+    if os.environ.get('BUILD_NAME', '') == 'trusty_32bit':
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_ref'
+    out_filename = 'tmp/out_gdal2tiles_smallworld.gpkg'
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q -z 0-3 ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q --processes=2 --container=gpkg -z 0-3 ../gdrivers/data/small_world.tif %s' %
+        out_filename)
+
+    ret = 'success'
+    conn = sqlite3.connect(out_filename)
+    rows = conn.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles').fetchall()
+    conn.close()
+
+    nb_ref_tiles = 0
+    for tz in range(0, 4):
+        for tx in os.listdir(os.path.join(ref_folder, str(tz))):
+            nb_ref_tiles += len([f for f in os.listdir(os.path.join(ref_folder, str(tz), tx))
+                                 if f.endswith('.png')])
+    if len(rows) != nb_ref_tiles:
+        gdaltest.post_reason('got %d tiles instead of %d' % (len(rows), nb_ref_tiles))
+        ret = 'fail'
+
+    for tz, tx, tile_row, tile_data in rows:
+        if ret != 'success':
+            break
+        # GeoPackage rows start from the top of the tile matrix
+        ty = 2**tz - 1 - tile_row
+        gdal.FileFromMemBuffer('/vsimem/gdal2tiles_tile.png', bytes(tile_data))
+        test_ds = gdal.Open('/vsimem/gdal2tiles_tile.png')
+        ref_ds = gdal.Open(os.path.join(ref_folder, str(tz), str(tx), '%d.png' % ty))
+        if ref_ds is None:
+            gdaltest.post_reason('unexpected tile %d/%d/%d' % (tz, tx, ty))
+            ret = 'fail'
+        else:
+            for i in range(ref_ds.RasterCount):
+                if ref_ds.GetRasterBand(i + 1).Checksum() != \
+                        test_ds.GetRasterBand(i + 1).Checksum():
+                    gdaltest.post_reason('wrong checksum for tile %d/%d/%d' % (tz, tx, ty))
+                    ret = 'fail'
+        test_ds = None
+        gdal.Unlink('/vsimem/gdal2tiles_tile.png')
+
+    # Read through the GeoPackage driver
+    if ret == 'success' and gdal.GetDriverByName('GPKG') is not None and \
+            not _check_tile_container_with_gdal(out_filename, ['USE_TILE_EXTENT=YES'],
+                                                ref_folder, 3):
+        ret = 'fail'
+
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    return ret
+
+
+def test_gdal2tiles_py_mbtiles_container():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    # Issue with multiprocessing in the chroot
+    if os.environ.get('BUILD_NAME', '') == 'trusty_32bit':
+        return 'skip'
+
+    if gdal.GetDriverByName('MBTiles') is None:
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_ref'
+    out_filename = 'tmp/out_gdal2tiles_smallworld.mbtiles'
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q -z 0-3 ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q --processes=2 --container=mbtiles -z 0-3 ../gdrivers/data/small_world.tif %s' %
+        out_filename)
+
+    ret = 'success'
+    conn = sqlite3.connect(out_filename)
+    nb_tiles = conn.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+    conn.close()
+
+    nb_ref_tiles = 0
+    for tz in range(0, 4):
+        for tx in os.listdir(os.path.join(ref_folder, str(tz))):
+            nb_ref_tiles += len([f for f in os.listdir(os.path.join(ref_folder, str(tz), tx))
+                                 if f.endswith('.png')])
+    if nb_tiles != nb_ref_tiles:
+        gdaltest.post_reason('got %d tiles instead of %d' % (nb_tiles, nb_ref_tiles))
+        ret = 'fail'
+
+    # Read through the MBTiles driver, on the extent of the tiles
+    if ret == 'success' and \
+            not _check_tile_container_with_gdal(out_filename, ['USE_BOUNDS=NO'],
+                                                ref_folder, 3):
+        ret = 'fail'
+
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    return ret
+
+
+def test_gdal2tiles_py_tar_container():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    # Issue with multiprocessing in the chroot
+    if os.environ.get('BUILD_NAME', '') == 'trusty_32bit':
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_ref'
+    out_filename = 'tmp/out_gdal2tiles_smallworld.tar'
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q -z 0-2 ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q --processes=2 --container=tar -z 0-2 ../gdrivers/data/small_world.tif %s' %
+        out_filename)
+
+    ret = 'success'
+    with open(out_filename + '.index') as f:
+        index = [line.split() for line in f]
+    if len(index) != 1 + 4 + 16:
+        gdaltest.post_reason('got %d indexed tiles' % len(index))
+        ret = 'fail'
+
+    for tz, tx, ty, _, _ in index:
+        tile = '%s/%s/%s.png' % (tz, tx, ty)
+        test_ds = gdal.Open('/vsitar/%s/%s' % (out_filename, tile))
+        ref_ds = gdal.Open('%s/%s' % (ref_folder, tile))
+        if test_ds is None or ref_ds is None or \
+                [ref_ds.GetRasterBand(i + 1).Checksum() for i in range(ref_ds.RasterCount)] != \
+                [test_ds.GetRasterBand(i + 1).Checksum() for i in range(test_ds.RasterCount)]:
+            gdaltest.post_reason('wrong tile %s' % tile)
+            ret = 'fail'
+            break
+
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+    gdal.Unlink(out_filename + '.index')
+
+    return ret
+
+
+def test_gdal2tiles_py_exclude_transparent_and_deduplicate():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    in_filename = 'tmp/out_gdal2tiles_half_nodata.tif'
+    out_folder = 'tmp/out_gdal2tiles_exclude'
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    # Western hemisphere at nodata, eastern hemisphere uniform
+    ds = gdal.GetDriverByName('GTiff').Create(in_filename, 512, 256, 1)
+    ds.SetGeoTransform([-180, 0.703125, 0, 90, 0, -0.703125])
+    ds.SetProjection('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+                     'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433],'
+                     'AUTHORITY["EPSG","4326"]]')
+    ds.GetRasterBand(1).SetNoDataValue(0)
+    ds.GetRasterBand(1).WriteRaster(256, 0, 256, 256, b'\xff' * (256 * 256))
+    ds = None
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p geodetic -z 0-1 -x --deduplicate %s %s' % (in_filename, out_folder))
+
+    ret = 'success'
+    for tile in ['0/0/0', '1/0/0', '1/0/1', '1/1/0', '1/1/1']:
+        if os.path.exists('%s/%s.png' % (out_folder, tile)):
+            gdaltest.post_reason('transparent tile %s not excluded' % tile)
+            ret = 'fail'
+    for tile in ['0/1/0', '1/2/0', '1/2/1', '1/3/0', '1/3/1']:
+        if not os.path.exists('%s/%s.png' % (out_folder, tile)):
+            gdaltest.post_reason('tile %s missing' % tile)
+            ret = 'fail'
+
+    # The uniform base tiles are stored once
+    if ret == 'success' and hasattr(os, 'link') and \
+            os.stat('%s/1/2/0.png' % out_folder).st_nlink != 4:
+        gdaltest.post_reason('identical tiles not deduplicated')
+        ret = 'fail'
+
+    shutil.rmtree(out_folder, ignore_errors=True)
+    gdal.Unlink(in_filename)
+
+    return ret
+
+
+def test_gdal2tiles_py_metatile():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_ref'
+    out_folder = 'tmp/out_gdal2tiles_smallworld_metatile'
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster --metatile=2 ../gdrivers/data/small_world.tif %s' % out_folder)
+
+    ret = 'success'
+    if not _compare_tile_trees(ref_folder, out_folder, range(0, 2)):
+        ret = 'fail'
+
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if ret != 'success':
+        return ret
+
+    # The source windows of reprojected tiles are rounded separately
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p mercator -z 0-3 ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p mercator -z 0-3 --metatile=2 ../gdrivers/data/small_world.tif %s' % out_folder)
+
+    if not _compare_tile_trees(ref_folder, out_folder, range(0, 4)):
+        ret = 'fail'
+
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return ret
+
+
+def test_gdal2tiles_py_numpy_downsample():
+
+    try:
+        import numpy
+    except ImportError:
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    backup_sys_path = sys.path[:]
+    sys.path.insert(0, script_path)
+    import gdal2tiles
+    sys.path = backup_sys_path
+
+    query = numpy.zeros((4, 4, 4), numpy.uint8)
+    query[0] = [[10, 11, 50, 50], [12, 13, 50, 50], [200, 200, 0, 0], [200, 200, 0, 0]]
+    query[3] = [[255, 255, 255, 255], [255, 255, 255, 255], [255, 0, 0, 0], [255, 0, 0, 0]]
+
+    # Transparent pixels must not darken the bottom left pixel
+    tile = gdal2tiles.numpy_downsample(query, 2, 'average')
+    if tile[0].tolist() != [[12, 50], [200, 0]] or tile[3].tolist() != [[255, 255], [128, 0]]:
+        gdaltest.post_reason('wrong average downsampling')
+        print(tile)
+        return 'fail'
+
+    tile = gdal2tiles.numpy_downsample(query, 2, 'near')
+    if tile[0].tolist() != [[13, 50], [200, 0]] or tile[3].tolist() != [[255, 255], [0, 0]]:
+        gdaltest.post_reason('wrong near downsampling')
+        print(tile)
+        return 'fail'
+
+    return 'success'
+
+
+def test_gdal2tiles_py_array_profile_methods():
+
+    try:
+        import numpy
+    except ImportError:
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    backup_sys_path = sys.path[:]
+    sys.path.insert(0, script_path)
+    import gdal2tiles
+    sys.path = backup_sys_path
+
+    mercator = gdal2tiles.GlobalMercator()
+    lat = numpy.array([-60.5, 0.1, 45.2, 84.9])
+    lon = numpy.array([-179.9, 2.3, 120.5, 10.0])
+    mx, my = mercator.LatLonToMetersArray(lat, lon)
+    for zoom in (0, 3, 12):
+        tx, ty = mercator.MetersToTileArray(mx, my, zoom)
+        quadkeys = mercator.QuadTreeArray(tx, ty, zoom)
+        minx, miny, maxx, maxy = mercator.TileBoundsArray(tx, ty, zoom)
+        for i in range(len(lat)):
+            if (tx[i], ty[i]) != mercator.MetersToTile(*(mercator.LatLonToMeters(lat[i], lon[i]) +
+                                                         (zoom,))):
+                gdaltest.post_reason('wrong tile')
+                return 'fail'
+            if quadkeys[i] != mercator.QuadTree(int(tx[i]), int(ty[i]), zoom):
+                gdaltest.post_reason('wrong quadkey')
+                print(quadkeys[i])
+                return 'fail'
+            if not numpy.allclose((minx[i], miny[i], maxx[i], maxy[i]),
+                                  mercator.TileBounds(tx[i], ty[i], zoom)):
+                gdaltest.post_reason('wrong bounds')
+                return 'fail'
+
+    geodetic = gdal2tiles.GlobalGeodetic(None)
+    tx, ty = geodetic.LonLatToTileArray(lon, lat, 5)
+    for i in range(len(lat)):
+        if (tx[i], ty[i]) != geodetic.LonLatToTile(lon[i], lat[i], 5):
+            gdaltest.post_reason('wrong geodetic tile')
+            return 'fail'
+
+    tz, tx, ty = mercator.EnvelopeTiles(-1e6, -1e6, 2e6, 3e6, 1, 2)
+    if list(zip(tz, tx, ty)) != [(1, 0, 0), (1, 1, 0), (1, 0, 1), (1, 1, 1),
+                                 (2, 1, 1), (2, 2, 1), (2, 1, 2), (2, 2, 2)]:
+        gdaltest.post_reason('wrong envelope tiles')
+        print(list(zip(tz, tx, ty)))
+        return 'fail'
+
+    return 'success'
+
+
+def test_gdal2tiles_py_antialias():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    backup_sys_path = sys.path[:]
+    sys.path.insert(0, script_path)
+    import gdal2tiles
+    sys.path = backup_sys_path
+    if not gdal2tiles.pil_available:
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_antialias'
+    out_filename = 'tmp/out_gdal2tiles_smallworld_antialias.gpkg'
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster -r antialias ../gdrivers/data/small_world.tif %s' % ref_folder)
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster -r antialias --container=gpkg ../gdrivers/data/small_world.tif %s' %
+        out_filename)
+
+    ret = 'success'
+    # The base tiles are written too
+    for tile in ('0/0/0', '1/0/0', '1/1/0'):
+        if not os.path.exists('%s/%s.png' % (ref_folder, tile)):
+            gdaltest.post_reason('missing tile %s' % tile)
+            ret = 'fail'
+
+    conn = sqlite3.connect(out_filename)
+    rows = conn.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles').fetchall()
+    conn.close()
+    if len(rows) != 3:
+        gdaltest.post_reason('got %d tiles instead of 3' % len(rows))
+        ret = 'fail'
+    for tz, tx, tile_row, tile_data in rows:
+        ty = 2**tz - 1 - tile_row
+        gdal.FileFromMemBuffer('/vsimem/gdal2tiles_tile.png', bytes(tile_data))
+        test_ds = gdal.Open('/vsimem/gdal2tiles_tile.png')
+        ref_ds = gdal.Open(os.path.join(ref_folder, str(tz), str(tx), '%d.png' % ty))
+        if ref_ds is None or [ref_ds.GetRasterBand(i + 1).Checksum() for i in range(4)] != \
+                [test_ds.GetRasterBand(i + 1).Checksum() for i in range(4)]:
+            gdaltest.post_reason('wrong tile %d/%d/%d' % (tz, tx, ty))
+            ret = 'fail'
+        test_ds = None
+        gdal.Unlink('/vsimem/gdal2tiles_tile.png')
+
+    shutil.rmtree(ref_folder, ignore_errors=True)
+    gdal.Unlink(out_filename)
+
+    return ret
+
+
+def test_gdal2tiles_py_resume_manifest():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    out_folder = 'tmp/out_gdal2tiles_resume'
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -z 0-1 ../gdrivers/data/small_world.tif %s' % out_folder)
+    if os.path.exists(out_folder + '/.gdal2tiles_manifest'):
+        gdaltest.post_reason('manifest not removed')
+        return 'fail'
+
+    # Simulate an interrupted run: only 1/0/0 and 1/1/0 were completed, and 1/1/0 was removed
+    os.unlink(out_folder + '/0/0/0.png')
+    os.unlink(out_folder + '/1/0/1.png')
+    os.unlink(out_folder + '/1/1/0.png')
+    os.mkdir(out_folder + '/.gdal2tiles_manifest')
+    with open(out_folder + '/.gdal2tiles_manifest/interrupted.log', 'w') as f:
+        f.write('1 0 0\n1 1 0\n1 1')
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -e -z 0-1 ../gdrivers/data/small_world.tif %s' % out_folder)
+
+    ret = 'success'
+    for tile, expected in [('0/0/0', True), ('1/0/1', True), ('1/1/0', False)]:
+        if os.path.exists('%s/%s.png' % (out_folder, tile)) != expected:
+            gdaltest.post_reason('wrong resume of tile %s' % tile)
+            ret = 'fail'
+    if os.path.exists(out_folder + '/.gdal2tiles_manifest'):
+        gdaltest.post_reason('manifest not removed')
+        ret = 'fail'
+
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    return ret
+
+
+def test_gdal2tiles_py_shards():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    ref_folder = 'tmp/out_gdal2tiles_smallworld_ref'
+    out_folder = 'tmp/out_gdal2tiles_smallworld_shards'
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster ../gdrivers/data/small_world.tif %s' % ref_folder)
+    # The shards of a tile tree can be generated into the same directory
+    for shard in range(3):
+        test_py_scripts.run_py_script(
+            script_path,
+            'gdal2tiles',
+            '-q -p raster --shard=%d/3 ../gdrivers/data/small_world.tif %s' % (shard, out_folder))
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -p raster --overviews-only -e ../gdrivers/data/small_world.tif %s' % out_folder)
+
+    ret = 'success'
+    if not _compare_tile_trees(ref_folder, out_folder, range(0, 2)):
+        ret = 'fail'
+    if os.path.exists(out_folder + '/.gdal2tiles_manifest'):
+        gdaltest.post_reason('manifest not removed')
+        ret = 'fail'
+
+    for folder in (ref_folder, out_folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return ret
+
+
+def test_gdal2tiles_py_profile_report():
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        return 'skip'
+
+    out_folder = 'tmp/out_gdal2tiles_profile'
+    report_file = 'tmp/out_gdal2tiles_profile.json'
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    test_py_scripts.run_py_script(
+        script_path,
+        'gdal2tiles',
+        '-q -z 0-1 --processes=2 --profile-report=%s ../gdrivers/data/small_world.tif %s' %
+        (report_file, out_folder))
+
+    ret = 'success'
+    try:
+        with open(report_file) as f:
+            report = json.load(f)
+    except (IOError, ValueError):
+        gdaltest.post_reason('no report')
+        return 'fail'
+
+    if report['zoom_levels']['1']['tiles'] != 4 or report['zoom_levels']['0']['tiles'] != 1:
+        gdaltest.post_reason('wrong tile counts')
+        print(report['zoom_levels'])
+        ret = 'fail'
+    if 'read' not in report['zoom_levels']['1']['stages'] or len(report['slowest_tiles']) != 5:
+        gdaltest.post_reason('wrong report')
+        print(report)
+        ret = 'fail'
+    if [f for f in os.listdir('tmp') if f.startswith('out_gdal2tiles_profile.json.')]:
+        gdaltest.post_reason('profile logs not removed')
+        ret = 'fail'
+
+    shutil.rmtree(out_folder, ignore_errors=True)
+    os.unlink(report_file)
+
+    return ret
+
+
 def test_does_not_error_when_source_bounds_close_to_tiles_bound():
     """
     Case where the border coordinate of the input file is inside a tile T but the first pixel is
@@ -290,6 +965,19 @@ def test_gdal2tiles_py_cleanup():
 gdaltest_list = [
     test_gdal2tiles_py_simple,
     test_gdal2tiles_py_zoom_option,
+    test_gdal2tiles_py_single_zoom_level,
+    test_gdal2tiles_py_overviews_multiprocess,
+    test_gdal2tiles_py_gpkg_container,
+    test_gdal2tiles_py_mbtiles_container,
+    test_gdal2tiles_py_tar_container,
+    test_gdal2tiles_py_exclude_transparent_and_deduplicate,
+    test_gdal2tiles_py_metatile,
+    test_gdal2tiles_py_numpy_downsample,
+    test_gdal2tiles_py_array_profile_methods,
+    test_gdal2tiles_py_antialias,
+    test_gdal2tiles_py_resume_manifest,
+    test_gdal2tiles_py_shards,
+    test_gdal2tiles_py_profile_report,
     test_does_not_error_when_source_bounds_close_to_tiles_bound,
     test_does_not_error_when_nothing_to_put_in_the_low_zoom_tile,
     test_python3_handle_utf8_by_default,
@@ -332,6 +332,322 @@ def test_gdal_calc_py_6():
 
     return 'success'
 
+###############################################################################
+# test that a small memory budget, splitting the raster into many windows,
+# gives the same result as the default one
+
+
+def test_gdal_calc_py_7():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    gdal.Translate('tmp/test_gdal_calc_py.tif', '../gcore/data/stefan_full_rgba.tif', options='-co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16')
+
+    gdal_calc.Calc('A*2+B', A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=4, allBands='A', type='UInt16', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_7_1.tif')
+    gdal_calc.Calc('A*2+B', A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=4, allBands='A', type='UInt16', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_7_2.tif', memory=0.01)
+
+    sys.path = backup_sys_path
+
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_7_1.tif')
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_7_2.tif')
+    for i in range(1, 5):
+        cs1 = ds1.GetRasterBand(i).Checksum()
+        cs2 = ds2.GetRasterBand(i).Checksum()
+        if cs1 != cs2:
+            gdaltest.post_reason('failure')
+            print(i, cs1, cs2)
+            return 'fail'
+
+    ds1 = None
+    ds2 = None
+
+    return 'success'
+
+###############################################################################
+# test evaluating windows with several threads
+
+
+def test_gdal_calc_py_8():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    gdal.Translate('tmp/test_gdal_calc_py.tif', '../gcore/data/stefan_full_rgba.tif', options='-co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=4 --allBands=A --calc=A*2+B --type=UInt16 --overwrite --outfile tmp/test_gdal_calc_py_8_1.tif')
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=4 --allBands=A --calc=A*2+B --type=UInt16 --memory=0.05 --threads=4 --overwrite --outfile tmp/test_gdal_calc_py_8_2.tif')
+
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_8_1.tif')
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_8_2.tif')
+    for i in range(1, 5):
+        cs1 = ds1.GetRasterBand(i).Checksum()
+        cs2 = ds2.GetRasterBand(i).Checksum()
+        if cs1 != cs2:
+            gdaltest.post_reason('failure')
+            print(i, cs1, cs2)
+            return 'fail'
+
+    ds1 = None
+    ds2 = None
+
+    return 'success'
+
+###############################################################################
+# test the numexpr engine (falls back to numpy if numexpr is not installed)
+
+
+def test_gdal_calc_py_9():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    shutil.copy('../gcore/data/stefan_full_rgba.tif', 'tmp/test_gdal_calc_py.tif')
+
+    gdal_calc.Calc('(A-B)/(A+B+1.0)', A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=2, type='Float32', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_1.tif')
+    gdal_calc.Calc('(A-B)/(A+B+1.0)', A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=2, type='Float32', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif', engine='numexpr')
+
+    sys.path = backup_sys_path
+
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_9_1.tif')
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_9_2.tif')
+    if not gdalnumeric.allclose(ds1.ReadAsArray(), ds2.ReadAsArray()):
+        gdaltest.post_reason('failure')
+        return 'fail'
+
+    ds1 = None
+    ds2 = None
+
+    return 'success'
+
+###############################################################################
+# test nodata propagation with allBands, when the result is the input array
+# itself
+
+
+def test_gdal_calc_py_10():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    gdal.Translate('tmp/test_gdal_calc_py.tif', '../gcore/data/stefan_full_rgba.tif', options='-a_nodata 0 -co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16')
+
+    gdal_calc.Calc('A', A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=4, allBands='A', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_10.tif', NoDataValue=1, memory=0.01)
+
+    sys.path = backup_sys_path
+
+    src_ds = gdal.Open('tmp/test_gdal_calc_py.tif')
+    ds = gdal.Open('tmp/test_gdal_calc_py_10.tif')
+    alpha = src_ds.GetRasterBand(4).ReadAsArray()
+    for i in range(1, 5):
+        src = src_ds.GetRasterBand(i).ReadAsArray()
+        expected = gdalnumeric.where((src == 0) | (alpha == 0), 1, src)
+        if not gdalnumeric.array_equal(ds.GetRasterBand(i).ReadAsArray(), expected):
+            gdaltest.post_reason('failure')
+            print(i)
+            return 'fail'
+
+    src_ds = None
+    ds = None
+
+    return 'success'
+
+###############################################################################
+# test several calculations evaluated in one pass
+
+
+def test_gdal_calc_py_11():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    shutil.copy('../gcore/data/stefan_full_rgba.tif', 'tmp/test_gdal_calc_py.tif')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=2 --calc=A+B --type=UInt16 --overwrite --outfile tmp/test_gdal_calc_py_11_1.tif')
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=2 --calc=A*(A>B) --NoDataValue=0 --overwrite --outfile tmp/test_gdal_calc_py_11_2.tif')
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=2 --calc=A+B --type=UInt16 --NoDataValue=65535 --outfile tmp/test_gdal_calc_py_11_3.tif --calc=A*(A>B) --type=Byte --NoDataValue=0 --outfile tmp/test_gdal_calc_py_11_4.tif --overwrite')
+
+    for (ref_filename, filename, datatype, nodata) in [('tmp/test_gdal_calc_py_11_1.tif', 'tmp/test_gdal_calc_py_11_3.tif', gdal.GDT_UInt16, 65535),
+                                                       ('tmp/test_gdal_calc_py_11_2.tif', 'tmp/test_gdal_calc_py_11_4.tif', gdal.GDT_Byte, 0)]:
+        ref_ds = gdal.Open(ref_filename)
+        ds = gdal.Open(filename)
+        if ds is None:
+            gdaltest.post_reason('%s not found' % filename)
+            return 'fail'
+        if ds.GetRasterBand(1).DataType != datatype or ds.GetRasterBand(1).GetNoDataValue() != nodata:
+            gdaltest.post_reason('failure')
+            print(filename, ds.GetRasterBand(1).DataType, ds.GetRasterBand(1).GetNoDataValue())
+            return 'fail'
+        if ds.GetRasterBand(1).Checksum() != ref_ds.GetRasterBand(1).Checksum():
+            gdaltest.post_reason('failure')
+            print(filename, ds.GetRasterBand(1).Checksum(), ref_ds.GetRasterBand(1).Checksum())
+            return 'fail'
+
+    ref_ds = None
+    ds = None
+
+    return 'success'
+
+###############################################################################
+# test allBands on a band interleaved layer that is not the first one
+
+
+def test_gdal_calc_py_12():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    gdal.Translate('tmp/test_gdal_calc_py.tif', '../gcore/data/stefan_full_rgba.tif', options='-co INTERLEAVE=BAND')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --A_band=4 -B tmp/test_gdal_calc_py.tif --allBands=B --calc=B*(A>0) --memory=0.1 --overwrite --outfile tmp/test_gdal_calc_py_12.tif')
+
+    src_ds = gdal.Open('tmp/test_gdal_calc_py.tif')
+    ds = gdal.Open('tmp/test_gdal_calc_py_12.tif')
+    if ds.RasterCount != 4:
+        gdaltest.post_reason('failure')
+        print(ds.RasterCount)
+        return 'fail'
+    alpha = src_ds.GetRasterBand(4).ReadAsArray()
+    for i in range(1, 5):
+        src = src_ds.GetRasterBand(i).ReadAsArray()
+        expected = src * (alpha > 0)
+        if not gdalnumeric.array_equal(ds.GetRasterBand(i).ReadAsArray(), expected):
+            gdaltest.post_reason('failure')
+            print(i)
+            return 'fail'
+
+    src_ds = None
+    ds = None
+
+    return 'success'
+
+###############################################################################
+# test VRT output, computed by a Python pixel function when read
+
+
+def test_gdal_calc_py_13():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    gdal.Translate('tmp/test_gdal_calc_py.tif', '../gcore/data/stefan_full_rgba.tif', options='-a_nodata 0')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=4 --allBands=A --calc=A/2+B*(A>100) --type=UInt16 --NoDataValue=1000 --overwrite --outfile tmp/test_gdal_calc_py_13_1.tif')
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band=4 --allBands=A --calc=A/2+B*(A>100) --type=UInt16 --NoDataValue=1000 --overwrite --outfile tmp/test_gdal_calc_py_13_2.vrt')
+
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_13_1.tif')
+    gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', 'YES')
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_13_2.vrt')
+    if ds2 is None or ds2.RasterCount != 4:
+        gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', None)
+        gdaltest.post_reason('failure')
+        return 'fail'
+    for i in range(1, 5):
+        if ds2.GetRasterBand(i).GetNoDataValue() != 1000:
+            gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', None)
+            gdaltest.post_reason('failure')
+            print(i, ds2.GetRasterBand(i).GetNoDataValue())
+            return 'fail'
+        cs1 = ds1.GetRasterBand(i).Checksum()
+        cs2 = ds2.GetRasterBand(i).Checksum()
+        if cs1 != cs2:
+            gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', None)
+            gdaltest.post_reason('failure')
+            print(i, cs1, cs2)
+            return 'fail'
+    gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', None)
+
+    ds1 = None
+    ds2 = None
+
+    return 'success'
+
+
+###############################################################################
+# test output files of different formats guessed from their extensions
+
+
+def test_gdal_calc_py_14():
+
+    if gdalnumeric_not_available:
+        gdaltest.post_reason('gdalnumeric is not available, skipping all tests')
+        return 'skip'
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        return 'skip'
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --calc=A+1 --outfile tmp/test_gdal_calc_py_14_1.vrt --calc=A*2 --outfile tmp/test_gdal_calc_py_14_2.tif --type=UInt16 --overwrite')
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --calc=A*2 --outfile tmp/test_gdal_calc_py_14_3.tif --type=UInt16 --overwrite')
+
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_14_1.vrt')
+    if ds1 is None or ds1.GetDriver().ShortName != 'VRT':
+        gdaltest.post_reason('failure')
+        return 'fail'
+    ds1 = None
+
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_14_2.tif')
+    ds3 = gdal.Open('tmp/test_gdal_calc_py_14_3.tif')
+    if ds2 is None or ds2.GetDriver().ShortName != 'GTiff':
+        gdaltest.post_reason('failure')
+        return 'fail'
+    if ds2.GetRasterBand(1).Checksum() != ds3.GetRasterBand(1).Checksum():
+        gdaltest.post_reason('failure')
+        print(ds2.GetRasterBand(1).Checksum(), ds3.GetRasterBand(1).Checksum())
+        return 'fail'
+
+    ds2 = None
+    ds3 = None
+
+    return 'success'
+
 
 def test_gdal_calc_py_cleanup():
 
@@ -350,6 +666,23 @@ def test_gdal_calc_py_cleanup():
            'tmp/test_gdal_calc_py_5_2.tif',
            'tmp/test_gdal_calc_py_5_3.tif',
            'tmp/test_gdal_calc_py_6.tif',
+           'tmp/test_gdal_calc_py_7_1.tif',
+           'tmp/test_gdal_calc_py_7_2.tif',
+           'tmp/test_gdal_calc_py_8_1.tif',
+           'tmp/test_gdal_calc_py_8_2.tif',
+           'tmp/test_gdal_calc_py_9_1.tif',
+           'tmp/test_gdal_calc_py_9_2.tif',
+           'tmp/test_gdal_calc_py_10.tif',
+           'tmp/test_gdal_calc_py_11_1.tif',
+           'tmp/test_gdal_calc_py_11_2.tif',
+           'tmp/test_gdal_calc_py_11_3.tif',
+           'tmp/test_gdal_calc_py_11_4.tif',
+           'tmp/test_gdal_calc_py_12.tif',
+           'tmp/test_gdal_calc_py_13_1.tif',
+           'tmp/test_gdal_calc_py_13_2.vrt',
+           'tmp/test_gdal_calc_py_14_1.vrt',
+           'tmp/test_gdal_calc_py_14_2.tif',
+           'tmp/test_gdal_calc_py_14_3.tif',
           ]
     for filename in lst:
         try:
@@ -367,6 +700,14 @@ gdaltest_list = [
     test_gdal_calc_py_4,
     test_gdal_calc_py_5,
     test_gdal_calc_py_6,
+    test_gdal_calc_py_7,
+    test_gdal_calc_py_8,
+    test_gdal_calc_py_9,
+    test_gdal_calc_py_10,
+    test_gdal_calc_py_11,
+    test_gdal_calc_py_12,
+    test_gdal_calc_py_13,
+    test_gdal_calc_py_14,
     test_gdal_calc_py_cleanup
 ]
 
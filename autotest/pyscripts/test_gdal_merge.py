@@ -265,6 +265,72 @@ def test_gdal_merge_5():
 
     return 'success'
 
+###############################################################################
+# Test copying in block-aligned windows with a small memory limit (-wm)
+
+
+def test_gdal_merge_6():
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        return 'skip'
+
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16 -wm 0.0001 -o tmp/test_gdal_merge_6.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_6.tif')
+    if ds.GetRasterBand(1).Checksum() != 3508:
+        print(ds.GetRasterBand(1).Checksum())
+        gdaltest.post_reason('Wrong checksum')
+        return 'fail'
+    ds = None
+
+    # Input and output resolutions differ: the source windows are fractional
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -ps 0.07 0.07 -o tmp/test_gdal_merge_6_ref.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif')
+    os.unlink('tmp/test_gdal_merge_6.tif')
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -ps 0.07 0.07 -co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16 -wm 0.0001 -o tmp/test_gdal_merge_6.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_6.tif')
+    ref_ds = gdal.Open('tmp/test_gdal_merge_6_ref.tif')
+    if ds.GetRasterBand(1).Checksum() != ref_ds.GetRasterBand(1).Checksum():
+        print(ds.GetRasterBand(1).Checksum())
+        print(ref_ds.GetRasterBand(1).Checksum())
+        gdaltest.post_reason('Wrong checksum')
+        return 'fail'
+
+    return 'success'
+
+###############################################################################
+# Test merging by tiles with several threads (-j)
+
+
+def test_gdal_merge_7():
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        return 'skip'
+
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -j 2 -co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16 -wm 0.0001 -o tmp/test_gdal_merge_7.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_7.tif')
+    if ds.GetRasterBand(1).Checksum() != 3508:
+        print(ds.GetRasterBand(1).Checksum())
+        gdaltest.post_reason('Wrong checksum')
+        return 'fail'
+    ds = None
+
+    os.unlink('tmp/test_gdal_merge_7.tif')
+
+    # Same as test_gdal_merge_4
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-j 2 -init 255 -o tmp/test_gdal_merge_7.tif tmp/in2.tif tmp/in3.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_7.tif')
+    if ds.GetRasterBand(1).Checksum() != 4725:
+        print(ds.GetRasterBand(1).Checksum())
+        gdaltest.post_reason('Wrong checksum')
+        return 'fail'
+
+    return 'success'
+
 ###############################################################################
 # Cleanup
 
@@ -276,6 +342,9 @@ def test_gdal_merge_cleanup():
            'tmp/test_gdal_merge_3.tif',
            'tmp/test_gdal_merge_4.tif',
            'tmp/test_gdal_merge_5.tif',
+           'tmp/test_gdal_merge_6.tif',
+           'tmp/test_gdal_merge_6_ref.tif',
+           'tmp/test_gdal_merge_7.tif',
            'tmp/in1.tif',
            'tmp/in2.tif',
            'tmp/in3.tif',
@@ -297,6 +366,8 @@ gdaltest_list = [
     test_gdal_merge_3,
     test_gdal_merge_4,
     test_gdal_merge_5,
+    test_gdal_merge_6,
+    test_gdal_merge_7,
     test_gdal_merge_cleanup
 ]
 
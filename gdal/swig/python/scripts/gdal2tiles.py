@@ -39,32 +39,61 @@
 
 from __future__ import print_function, division
 
+from collections import OrderedDict
+from functools import partial
+import hashlib
+from io import BytesIO
+import json
 import math
-from multiprocessing import Pipe, Pool, Process, Manager
+from multiprocessing import Pool, Process, Queue
+from multiprocessing.util import Finalize
 import os
-import tempfile
+import sqlite3
 import shutil
+import struct
 import sys
+import tarfile
+import time
+from timeit import default_timer
 from uuid import uuid4
 from xml.etree import ElementTree
+import zipfile
 
 from osgeo import gdal
 from osgeo import osr
 
 try:
-    from PIL import Image
+    from multiprocessing import SimpleQueue
+except ImportError:
+    # Python 2
+    from multiprocessing.queues import SimpleQueue
+
+try:
+    from queue import Empty as QueueEmpty
+except ImportError:
+    # Python 2
+    from Queue import Empty as QueueEmpty
+
+try:
     import numpy
-    import osgeo.gdal_array as gdalarray
     numpy_available = True
 except ImportError:
-    # 'antialias' resampling is not available
+    # The NumPy downsampling is not available
     numpy_available = False
 
+try:
+    from PIL import Image
+    pil_available = True
+except ImportError:
+    # 'antialias' resampling is not available
+    pil_available = False
+
 __version__ = "$Id$"
 
 resampling_list = ('average', 'near', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'antialias')
 profile_list = ('mercator', 'geodetic', 'raster')
 webviewer_list = ('all', 'google', 'openlayers', 'leaflet', 'none')
+container_list = ('mbtiles', 'gpkg', 'tar', 'zip')
 
 # =============================================================================
 # =============================================================================
@@ -318,6 +347,89 @@ class GlobalMercator(object):
 
         return quadKey
 
+    # Array variants of the conversions above, for large numbers of coordinates or tiles: they
+    # take and return NumPy arrays (or anything numpy.asarray() accepts) instead of scalars, and
+    # are only available with NumPy
+
+    def LatLonToMetersArray(self, lat, lon):
+        "Converts arrays of lat/lon in WGS84 Datum to XY arrays in Spherical Mercator EPSG:3857"
+
+        mx = numpy.asarray(lon, dtype=numpy.float64) * self.originShift / 180.0
+        my = numpy.log(numpy.tan((90 + numpy.asarray(lat, dtype=numpy.float64)) *
+                                 math.pi / 360.0)) / (math.pi / 180.0)
+
+        my = my * self.originShift / 180.0
+        return mx, my
+
+    def MetersToLatLonArray(self, mx, my):
+        "Converts XY arrays from Spherical Mercator EPSG:3857 to lat/lon arrays in WGS84 Datum"
+
+        lon = (numpy.asarray(mx, dtype=numpy.float64) / self.originShift) * 180.0
+        lat = (numpy.asarray(my, dtype=numpy.float64) / self.originShift) * 180.0
+
+        lat = 180 / math.pi * (2 * numpy.arctan(numpy.exp(lat * math.pi / 180.0)) - math.pi / 2.0)
+        return lat, lon
+
+    def MetersToTileArray(self, mx, my, zoom):
+        "Returns the tx, ty arrays of the tiles for given arrays of mercator coordinates"
+
+        res = self.Resolution(zoom)
+        px = (numpy.asarray(mx, dtype=numpy.float64) + self.originShift) / res
+        py = (numpy.asarray(my, dtype=numpy.float64) + self.originShift) / res
+        return pixels_to_tile_array(px, py, self.tileSize)
+
+    def TileBoundsArray(self, tx, ty, zoom):
+        "Returns the minx, miny, maxx, maxy arrays of the bounds of given tiles in EPSG:3857"
+
+        tile_res = self.Resolution(zoom) * self.tileSize
+        tx = numpy.asarray(tx, dtype=numpy.float64)
+        ty = numpy.asarray(ty, dtype=numpy.float64)
+        return (tx * tile_res - self.originShift, ty * tile_res - self.originShift,
+                (tx + 1) * tile_res - self.originShift, (ty + 1) * tile_res - self.originShift)
+
+    def TileLatLonBoundsArray(self, tx, ty, zoom):
+        "Returns the minLat, minLon, maxLat, maxLon arrays of the bounds of given tiles"
+
+        minx, miny, maxx, maxy = self.TileBoundsArray(tx, ty, zoom)
+        minLat, minLon = self.MetersToLatLonArray(minx, miny)
+        maxLat, maxLon = self.MetersToLatLonArray(maxx, maxy)
+
+        return (minLat, minLon, maxLat, maxLon)
+
+    def GoogleTileArray(self, tx, ty, zoom):
+        "Converts arrays of TMS tile coordinates to Google Tile coordinates"
+
+        return numpy.asarray(tx), (2**zoom - 1) - numpy.asarray(ty)
+
+    def QuadTreeArray(self, tx, ty, zoom):
+        "Converts arrays of TMS tile coordinates to an array of Microsoft QuadTree keys"
+
+        tx = numpy.asarray(tx, dtype=numpy.int64).ravel()
+        ty = (2**zoom - 1) - numpy.asarray(ty, dtype=numpy.int64).ravel()
+        if zoom == 0:
+            return numpy.array([''] * len(tx))
+
+        # One column of quadkey digits per zoom level, most significant first
+        shifts = numpy.arange(zoom - 1, -1, -1, dtype=numpy.int64)
+        digits = (((tx[:, None] >> shifts) & 1) + 2 * ((ty[:, None] >> shifts) & 1) +
+                  ord('0')).astype(numpy.uint8)
+        return numpy.ascontiguousarray(digits).view('S%d' % zoom).ravel().astype(str)
+
+    def EnvelopeTiles(self, minx, miny, maxx, maxy, minzoom, maxzoom):
+        """
+        Returns the tz, tx, ty arrays of all the tiles of zoom levels minzoom to maxzoom
+        intersecting the given EPSG:3857 envelope, zoom level by zoom level
+        """
+
+        tile_ranges = []
+        for tz in range(minzoom, maxzoom + 1):
+            tminx, tminy = self.MetersToTile(minx, miny, tz)
+            tmaxx, tmaxy = self.MetersToTile(maxx, maxy, tz)
+            # crop tiles extending world limits (+-180,+-90)
+            tile_ranges.append((tz, max(0, tminx), max(0, tminy),
+                                min(2**tz - 1, tmaxx), min(2**tz - 1, tmaxy)))
+        return tile_ranges_to_arrays(tile_ranges)
+
 
 class GlobalGeodetic(object):
     r"""
@@ -416,6 +528,72 @@ class GlobalGeodetic(object):
         b = self.TileBounds(tx, ty, zoom)
         return (b[1], b[0], b[3], b[2])
 
+    # Array variants of the conversions above, for large numbers of coordinates or tiles: they
+    # take and return NumPy arrays (or anything numpy.asarray() accepts) instead of scalars, and
+    # are only available with NumPy
+
+    def LonLatToTileArray(self, lon, lat, zoom):
+        "Returns the tx, ty arrays of the tiles for zoom which cover given lon/lat arrays"
+
+        res = self.Resolution(zoom)
+        px = (180 + numpy.asarray(lon, dtype=numpy.float64)) / res
+        py = (90 + numpy.asarray(lat, dtype=numpy.float64)) / res
+        return pixels_to_tile_array(px, py, self.tileSize)
+
+    def TileBoundsArray(self, tx, ty, zoom):
+        "Returns the minx, miny, maxx, maxy arrays of the bounds of given tiles"
+        tile_res = self.Resolution(zoom) * self.tileSize
+        tx = numpy.asarray(tx, dtype=numpy.float64)
+        ty = numpy.asarray(ty, dtype=numpy.float64)
+        return (tx * tile_res - 180, ty * tile_res - 90,
+                (tx + 1) * tile_res - 180, (ty + 1) * tile_res - 90)
+
+    def TileLatLonBoundsArray(self, tx, ty, zoom):
+        "Returns the bounds arrays of given tiles in the SWNE form"
+        b = self.TileBoundsArray(tx, ty, zoom)
+        return (b[1], b[0], b[3], b[2])
+
+    def EnvelopeTiles(self, minx, miny, maxx, maxy, minzoom, maxzoom):
+        """
+        Returns the tz, tx, ty arrays of all the tiles of zoom levels minzoom to maxzoom
+        intersecting the given lon/lat envelope, zoom level by zoom level
+        """
+
+        tile_ranges = []
+        for tz in range(minzoom, maxzoom + 1):
+            tminx, tminy = self.LonLatToTile(minx, miny, tz)
+            tmaxx, tmaxy = self.LonLatToTile(maxx, maxy, tz)
+            # crop tiles extending world limits (+-180,+-90)
+            tile_ranges.append((tz, max(0, tminx), max(0, tminy),
+                                min(2**(tz + 1) - 1, tmaxx), min(2**tz - 1, tmaxy)))
+        return tile_ranges_to_arrays(tile_ranges)
+
+
+def pixels_to_tile_array(px, py, tile_size):
+    "Returns the tx, ty arrays of the tiles covering given arrays of pixel coordinates"
+
+    tx = numpy.ceil(px / float(tile_size)).astype(numpy.int64) - 1
+    ty = numpy.ceil(py / float(tile_size)).astype(numpy.int64) - 1
+    return tx, ty
+
+
+def tile_ranges_to_arrays(tile_ranges):
+    """
+    Returns the tz, tx, ty arrays of all the tiles of a list of (tz, tminx, tminy, tmaxx, tmaxy)
+    tile ranges. In each range, the tiles are listed row by row.
+    """
+    tz_list, tx_list, ty_list = [], [], []
+    for tz, tminx, tminy, tmaxx, tmaxy in tile_ranges:
+        if tminx > tmaxx or tminy > tmaxy:
+            continue
+        ty, tx = numpy.mgrid[tminy:tmaxy + 1, tminx:tmaxx + 1]
+        tz_list.append(numpy.full(tx.size, tz, dtype=numpy.int64))
+        tx_list.append(tx.ravel().astype(numpy.int64))
+        ty_list.append(ty.ravel().astype(numpy.int64))
+    if not tz_list:
+        return tuple(numpy.zeros(0, dtype=numpy.int64) for _ in range(3))
+    return numpy.concatenate(tz_list), numpy.concatenate(tx_list), numpy.concatenate(ty_list)
+
 
 class Zoomify(object):
     """
@@ -594,6 +772,39 @@ def generate_kml(tx, ty, tz, tileext, tilesize, tileswne, options, children=None
     return s
 
 
+def numpy_downsample(query_array, tilesize, resampling):
+    """
+    Downsamples a (bands, querysize, querysize) uint8 array, whose last band is the alpha band,
+    to (bands, tilesize, tilesize) with the 'average' or 'near' resampling. querysize must be a
+    multiple of tilesize.
+
+    'near' picks the same pixels as gdal.ReprojectImage(). 'average' rounds like
+    gdal.RegenerateOverview(), but weights the data bands by the alpha band, so that the
+    transparent pixels do not darken the edges: the result is the same wherever the alpha is
+    uniform in the averaged block.
+    """
+    bands, querysize, _ = query_array.shape
+    factor = querysize // tilesize
+
+    if resampling == 'near':
+        return query_array[:, factor // 2::factor, factor // 2::factor]
+
+    blocks = query_array.reshape(bands, tilesize, factor, tilesize, factor).astype(numpy.uint32)
+    nb_pixels = factor * factor
+    sums = blocks.sum(axis=(2, 4))
+    tile_array = (sums + nb_pixels // 2) // nb_pixels
+
+    alpha_sums = sums[-1]
+    weighted = alpha_sums > 0
+    if weighted.any():
+        weighted_sums = (blocks[:-1] * blocks[-1]).sum(axis=(2, 4))
+        for i in range(bands - 1):
+            tile_array[i][weighted] = ((weighted_sums[i][weighted] + alpha_sums[weighted] // 2) //
+                                       alpha_sums[weighted])
+
+    return tile_array
+
+
 def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
     """Scales down query dataset to the tile dataset"""
 
@@ -601,7 +812,17 @@ def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
     tilesize = dstile.RasterXSize
     tilebands = dstile.RasterCount
 
-    if options.resampling == 'average':
+    if (options.resampling in ('average', 'near') and numpy_available and
+            querysize % tilesize == 0):
+
+        # All the bands at once, with NumPy
+        query_array = numpy.frombuffer(dsquery.ReadRaster(0, 0, querysize, querysize),
+                                       numpy.uint8).reshape(tilebands, querysize, querysize)
+        tile_array = numpy_downsample(query_array, tilesize, options.resampling)
+        dstile.WriteRaster(0, 0, tilesize, tilesize,
+                           numpy.ascontiguousarray(tile_array, numpy.uint8).tobytes())
+
+    elif options.resampling == 'average':
 
         # Function: gdal.RegenerateOverview()
         for i in range(1, tilebands + 1):
@@ -612,19 +833,27 @@ def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
                 exit_with_error("RegenerateOverview() failed on %s, error %d" % (
                     tilefilename, res))
 
-    elif options.resampling == 'antialias' and numpy_available:
+    elif options.resampling == 'antialias' and pil_available:
 
         # Scaling by PIL (Python Imaging Library) - improved Lanczos
-        array = numpy.zeros((querysize, querysize, tilebands), numpy.uint8)
-        for i in range(tilebands):
-            array[:, :, i] = gdalarray.BandReadAsArray(dsquery.GetRasterBand(i + 1),
-                                                       0, 0, querysize, querysize)
-        im = Image.fromarray(array, 'RGBA')     # Always four bands
+        # All the bands are read at once, pixel interleaved as PIL expects them, and the result is
+        # written back to the tile dataset, to be encoded once by save_tile()
+        mode = 'RGBA' if tilebands == 4 else 'LA'
+        im = Image.frombuffer(mode, (querysize, querysize),
+                              read_interleaved_raster(dsquery, querysize), 'raw', mode, 0, 1)
         im1 = im.resize((tilesize, tilesize), Image.ANTIALIAS)
-        if os.path.exists(tilefilename):
-            im0 = Image.open(tilefilename)
-            im1 = Image.composite(im1, im0, im1)
-        im1.save(tilefilename, tiledriver)
+        if options.resume and tilefilename and os.path.exists(tilefilename):
+            # A tile left by an interrupted run and not recorded in its manifest
+            dsexisting = gdal.Open(tilefilename, gdal.GA_ReadOnly)
+            if dsexisting is not None and dsexisting.RasterCount == tilebands:
+                im0 = Image.frombuffer(mode, (tilesize, tilesize),
+                                       read_interleaved_raster(dsexisting, tilesize),
+                                       'raw', mode, 0, 1)
+                im1 = Image.composite(im1, im0, im1)
+            del dsexisting
+        dstile.WriteRaster(0, 0, tilesize, tilesize, im1.tobytes(),
+                           buf_pixel_space=tilebands, buf_line_space=tilebands * tilesize,
+                           buf_band_space=1)
 
     else:
 
@@ -653,6 +882,13 @@ def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
             exit_with_error("ReprojectImage() failed on %s, error %d" % (tilefilename, res))
 
 
+def read_interleaved_raster(ds, size):
+    """Returns the size x size pixels of all the bands of a dataset, pixel interleaved"""
+    bands = ds.RasterCount
+    return ds.ReadRaster(0, 0, size, size, buf_pixel_space=bands, buf_line_space=bands * size,
+                         buf_band_space=1)
+
+
 def setup_no_data_values(input_dataset, options):
     """
     Extract the NODATA values from the dataset or use the passed arguments as override if any
@@ -766,16 +1002,36 @@ def add_gdal_warp_options_to_string(vrt_string, warp_options):
     return ElementTree.tostring(vrt_root).decode()
 
 
+def read_vsimem_file(filename):
+    """Returns the content of a /vsimem/ file as a bytes object, and removes the file"""
+    f = gdal.VSIFOpenL(filename, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(filename)
+    return data
+
+
+def vrt_string_of_dataset(dataset):
+    """
+    Returns the XML definition of a dataset as a VRT. The VRT is only written to a /vsimem/ file,
+    and the string can be opened directly with gdal.Open().
+    """
+    filename = '/vsimem/%s.vrt' % uuid4()
+    # The returned dataset is closed right away, which flushes the VRT file
+    gdal.GetDriverByName('VRT').CreateCopy(filename, dataset)
+    return read_vsimem_file(filename).decode()
+
+
 def update_no_data_values(warped_vrt_dataset, nodata_values, options=None):
     """
     Takes an array of NODATA values and forces them on the WarpedVRT file dataset passed
     """
     # TODO: gbataille - Seems that I forgot tests there
     if nodata_values != []:
-        temp_file = gettempfilename('-gdal2tiles.vrt')
-        warped_vrt_dataset.GetDriver().CreateCopy(temp_file, warped_vrt_dataset)
-        with open(temp_file, 'r') as f:
-            vrt_string = f.read()
+        vrt_string = vrt_string_of_dataset(warped_vrt_dataset)
 
         vrt_string = add_gdal_warp_options_to_string(
             vrt_string, {"INIT_DEST": "NO_DATA", "UNIFIED_SRC_NODATA": "YES"})
@@ -794,12 +1050,7 @@ def update_no_data_values(warped_vrt_dataset, nodata_values, options=None):
 # </BandMapping>
 #                 """ % ((i+1), (i+1), nodata_values[i], nodata_values[i]))
 
-        # save the corrected VRT
-        with open(temp_file, 'w') as f:
-            f.write(vrt_string)
-
-        corrected_dataset = gdal.Open(temp_file)
-        os.unlink(temp_file)
+        corrected_dataset = gdal.Open(vrt_string)
 
         # set NODATA_VALUE metadata
         corrected_dataset.SetMetadataItem(
@@ -872,16 +1123,9 @@ def update_alpha_value_for_non_alpha_inputs(warped_vrt_dataset, options=None):
     not been forced by options
     """
     if warped_vrt_dataset.RasterCount in [1, 3]:
-        tempfilename = gettempfilename('-gdal2tiles.vrt')
-        warped_vrt_dataset.GetDriver().CreateCopy(tempfilename, warped_vrt_dataset)
-        with open(tempfilename) as f:
-            orig_data = f.read()
-        alpha_data = add_alpha_band_to_string_vrt(orig_data)
-        with open(tempfilename, 'w') as f:
-            f.write(alpha_data)
+        alpha_data = add_alpha_band_to_string_vrt(vrt_string_of_dataset(warped_vrt_dataset))
 
-        warped_vrt_dataset = gdal.Open(tempfilename)
-        os.unlink(tempfilename)
+        warped_vrt_dataset = gdal.Open(alpha_data)
 
         if options and options.verbose:
             print("Modified -dstalpha warping result saved into 'tiles1.vrt'")
@@ -905,26 +1149,969 @@ def nb_data_bands(dataset):
     return dataset.RasterCount
 
 
-def gettempfilename(suffix):
-    """Returns a temporary filename"""
-    if '_' in os.environ:
-        # tempfile.mktemp() crashes on some Wine versions (the one of Ubuntu 12.04 particularly)
-        if os.environ['_'].find('wine') >= 0:
-            tmpdir = '.'
-            if 'TMP' in os.environ:
-                tmpdir = os.environ['TMP']
-            import time
-            import random
-            random.seed(time.time())
-            random_part = 'file%d' % random.randint(0, 1000000000)
-            return os.path.join(tmpdir, random_part + suffix)
+class MBTilesContainer(object):
+    """
+    Single file tile container following the MBTiles specification
+    (https://github.com/mapbox/mbtiles-spec). Rows are in the TMS (bottom-left origin) scheme.
+
+    The object only holds the filename when it is pickled to the worker processes, each process
+    opening its own SQLite connection on first use.
+    """
+
+    table_name = 'tiles'
+
+    def __init__(self, filename, deduplicate=False):
+        self.filename = filename
+        self.deduplicate = deduplicate
+        self.conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, timeout=600)
+        return self.conn
+
+    def create(self, gdal2tiles):
+        """Creates the container and its metadata from a GDAL2Tiles object with opened input"""
+        if os.path.exists(self.filename):
+            if gdal2tiles.options.resume:
+                # Keep on writing the tiles the way the existing file stores them
+                self.deduplicate = self.connect().execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'images'").fetchone() is not None
+                self.conn.close()
+                self.conn = None
+                return
+            os.remove(self.filename)
+
+        conn = self.connect()
+        # The WAL journal lets the workers read the tiles of the previous zoom level while the
+        # writer process inserts new ones
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            self.create_schema(conn, gdal2tiles)
+        # Each process opens its own connection when it needs one
+        self.conn.close()
+        self.conn = None
+
+    def create_schema(self, conn, gdal2tiles):
+        conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        if self.deduplicate:
+            # Identical tiles share a single row of the images table, keyed by their SHA-1
+            conn.execute("CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, "
+                         "tile_row INTEGER, tile_id TEXT)")
+            conn.execute("CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, "
+                         "tile_row)")
+            conn.execute("CREATE TABLE images (tile_data BLOB, tile_id TEXT)")
+            conn.execute("CREATE UNIQUE INDEX images_id ON images (tile_id)")
+            conn.execute("CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, "
+                         "map.tile_column AS tile_column, map.tile_row AS tile_row, "
+                         "images.tile_data AS tile_data FROM map "
+                         "JOIN images ON images.tile_id = map.tile_id")
+        else:
+            conn.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+                         "tile_row INTEGER, tile_data BLOB)")
+            conn.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, "
+                         "tile_row)")
+
+        conn.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)",
+                         sorted(container_metadata(gdal2tiles).items()))
+
+    def tile_row(self, tz, ty):
+        return ty
+
+    def write_tiles(self, tiles):
+        """Inserts a list of (tz, tx, ty, data) tiles in a single transaction"""
+        conn = self.connect()
+        if self.deduplicate:
+            images = {}
+            rows = []
+            for tz, tx, ty, data in tiles:
+                tile_id = hashlib.sha1(data).hexdigest()
+                images[tile_id] = data
+                rows.append((tz, tx, self.tile_row(tz, ty), tile_id))
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)",
+                                 [(sqlite3.Binary(data), tile_id)
+                                  for tile_id, data in images.items()])
+                conn.executemany("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, "
+                                 "tile_id) VALUES (?, ?, ?, ?)", rows)
+            return
+
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO %s (zoom_level, tile_column, tile_row, tile_data) "
+                "VALUES (?, ?, ?, ?)" % self.table_name,
+                [(tz, tx, self.tile_row(tz, ty), sqlite3.Binary(data))
+                 for tz, tx, ty, data in tiles])
+
+    def read_tile(self, tz, tx, ty):
+        """Returns the encoded data of a tile, or None if the tile is not in the container"""
+        row = self.connect().execute(
+            "SELECT tile_data FROM %s WHERE zoom_level = ? AND tile_column = ? AND "
+            "tile_row = ?" % self.table_name, (tz, tx, self.tile_row(tz, ty))).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def has_tile(self, tz, tx, ty):
+        row = self.connect().execute(
+            "SELECT 1 FROM %s WHERE zoom_level = ? AND tile_column = ? AND "
+            "tile_row = ?" % self.table_name, (tz, tx, self.tile_row(tz, ty))).fetchone()
+        return row is not None
+
+    def close(self):
+        if self.conn is not None:
+            # Checkpoint the WAL so that a self-contained file is left behind
+            self.conn.execute("PRAGMA journal_mode=DELETE")
+            self.conn.close()
+            self.conn = None
+
+
+class GeoPackageContainer(MBTilesContainer):
+    """
+    Single file tile container following the OGC GeoPackage tiles specification. The tile matrix
+    set covers 2**tz x 2**tz tiles (2**(tz+1) x 2**tz for the TMS compatible geodetic profile)
+    at each zoom level, with its rows starting from the top.
+    """
+
+    def create_schema(self, conn, gdal2tiles):
+        conn.execute("PRAGMA application_id = 1196444487")   # 'GPKG'
+        conn.execute("PRAGMA user_version = 10200")
+        conn.execute(
+            "CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+            "srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL, "
+            "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+            "description TEXT)")
+        conn.execute(
+            "CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+            "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+            "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+            "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "
+            "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) "
+            "REFERENCES gpkg_spatial_ref_sys(srs_id))")
+        conn.execute(
+            "CREATE TABLE gpkg_tile_matrix_set (table_name TEXT NOT NULL PRIMARY KEY, "
+            "srs_id INTEGER NOT NULL, min_x DOUBLE NOT NULL, min_y DOUBLE NOT NULL, "
+            "max_x DOUBLE NOT NULL, max_y DOUBLE NOT NULL, "
+            "CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name) "
+            "REFERENCES gpkg_contents(table_name), "
+            "CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id) "
+            "REFERENCES gpkg_spatial_ref_sys (srs_id))")
+        conn.execute(
+            "CREATE TABLE gpkg_tile_matrix (table_name TEXT NOT NULL, "
+            "zoom_level INTEGER NOT NULL, matrix_width INTEGER NOT NULL, "
+            "matrix_height INTEGER NOT NULL, tile_width INTEGER NOT NULL, "
+            "tile_height INTEGER NOT NULL, pixel_x_size DOUBLE NOT NULL, "
+            "pixel_y_size DOUBLE NOT NULL, "
+            "CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level), "
+            "CONSTRAINT fk_tmm_table_name FOREIGN KEY (table_name) "
+            "REFERENCES gpkg_contents(table_name))")
+        conn.execute(
+            "CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+            "tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL, "
+            "UNIQUE (zoom_level, tile_column, tile_row))" % self.table_name)
+
+        srs_4326 = osr.SpatialReference()
+        srs_4326.ImportFromEPSG(4326)
+        srs_rows = [
+            ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+            ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+            ('WGS 84 geodetic', 4326, 'EPSG', 4326, srs_4326.ExportToWkt(), None),
+        ]
+
+        tilesize = gdal2tiles.tilesize
+        if gdal2tiles.options.profile == 'mercator':
+            srs_id = 3857
+            srs_rows.append(('WGS 84 / Pseudo-Mercator', 3857, 'EPSG', 3857,
+                             gdal2tiles.out_srs.ExportToWkt(), None))
+            matrix_set = (-gdal2tiles.mercator.originShift, -gdal2tiles.mercator.originShift,
+                          gdal2tiles.mercator.originShift, gdal2tiles.mercator.originShift)
+            resolution = gdal2tiles.mercator.Resolution
+        elif gdal2tiles.options.profile == 'geodetic':
+            srs_id = 4326
+            matrix_set = gdal2tiles.geodetic.TileBounds(0, 0, 0)
+            if gdal2tiles.options.tmscompatible:
+                matrix_set = (matrix_set[0], matrix_set[1],
+                              matrix_set[2] + (matrix_set[2] - matrix_set[0]), matrix_set[3])
+            resolution = gdal2tiles.geodetic.Resolution
+        else:
+            if gdal2tiles.out_srs:
+                srs_id = 100000
+                srs_rows.append(('Raster SRS', srs_id, 'NONE', srs_id,
+                                 gdal2tiles.out_srs.ExportToWkt(), None))
+            else:
+                srs_id = -1
+
+            def resolution(tz):
+                return gdal2tiles.out_gt[1] * 2**(gdal2tiles.nativezoom - tz)
+
+            extent = tilesize * resolution(0)
+            matrix_set = (gdal2tiles.ominx, gdal2tiles.ominy,
+                          gdal2tiles.ominx + extent, gdal2tiles.ominy + extent)
+
+        conn.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", srs_rows)
+        conn.execute(
+            "INSERT INTO gpkg_contents (table_name, data_type, identifier, description, "
+            "min_x, min_y, max_x, max_y, srs_id) VALUES (?, 'tiles', ?, ?, ?, ?, ?, ?, ?)",
+            (self.table_name, gdal2tiles.options.title, gdal2tiles.options.copyright or '',
+             gdal2tiles.ominx, gdal2tiles.ominy, gdal2tiles.omaxx, gdal2tiles.omaxy, srs_id))
+        conn.execute("INSERT INTO gpkg_tile_matrix_set VALUES (?, ?, ?, ?, ?, ?)",
+                     (self.table_name, srs_id) + tuple(matrix_set))
+
+        matrix_width_factor = int(round((matrix_set[2] - matrix_set[0]) /
+                                        (matrix_set[3] - matrix_set[1])))
+        conn.executemany(
+            "INSERT INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(self.table_name, tz, matrix_width_factor * 2**tz, 2**tz, tilesize, tilesize,
+              resolution(tz), resolution(tz))
+             for tz in range(gdal2tiles.tminz, gdal2tiles.tmaxz + 1)])
+
+    def tile_row(self, tz, ty):
+        return 2**tz - 1 - ty
+
+
+class TarTileContainer(object):
+    """
+    Uncompressed tar archive of the tile tree, readable with the /vsitar/ GDAL handler (or
+    extracted) once closed. The tiles are stored as tz/tx/ty.ext members, after a metadata.json
+    member.
+
+    Only the writer process appends to the archive. Along with it, it appends the offset and
+    size of each tile in the archive to a "tz tx ty offset size" text index next to the archive:
+    the other processes read the tiles back by seeking into the archive through the index, and
+    the index is kept for random access to the archive by other tools.
+    """
+
+    tileext = 'png'
+    mtime = 0
+
+    def __init__(self, filename, deduplicate=False):
+        self.filename = filename
+        self.index_filename = filename + '.index'
+        self.archive = None
+        self.index_file = None
+        self.reader = None
+        self.index = {}
+        self.index_pos = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['archive'] = state['index_file'] = state['reader'] = None
+        state['index'] = {}
+        state['index_pos'] = 0
+        return state
+
+    def create(self, gdal2tiles):
+        """Creates the archive and its metadata from a GDAL2Tiles object with opened input"""
+        self.tileext = gdal2tiles.tileext
+        self.mtime = int(time.time())
+
+        if os.path.exists(self.filename) and gdal2tiles.options.resume:
+            # Rebuild the index from the tiles of the archive
+            try:
+                archive = self.open_archive('a')
+                tiles = list(self.archive_tiles(archive))
+                archive.close()
+            except (tarfile.TarError, zipfile.BadZipfile, IOError) as e:
+                exit_with_error("Cannot resume the tiling into %s: %s" % (self.filename, e))
+            with open(self.index_filename, 'w') as f:
+                for tile, offset, size in tiles:
+                    f.write('%d %d %d %d %d\n' % (tile + (offset, size)))
+            return
+
+        for filename in (self.filename, self.index_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+        archive = self.open_archive('w')
+        self.add_member(archive, 'metadata.json',
+                        json.dumps(container_metadata(gdal2tiles), indent=2).encode('utf-8'))
+        archive.close()
+        open(self.index_filename, 'w').close()
+
+    def open_archive(self, mode):
+        return tarfile.open(self.filename, mode, format=tarfile.USTAR_FORMAT)
+
+    def add_member(self, archive, name, data):
+        """Appends a member to the archive, and returns the offset of its data"""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        archive.addfile(info, BytesIO(data))
+        # The data is followed by the padding of its last block
+        nb_blocks = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+        return archive.offset - nb_blocks * tarfile.BLOCKSIZE
+
+    def archive_tiles(self, archive):
+        """Yields the ((tz, tx, ty), offset, size) of the tiles of an open archive"""
+        for info in archive.getmembers():
+            tile = tile_of_member_name(info.name)
+            if tile is not None:
+                yield tile, info.offset_data, info.size
+
+    def load_index(self):
+        """Loads the tiles added to the index file since the previous call"""
+        if not os.path.exists(self.index_filename):
+            return
+        with open(self.index_filename) as f:
+            f.seek(self.index_pos)
+            for line in f:
+                if not line.endswith('\n'):
+                    # Line being written by the writer process
+                    break
+                self.index_pos += len(line)
+                tz, tx, ty, offset, size = [int(v) for v in line.split()]
+                self.index[(tz, tx, ty)] = (offset, size)
+
+    def write_tiles(self, tiles):
+        """Appends a list of (tz, tx, ty, data) tiles to the archive, and indexes them"""
+        if self.archive is None:
+            # From now on, this process is the only one changing the index
+            self.load_index()
+            self.archive = self.open_archive('a')
+            self.index_file = open(self.index_filename, 'a')
+        for tz, tx, ty, data in tiles:
+            offset = self.add_member(self.archive, '%d/%d/%d.%s' % (tz, tx, ty, self.tileext),
+                                     data)
+            self.index[(tz, tx, ty)] = (offset, len(data))
+            self.index_file.write('%d %d %d %d %d\n' % (tz, tx, ty, offset, len(data)))
+        # The tiles must be in the archive before they are in the index
+        self.flush_archive()
+        self.index_file.flush()
+
+    def flush_archive(self):
+        self.archive.fileobj.flush()
+
+    def lookup(self, tz, tx, ty):
+        """Returns the (offset, size) of a tile, or None if the tile is not in the archive"""
+        entry = self.index.get((tz, tx, ty))
+        if entry is None and self.archive is None:
+            self.load_index()
+            entry = self.index.get((tz, tx, ty))
+        return entry
+
+    def read_tile(self, tz, tx, ty):
+        """Returns the encoded data of a tile, or None if the tile is not in the archive"""
+        entry = self.lookup(tz, tx, ty)
+        if entry is None:
+            return None
+        if self.reader is None:
+            self.reader = open(self.filename, 'rb')
+        self.reader.seek(entry[0])
+        return self.reader.read(entry[1])
+
+    def has_tile(self, tz, tx, ty):
+        return self.lookup(tz, tx, ty) is not None
+
+    def close(self):
+        for handle in (self.reader, self.index_file, self.archive):
+            if handle is not None:
+                handle.close()
+        self.archive = self.index_file = self.reader = None
+
+
+class ZipTileContainer(TarTileContainer):
+    """
+    Uncompressed (stored) zip archive of the tile tree, readable with the /vsizip/ GDAL handler
+    once closed. Same layout and index as the TarTileContainer.
+
+    The central directory of the archive is only written when it is closed: the archive of an
+    interrupted run cannot be resumed.
+    """
+
+    def open_archive(self, mode):
+        return zipfile.ZipFile(self.filename, mode, zipfile.ZIP_STORED, allowZip64=True)
 
-    return tempfile.mktemp(suffix)
+    def add_member(self, archive, name, data):
+        archive.writestr(zipfile.ZipInfo(name, time.localtime(self.mtime)[:6]), data)
+        # Stored data is not followed by a data descriptor when the file is seekable
+        return archive.fp.tell() - len(data)
 
+    def flush_archive(self):
+        self.archive.fp.flush()
 
-def create_base_tile(tile_job_info, tile_detail, queue=None):
+    def archive_tiles(self, archive):
+        with open(self.filename, 'rb') as f:
+            for info in archive.infolist():
+                tile = tile_of_member_name(info.filename)
+                if tile is not None:
+                    # The extra field of the local header may differ from the central one
+                    f.seek(info.header_offset + 26)
+                    name_size, extra_size = struct.unpack('<HH', f.read(4))
+                    yield tile, info.header_offset + 30 + name_size + extra_size, info.file_size
+
+
+def tile_of_member_name(name):
+    """Returns the (tz, tx, ty) of a tz/tx/ty.ext archive member, or None"""
+    try:
+        tz, tx, ty = name.split('.')[0].split('/')
+        return int(tz), int(tx), int(ty)
+    except ValueError:
+        return None
+
+
+def container_metadata(gdal2tiles):
+    """Metadata of a tile container (MBTiles keys), from a GDAL2Tiles object with opened input"""
+    south, west, north, east = gdal2tiles.swne
+    return {
+        'name': gdal2tiles.options.title,
+        'type': 'overlay',
+        'version': '1.1',
+        'description': gdal2tiles.options.copyright or '',
+        'format': gdal2tiles.tileext,
+        'bounds': "%.14f,%.14f,%.14f,%.14f" % (west, south, east, north),
+        'minzoom': str(gdal2tiles.tminz),
+        'maxzoom': str(gdal2tiles.tmaxz),
+    }
+
+
+def create_tile_container(container, filename, deduplicate=False):
+    if container == 'mbtiles':
+        return MBTilesContainer(filename, deduplicate)
+    elif container == 'gpkg':
+        return GeoPackageContainer(filename)
+    elif container == 'tar':
+        return TarTileContainer(filename)
+    elif container == 'zip':
+        return ZipTileContainer(filename)
+    raise Gdal2TilesError("Unknown tile container '%s'" % container)
+
+
+class TileContainerWriter(object):
+    """Buffers the tiles written to a container, and inserts them by batches"""
+
+    def __init__(self, container, batch_size=256):
+        self.container = container
+        self.batch_size = batch_size
+        self.tiles = []
+
+    def put(self, tz, tx, ty, data):
+        self.tiles.append((tz, tx, ty, data))
+        if len(self.tiles) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.tiles:
+            self.container.write_tiles(self.tiles)
+            self.tiles = []
+
+    def close(self):
+        self.flush()
+        self.container.close()
+
+
+class QueueTileWriter(object):
+    """Worker side of a TileWriterProcess: sends the encoded tiles to the writer process"""
+
+    def __init__(self, tile_queue):
+        self.tile_queue = tile_queue
+
+    def put(self, tz, tx, ty, data):
+        self.tile_queue.put((tz, tx, ty, data))
+
+
+def tile_writer_process(container, tile_queue, ack_queue):
+    """
+    Main function of the process owning the container: inserts the tiles sent by the workers,
+    one transaction for each batch of tiles waiting in the queue.
+    """
+    writer = TileContainerWriter(container)
+    while True:
+        item = tile_queue.get()
+        if item == 'flush' or item == 'close':
+            writer.flush()
+            if item == 'close':
+                writer.close()
+            ack_queue.put(item)
+            if item == 'close':
+                return
+            continue
+
+        writer.tiles.append(item)
+        if len(writer.tiles) >= writer.batch_size or tile_queue.empty():
+            writer.flush()
+
+
+class TileWriterProcess(object):
+    """
+    Single process writing the tiles of all the workers to a container.
+
+    The tiles go through a SimpleQueue, whose put() only returns once the tile is in the pipe, so
+    that a tile sent by a finished job is always received before a later flush() request.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.tile_queue = SimpleQueue()
+        self.ack_queue = Queue()
+        self.process = Process(target=tile_writer_process,
+                               args=[container, self.tile_queue, self.ack_queue])
+
+    def start(self):
+        self.process.start()
+
+    def request(self, item):
+        self.tile_queue.put(item)
+        while True:
+            try:
+                return self.ack_queue.get(timeout=1)
+            except QueueEmpty:
+                if not self.process.is_alive():
+                    raise Gdal2TilesError("The tile writer process has stopped unexpectedly")
+
+    def flush(self):
+        """Waits until all the tiles sent so far are committed to the container"""
+        self.request('flush')
+
+    def close(self):
+        self.request('close')
+        self.process.join()
+
+
+class TileDeduplicator(object):
+    """
+    Writes encoded tiles to the tile tree, as hardlinks to a previous tile of the current process
+    when it had the same content.
+
+    Only the max_entries most recently seen contents are remembered: this is enough to catch the
+    tiles repeated over uniform areas (sea, nodata...) without keeping a digest of every tile.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.filenames = OrderedDict()
+
+    def write(self, data, tilefilename):
+        # Never write into an existing file: it may be a link shared with other tiles
+        try:
+            os.remove(tilefilename)
+        except OSError:
+            pass
+
+        digest = hashlib.sha1(data).digest()
+        filename = self.filenames.pop(digest, None)
+        linked = False
+        if filename is not None:
+            try:
+                os.link(filename, tilefilename)
+                linked = True
+            except (AttributeError, OSError):
+                # No hardlink support on this platform or file system
+                pass
+        if not linked:
+            with open(tilefilename, 'wb') as f:
+                f.write(data)
+            filename = tilefilename
+
+        self.filenames[digest] = filename
+        if len(self.filenames) > self.max_entries:
+            self.filenames.popitem(last=False)
+
+
+class TileRasterCache(object):
+    """
+    Bounded LRU cache of the rasters (as returned by ReadRaster()) of the overview tiles generated
+    by the current process, so that their parent tile is built without decoding them again.
+
+    A raster of None records a tile that was not generated because it was transparent.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.rasters = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.rasters
+
+    def put(self, key, raster):
+        self.rasters[key] = raster
+        if len(self.rasters) > self.max_entries:
+            self.rasters.popitem(last=False)
+
+    def pop(self, key):
+        """Returns the raster of a tile, and forgets it: a tile has a single parent"""
+        return self.rasters.pop(key)
+
+
+class TileManifest(object):
+    """
+    Completion manifest of a tile tree, so that --resume does not check the existence of each
+    tile file.
+
+    Each process appends the tiles it completes to its own log in the manifest folder. When
+    resuming, the logs are loaded once, into a bitmap per zoom level over the tile ranges of the
+    job, and the tiles are looked up in memory. The folder is removed once the tiling completes.
+    """
+
+    folder_name = '.gdal2tiles_manifest'
+
+    def __init__(self, output_folder, tminmax, tminz, tmaxz):
+        self.folder = os.path.join(output_folder, self.folder_name)
+        self.tminmax = tminmax
+        self.tminz = tminz
+        self.tmaxz = tmaxz
+        self.bitmaps = None
+        self.log = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['log'] = None
+        return state
+
+    def create(self, resume, shared=False):
+        """
+        Creates the manifest folder, loading the logs of the previous run when resuming. A shared
+        manifest (--tile-range or --shard) keeps the logs of the other runs on the same tile tree.
+        """
+        if os.path.isdir(self.folder):
+            if resume:
+                self.load()
+                return
+            if shared:
+                return
+            shutil.rmtree(self.folder)
+        try:
+            os.makedirs(self.folder)
+        except OSError:
+            if not os.path.isdir(self.folder):
+                raise
+
+    def load(self):
+        self.bitmaps = {}
+        for tz in range(self.tminz, self.tmaxz + 1):
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+            self.bitmaps[tz] = bytearray(((tmaxx - tminx + 1) * (tmaxy - tminy + 1) + 7) // 8)
+
+        for filename in os.listdir(self.folder):
+            with open(os.path.join(self.folder, filename)) as f:
+                for line in f:
+                    try:
+                        tz, tx, ty = [int(v) for v in line.split()]
+                    except ValueError:
+                        # Last line of a process that was interrupted
+                        continue
+                    index = self.bit_index(tz, tx, ty)
+                    if index is not None:
+                        self.bitmaps[tz][index >> 3] |= 1 << (index & 7)
+
+    def is_loaded(self):
+        return self.bitmaps is not None
+
+    def bit_index(self, tz, tx, ty):
+        if tz < self.tminz or tz > self.tmaxz:
+            return None
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+        if tx < tminx or tx > tmaxx or ty < tminy or ty > tmaxy:
+            return None
+        return (ty - tminy) * (tmaxx - tminx + 1) + tx - tminx
+
+    def __contains__(self, tile):
+        index = self.bit_index(*tile)
+        return index is not None and bool(self.bitmaps[tile[0]][index >> 3] & (1 << (index & 7)))
+
+    def add(self, tz, tx, ty):
+        if self.log is None:
+            self.log = open(os.path.join(self.folder, '%s.log' % uuid4().hex), 'a')
+            # Pool workers do not run the destructors when they exit
+            Finalize(self.log, self.log.close, exitpriority=10)
+        self.log.write('%d %d %d\n' % (tz, tx, ty))
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.folder)
+
+
+class TileProfiler(object):
+    """
+    Timings of the stages of the tiles rendered by the current process (--profile-report option)
+
+    For each tile, the time between start() and each lap() call is added to the stage given to
+    lap(), with the number of bytes the stage processed. Like the TileManifest, each process
+    appends its tile records (JSON lines) to its own log next to the report, and
+    write_profile_report() merges the logs into the report at the end of the run.
+    """
+
+    def __init__(self, report_file):
+        self.report_file = report_file
+        self.log = None
+        self.record = None
+        self.start_time = self.lap_time = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['log'] = None
+        state['record'] = None
+        return state
+
+    def start(self, kind, tz, tx, ty):
+        self.record = {'kind': kind, 'tile': [tz, tx, ty], 'stages': {}}
+        self.start_time = self.lap_time = default_timer()
+
+    def lap(self, stage, nbytes=0, filename=None):
+        """Adds the time since the previous lap to stage, with the size of filename if given"""
+        now = default_timer()
+        if not nbytes and filename is not None and os.path.exists(filename):
+            nbytes = os.path.getsize(filename)
+        times = self.record['stages'].setdefault(stage, [0.0, 0])
+        times[0] += now - self.lap_time
+        times[1] += nbytes
+        self.lap_time = default_timer()
+
+    def end(self):
+        self.record['time'] = default_timer() - self.start_time
+        if self.log is None:
+            self.log = open('%s.%s.log' % (self.report_file, uuid4().hex), 'a')
+            # Pool workers do not run the destructors when they exit
+            Finalize(self.log, self.log.close, exitpriority=10)
+        self.log.write(json.dumps(self.record) + '\n')
+        self.record = None
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class NullTileProfiler(object):
+    """Stands for the TileProfiler when --profile-report is not used"""
+
+    def start(self, kind, tz, tx, ty):
+        pass
+
+    def lap(self, stage, nbytes=0, filename=None):
+        pass
+
+    def end(self):
+        pass
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of a sorted list of values"""
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def profile_log_files(report_file):
+    """Returns the TileProfiler logs of a report"""
+    folder, prefix = os.path.split(os.path.abspath(report_file))
+    return [os.path.join(folder, filename) for filename in sorted(os.listdir(folder))
+            if filename.startswith(prefix + '.') and filename.endswith('.log')]
+
+
+def write_profile_report(report_file, phase_times, nb_slowest_tiles=20):
+    """
+    Merges the tile records logged by the TileProfiler of each process into a JSON report with
+    the wall-clock time of the phases of the run, the time and bytes of each stage per zoom level,
+    the percentiles of the tile times per zoom level, and the slowest tiles
+    """
+    records = []
+    for filename in profile_log_files(report_file):
+        with open(filename) as f:
+            records.extend(json.loads(line) for line in f if line.endswith('\n'))
+        os.unlink(filename)
+
+    zoom_levels = {}
+    for record in records:
+        level = zoom_levels.setdefault(str(record['tile'][0]), {
+            'tiles': 0, 'metatiles': 0, 'time': 0.0, 'stages': {}, 'tile_times': []})
+        if record['kind'] == 'metatile':
+            level['metatiles'] += 1
+        else:
+            level['tiles'] += 1
+            level['tile_times'].append(record['time'])
+        level['time'] += record['time']
+        for stage, (seconds, nbytes) in record['stages'].items():
+            totals = level['stages'].setdefault(stage, {'time': 0.0, 'bytes': 0})
+            totals['time'] += seconds
+            totals['bytes'] += nbytes
+
+    for level in zoom_levels.values():
+        tile_times = sorted(level.pop('tile_times'))
+        level['tile_time_percentiles'] = dict(
+            ('p%d' % p, percentile(tile_times, p)) for p in (50, 90, 99, 100))
+
+    tiles = [record for record in records if record['kind'] != 'metatile']
+    tiles.sort(key=lambda record: record['time'], reverse=True)
+    for record in tiles[:nb_slowest_tiles]:
+        record['stages'] = dict((stage, {'time': seconds, 'bytes': nbytes})
+                                for stage, (seconds, nbytes) in record['stages'].items())
+    report = {
+        'phases': phase_times,
+        'zoom_levels': zoom_levels,
+        'slowest_tiles': tiles[:nb_slowest_tiles],
+    }
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def create_tile_columns(output_folder, tz, tminx, tmaxx):
+    """Creates the directories of the tile columns tminx to tmaxx of zoom level tz"""
+    for tx in range(tminx, tmaxx + 1):
+        column = os.path.join(output_folder, str(tz), str(tx))
+        if not os.path.isdir(column):
+            try:
+                os.makedirs(column)
+            except OSError:
+                # Another run working on the same tile tree may have created it in the meantime
+                if not os.path.isdir(column):
+                    raise
+
+
+def is_transparent(alpha):
+    """Returns whether an alpha band buffer (as returned by ReadRaster) is fully transparent"""
+    return alpha is None or alpha.count(b'\x00') == len(alpha)
+
+
+def encode_tile(out_drv, dstile, tileext):
+    """Returns the tile dataset encoded with the tile driver, as a bytes object"""
+    filename = '/vsimem/%s.%s' % (uuid4(), tileext)
+    out_drv.CreateCopy(filename, dstile, strict=0)
+
+    data = read_vsimem_file(filename)
+    gdal.Unlink(filename + '.aux.xml')
+    return data
+
+
+def save_tile(tile_job_info, out_drv, dstile, tz, tx, ty, tilefilename):
+    """
+    Writes the tile dataset to the tile tree, or to the tile container writer. Returns the size of
+    the encoded tile when it is encoded in memory, 0 otherwise.
+    """
+    if tile_job_info.container:
+        data = encode_tile(out_drv, dstile, tile_job_info.tile_extension)
+        _tile_worker_handles['tile_writer'].put(tz, tx, ty, data)
+    elif 'deduplicator' in _tile_worker_handles:
+        data = encode_tile(out_drv, dstile, tile_job_info.tile_extension)
+        _tile_worker_handles['deduplicator'].write(data, tilefilename)
+    else:
+        out_drv.CreateCopy(tilefilename, dstile, strict=0)
+        return 0
+    return len(data)
+
+
+def tile_exists(tile_job_info, tz, tx, ty, tilefilename):
+    if tile_job_info.container:
+        return _tile_worker_handles['container'].has_tile(tz, tx, ty)
+    manifest = _tile_worker_handles.get('manifest')
+    if manifest is not None and manifest.is_loaded():
+        return (tz, tx, ty) in manifest
+    return os.path.exists(tilefilename)
+
+
+def mark_tile_done(tz, tx, ty):
+    """Records a tile (generated, or excluded as transparent) in the manifest of the process"""
+    manifest = _tile_worker_handles.get('manifest')
+    if manifest is not None:
+        manifest.add(tz, tx, ty)
+
+
+def read_tile_raster(tile_job_info, tz, tx, ty, tilefilename):
+    """
+    Returns the decoded pixels (all bands) of a tile already written to the tile tree or to the
+    tile container, or None if the tile does not exist
+    """
+    tilesize = tile_job_info.tile_size
+    if not tile_job_info.container:
+        # Tiles skipped with -x are not written
+        if not os.path.isfile(tilefilename):
+            return None
+        ds = gdal.Open(tilefilename, gdal.GA_ReadOnly)
+        if ds is None:
+            return None
+        return ds.ReadRaster(0, 0, tilesize, tilesize)
+
+    data = _tile_worker_handles['container'].read_tile(tz, tx, ty)
+    if data is None:
+        return None
+    filename = '/vsimem/%s.%s' % (uuid4(), tile_job_info.tile_extension)
+    gdal.FileFromMemBuffer(filename, data)
+    ds = gdal.Open(filename, gdal.GA_ReadOnly)
+    raster = ds.ReadRaster(0, 0, tilesize, tilesize)
+    ds = None
+    gdal.Unlink(filename)
+    return raster
+
+
+# GDAL handles of the current process, opened once by init_tile_worker() and reused for all the
+# tiles rendered by this process
+_tile_worker_handles = {}
+_null_tile_profiler = NullTileProfiler()
+
+
+def init_tile_worker(tile_job_info, tile_queue=None, manifest=None):
+    """
+    Open the source dataset, the MEM driver and the tile driver once for the current process.
+
+    Used as the initializer of the multiprocessing Pool, so that each worker keeps its own
+    dataset handle (and its block cache) instead of re-opening the source for every tile.
+    When writing to a tile container, tile_queue is the queue of the TileWriterProcess; without
+    it, the tiles are written directly to the container by this process. When writing a tile
+    tree, the completed tiles are recorded in manifest.
+    """
     gdal.AllRegister()
 
+    _tile_worker_handles.clear()
+    _tile_worker_handles['src_file'] = tile_job_info.src_file
+    _tile_worker_handles['ds'] = gdal.Open(tile_job_info.src_file, gdal.GA_ReadOnly)
+    _tile_worker_handles['mem_drv'] = gdal.GetDriverByName('MEM')
+    _tile_worker_handles['out_drv'] = gdal.GetDriverByName(tile_job_info.tile_driver)
+
+    if tile_job_info.container:
+        _tile_worker_handles['container'] = tile_job_info.container
+        if tile_queue is not None:
+            _tile_worker_handles['tile_writer'] = QueueTileWriter(tile_queue)
+        else:
+            _tile_worker_handles['tile_writer'] = TileContainerWriter(tile_job_info.container)
+    elif tile_job_info.options.deduplicate:
+        _tile_worker_handles['deduplicator'] = TileDeduplicator()
+
+    if manifest is not None:
+        _tile_worker_handles['manifest'] = manifest
+
+    if tile_job_info.options.profile_report:
+        _tile_worker_handles['profiler'] = TileProfiler(tile_job_info.options.profile_report)
+
+
+def get_tile_worker_handles(tile_job_info):
+    """Returns the (source dataset, MEM driver, tile driver) handles of the current process"""
+    if _tile_worker_handles.get('src_file') != tile_job_info.src_file:
+        init_tile_worker(tile_job_info)
+
+    return (_tile_worker_handles['ds'], _tile_worker_handles['mem_drv'],
+            _tile_worker_handles['out_drv'])
+
+
+def get_tile_profiler():
+    """Returns the TileProfiler of the current process, or a NullTileProfiler"""
+    return _tile_worker_handles.get('profiler', _null_tile_profiler)
+
+
+def release_tile_worker_handles():
+    """Closes the handles of the current process"""
+    if 'profiler' in _tile_worker_handles:
+        _tile_worker_handles['profiler'].close()
+    _tile_worker_handles.clear()
+
+
+def create_base_tile(tile_job_info, tile_detail, metatile=None):
+    """
+    Generation of a base tile from the source dataset, or from the (metatile dataset, (x, y)
+    offset of the tile query window in it) metatile, already read by create_base_metatile()
+
+    Returns the number of tiles processed (1), for the progress bar.
+    """
     dataBandsCount = tile_job_info.nb_data_bands
     output = tile_job_info.output_file_path
     tileext = tile_job_info.tile_extension
@@ -932,10 +2119,9 @@ def create_base_tile(tile_job_info, tile_detail, queue=None):
     options = tile_job_info.options
 
     tilebands = dataBandsCount + 1
-    ds = gdal.Open(tile_job_info.src_file, gdal.GA_ReadOnly)
-    mem_drv = gdal.GetDriverByName('MEM')
-    out_drv = gdal.GetDriverByName(tile_job_info.tile_driver)
+    ds, mem_drv, out_drv = get_tile_worker_handles(tile_job_info)
     alphaband = ds.GetRasterBand(1).GetMaskBand()
+    profiler = get_tile_profiler()
 
     tx = tile_detail.tx
     ty = tile_detail.ty
@@ -950,9 +2136,19 @@ def create_base_tile(tile_job_info, tile_detail, queue=None):
     wysize = tile_detail.wysize
     querysize = tile_detail.querysize
 
-    # Tile dataset in memory
     tilefilename = os.path.join(
         output, str(tz), str(tx), "%s.%s" % (ty, tileext))
+
+    profiler.start('base', tz, tx, ty)
+    if options.resume and tile_exists(tile_job_info, tz, tx, ty, tilefilename):
+        if options.verbose:
+            print("Tile generation skipped because of --resume")
+        profiler.lap('exists')
+        profiler.end()
+        return 1
+    profiler.lap('exists')
+
+    # Tile dataset in memory
     dstile = mem_drv.Create('', tilesize, tilesize, tilebands)
 
     data = alpha = None
@@ -965,9 +2161,22 @@ def create_base_tile(tile_job_info, tile_detail, queue=None):
     # We scale down the query to the tilesize by supplied algorithm.
 
     if rxsize != 0 and rysize != 0 and wxsize != 0 and wysize != 0:
-        data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize,
-                             band_list=list(range(1, dataBandsCount + 1)))
-        alpha = alphaband.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
+        if metatile is None:
+            data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize,
+                                 band_list=list(range(1, dataBandsCount + 1)))
+            alpha = alphaband.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
+        else:
+            dsmeta, (mx, my) = metatile
+            data = dsmeta.ReadRaster(mx, my, wxsize, wysize,
+                                     band_list=list(range(1, dataBandsCount + 1)))
+            alpha = dsmeta.GetRasterBand(tilebands).ReadRaster(mx, my, wxsize, wysize)
+        profiler.lap('read', len(data) + len(alpha))
+
+    if options.exclude_transparent and is_transparent(alpha):
+        # Nothing to see in this tile: do not write it
+        mark_tile_done(tz, tx, ty)
+        profiler.end()
+        return 1
 
     # The tile in memory is a transparent file by default. Write pixel values into it if
     # any
@@ -995,15 +2204,14 @@ def create_base_tile(tile_job_info, tile_detail, queue=None):
             scale_query_to_tile(dsquery, dstile, tile_job_info.tile_driver, options,
                                 tilefilename=tilefilename)
             del dsquery
+        profiler.lap('scale')
 
-    # Force freeing the memory to make sure the C++ destructor is called and the memory as well as
-    # the file locks are released
-    del ds
+    # Force freeing the memory to make sure the C++ destructor is called
     del data
 
-    if options.resampling != 'antialias':
-        # Write a copy of tile to png/jpg
-        out_drv.CreateCopy(tilefilename, dstile, strict=0)
+    # Write a copy of tile to png/jpg
+    profiler.lap('write', save_tile(tile_job_info, out_drv, dstile, tz, tx, ty, tilefilename),
+                 filename=None if tile_job_info.container else tilefilename)
 
     del dstile
 
@@ -1016,27 +2224,389 @@ def create_base_tile(tile_job_info, tile_detail, queue=None):
                     tx, ty, tz, tile_job_info.tile_extension, tile_job_info.tile_size,
                     tile_job_info.tile_swne, tile_job_info.options
                 ).encode('utf-8'))
+        profiler.lap('kml')
+
+    mark_tile_done(tz, tx, ty)
+    profiler.end()
+
+    return 1
+
 
-    if queue:
-        queue.put("tile %s %s %s" % (tx, ty, tz))
+def create_base_metatile(tile_job_info, metatile_detail):
+    """
+    Generation of a block of base tiles (--metatile option): the source window covering all the
+    tiles is read with a single ReadRaster() call, then sliced into the tiles in memory
 
+    Returns the number of tiles processed, for the progress bar.
+    """
+    tilebands = tile_job_info.nb_data_bands + 1
+    options = tile_job_info.options
+    m = metatile_detail
+
+    if options.resume and all(tile_exists(
+            tile_job_info, t.tz, t.tx, t.ty,
+            os.path.join(tile_job_info.output_file_path, str(t.tz), str(t.tx),
+                         "%s.%s" % (t.ty, tile_job_info.tile_extension)))
+            for t in m.tiles):
+        if options.verbose:
+            print("Metatile generation skipped because of --resume")
+        return len(m.tiles)
+
+    if not m.bxsize:
+        # The query windows of the tiles can not be merged: read them separately
+        for tile_detail in m.tiles:
+            create_base_tile(tile_job_info, tile_detail)
+        return len(m.tiles)
+
+    ds, mem_drv, _ = get_tile_worker_handles(tile_job_info)
+    alphaband = ds.GetRasterBand(1).GetMaskBand()
+    profiler = get_tile_profiler()
+
+    if options.verbose:
+        print("\tReadRaster Metatile Extent: ",
+              (m.rx, m.ry, m.rxsize, m.rysize), (m.bxsize, m.bysize))
 
-def create_overview_tiles(tile_job_info, output_folder, options):
-    """Generation of the overview tiles (higher in the pyramid) based on existing tiles"""
-    mem_driver = gdal.GetDriverByName('MEM')
+    # The block read is profiled apart from the tiles, under the first tile of the block
+    profiler.start('metatile', m.tiles[0].tz, m.tiles[0].tx, m.tiles[0].ty)
+    dsmeta = mem_drv.Create('', m.bxsize, m.bysize, tilebands)
+    dsmeta.WriteRaster(0, 0, m.bxsize, m.bysize,
+                       ds.ReadRaster(m.rx, m.ry, m.rxsize, m.rysize, m.bxsize, m.bysize,
+                                     band_list=list(range(1, tilebands))),
+                       band_list=list(range(1, tilebands)))
+    dsmeta.WriteRaster(0, 0, m.bxsize, m.bysize,
+                       alphaband.ReadRaster(m.rx, m.ry, m.rxsize, m.rysize, m.bxsize, m.bysize),
+                       band_list=[tilebands])
+    profiler.lap('read', m.bxsize * m.bysize * tilebands)
+    profiler.end()
+
+    for tile_detail, position in zip(m.tiles, m.positions):
+        create_base_tile(tile_job_info, tile_detail, metatile=(dsmeta, position))
+
+    del dsmeta
+
+    return len(m.tiles)
+
+
+def create_overview_tile(base_tz, base_tiles, output_folder, tile_job_info, options,
+                         tile_cache=None):
+    """
+    Generation of an overview tile from its (at most 4) underlying tiles (base tiles)
+
+    The rasters of the base tiles are taken from tile_cache when they are there, and the raster
+    of the new tile is added to it.
+    """
+    _, mem_driver, out_driver = get_tile_worker_handles(tile_job_info)
     tile_driver = tile_job_info.tile_driver
-    out_driver = gdal.GetDriverByName(tile_driver)
+    profiler = get_tile_profiler()
 
     tilebands = tile_job_info.nb_data_bands + 1
 
-    # Usage of existing tiles: from 4 underlying tiles generate one as overview.
+    tz = base_tz - 1
+    tx = base_tiles[0][0] // 2
+    ty = base_tiles[0][1] // 2
+
+    tilefilename = os.path.join(output_folder,
+                                str(tz),
+                                str(tx),
+                                "%s.%s" % (ty, tile_job_info.tile_extension))
+
+    if options.verbose:
+        print(tilefilename)
+
+    profiler.start('overview', tz, tx, ty)
+    if options.resume and tile_exists(tile_job_info, tz, tx, ty, tilefilename):
+        if options.verbose:
+            print("Tile generation skipped because of --resume")
+        profiler.lap('exists')
+        profiler.end()
+        return
+    profiler.lap('exists')
+
+    dsquery = mem_driver.Create('', 2 * tile_job_info.tile_size,
+                                2 * tile_job_info.tile_size, tilebands)
+    # TODO: fill the null value
+    dstile = mem_driver.Create('', tile_job_info.tile_size, tile_job_info.tile_size,
+                               tilebands)
+
+    children = []
+    nbytes = 0
+    # Read the tiles and write them to query window
+    for x, y in base_tiles:
+        if tile_cache is not None and (base_tz, x, y) in tile_cache:
+            base_tile_raster = tile_cache.pop((base_tz, x, y))
+        else:
+            base_tile_raster = read_tile_raster(
+                tile_job_info, base_tz, x, y,
+                os.path.join(output_folder, str(base_tz), str(x),
+                             "%s.%s" % (y, tile_job_info.tile_extension)))
+        if base_tile_raster is None:
+            continue
+        nbytes += len(base_tile_raster)
+        # TMS y axis goes up: the southern child is at the bottom of the query window
+        if y == 2 * ty:
+            tileposy = tile_job_info.tile_size
+        else:
+            tileposy = 0
+        tileposx = (x - 2 * tx) * tile_job_info.tile_size
+        dsquery.WriteRaster(
+            tileposx, tileposy, tile_job_info.tile_size,
+            tile_job_info.tile_size,
+            base_tile_raster,
+            band_list=list(range(1, tilebands + 1)))
+        children.append([x, y, base_tz])
+    profiler.lap('read', nbytes)
+
+    if options.exclude_transparent and not children:
+        # All the base tiles were excluded as transparent
+        if tile_cache is not None:
+            tile_cache.put((tz, tx, ty), None)
+        mark_tile_done(tz, tx, ty)
+        profiler.end()
+        return
+
+    scale_query_to_tile(dsquery, dstile, tile_driver, options,
+                        tilefilename=tilefilename)
+    profiler.lap('scale')
+    # Write a copy of tile to png/jpg
+    profiler.lap('write', save_tile(tile_job_info, out_driver, dstile, tz, tx, ty, tilefilename),
+                 filename=None if tile_job_info.container else tilefilename)
+    if tile_cache is not None:
+        tile_cache.put((tz, tx, ty), dstile.ReadRaster(0, 0, tile_job_info.tile_size,
+                                                       tile_job_info.tile_size))
+        profiler.lap('cache')
+
+    if options.verbose:
+        print("\tbuild from zoom", base_tz,
+              " tiles:", (2 * tx, 2 * ty), (2 * tx + 1, 2 * ty),
+              (2 * tx, 2 * ty + 1), (2 * tx + 1, 2 * ty + 1))
+
+    # Create a KML file for this tile.
+    if tile_job_info.kml:
+        with open(os.path.join(
+            output_folder,
+            '%d/%d/%d.kml' % (tz, tx, ty)
+        ), 'wb') as f:
+            f.write(generate_kml(
+                tx, ty, tz, tile_job_info.tile_extension, tile_job_info.tile_size,
+                get_tile_swne(tile_job_info, options), options, children
+            ).encode('utf-8'))
+        profiler.lap('kml')
+
+    mark_tile_done(tz, tx, ty)
+    profiler.end()
+
+
+def overview_tile_children(tz, tx, ty, tile_job_info):
+    """Returns the (x, y) tiles of zoom level tz + 1 under the tile tx, ty of zoom level tz"""
+    minx, miny, maxx, maxy = tile_job_info.tminmax[tz + 1]
+    children = []
+    for y in range(2 * ty, 2 * ty + 2):
+        for x in range(2 * tx, 2 * tx + 2):
+            if x >= minx and x <= maxx and y >= miny and y <= maxy:
+                children.append((x, y))
+    return children
+
+
+def create_overview_subtree(subtree, output_folder, tile_job_info, options):
+    """
+    Generation of the overview tile root_tile (tz, tx, ty) of a (root_tile, max_tz) subtree and of
+    all the overview tiles below it, down to zoom level max_tz - 1. The tiles of zoom level max_tz
+    must already exist.
 
-    tcount = 0
+    The quadtree is walked depth first, so that the four children of a tile have just been built
+    when the tile is, and their rasters are still in a small TileRasterCache: the overview tiles
+    are never read back from the encoded tiles. Returns the number of tiles generated.
+    """
+    root_tile, max_tz = subtree
+    tile_cache = TileRasterCache()
+    nb_tiles = [0]
+
+    def create_subtree(tz, tx, ty):
+        children = overview_tile_children(tz, tx, ty, tile_job_info)
+        if tz + 1 < max_tz:
+            for x, y in children:
+                create_subtree(tz + 1, x, y)
+        create_overview_tile(tz + 1, children, output_folder, tile_job_info, options,
+                             tile_cache=tile_cache)
+        nb_tiles[0] += 1
+
+    create_subtree(*root_tile)
+    return nb_tiles[0]
+
+
+def overview_root_tiles(tz, tile_job_info):
+    """Returns the (tz, tx, ty) tiles of zoom level tz that have tiles under them"""
+    tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
+    return [(tz, tx, ty)
+            for ty in range(tmaxy, tminy - 1, -1)
+            for tx in range(tminx, tmaxx + 1)
+            if overview_tile_children(tz, tx, ty, tile_job_info)]
+
+
+def intersect_tile_ranges(range1, range2):
+    """Returns the intersection of two (tminx, tminy, tmaxx, tmaxy) ranges, or None"""
+    tminx, tminy = max(range1[0], range2[0]), max(range1[1], range2[1])
+    tmaxx, tmaxy = min(range1[2], range2[2]), min(range1[3], range2[3])
+    if tminx > tmaxx or tminy > tmaxy:
+        return None
+    return (tminx, tminy, tmaxx, tmaxy)
+
+
+def tile_range_size(tile_range):
+    if tile_range is None:
+        return 0
+    tminx, tminy, tmaxx, tmaxy = tile_range
+    return (tmaxx - tminx + 1) * (tmaxy - tminy + 1)
+
+
+def morton_key(tx, ty):
+    """Position of a tile along the Z-order (Morton) curve: the bits of tx and ty interleaved"""
+    key = 0
+    bit = 0
+    while tx >> bit or ty >> bit:
+        key |= ((tx >> bit) & 1) << (2 * bit) | ((ty >> bit) & 1) << (2 * bit + 1)
+        bit += 1
+    return key
+
+
+def morton_tile(key):
+    """Tile (tx, ty) at a position along the Z-order curve"""
+    tx = ty = 0
+    bit = 0
+    while key >> (2 * bit):
+        tx |= ((key >> (2 * bit)) & 1) << bit
+        ty |= ((key >> (2 * bit + 1)) & 1) << bit
+        bit += 1
+    return tx, ty
+
+
+def morton_key_at_rank(tile_range, rank, nb_levels):
+    """
+    Position along the Z-order curve of the rank-th tile of tile_range in the curve order, in a
+    grid of 2**nb_levels x 2**nb_levels tiles. Returns 4**nb_levels when rank is past the end.
+    """
+    if rank >= tile_range_size(tile_range):
+        return 4 ** nb_levels
+
+    key = 0
+    x0 = y0 = 0
+    for level in range(nb_levels - 1, -1, -1):
+        half = 1 << level
+        for quadrant in range(4):
+            qx = x0 + (quadrant & 1) * half
+            qy = y0 + (quadrant >> 1) * half
+            nb_tiles = tile_range_size(
+                intersect_tile_ranges((qx, qy, qx + half - 1, qy + half - 1), tile_range))
+            if rank < nb_tiles:
+                break
+            rank -= nb_tiles
+        key = key * 4 + quadrant
+        x0, y0 = qx, qy
+    return key
+
+
+def shard_tile_ranges(tile_range, shard, nb_shards):
+    """
+    Splits a (tminx, tminy, tmaxx, tmaxy) tile range into nb_shards parts with the same number of
+    tiles, each one contiguous along the Z-order curve, and returns the tile ranges making up part
+    number shard (0 <= shard < nb_shards).
+
+    A part of the curve is a union of aligned quadtree blocks, so that most overview tiles only
+    depend on the base tiles of a single part.
+    """
+    nb_tiles = tile_range_size(tile_range)
+    nb_levels = max(tile_range[2], tile_range[3]).bit_length()
+    key = morton_key_at_rank(tile_range, shard * nb_tiles // nb_shards, nb_levels)
+    end = morton_key_at_rank(tile_range, (shard + 1) * nb_tiles // nb_shards, nb_levels)
+
+    ranges = []
+    while key < end:
+        # Largest aligned block starting at key and ending before end
+        level = 0
+        while key % (4 ** (level + 1)) == 0 and key + 4 ** (level + 1) <= end:
+            level += 1
+        tx, ty = morton_tile(key)
+        block = intersect_tile_ranges(
+            (tx, ty, tx + (1 << level) - 1, ty + (1 << level) - 1), tile_range)
+        if block is not None:
+            ranges.append(block)
+        key += 4 ** level
+    return ranges
+
+
+def overview_tile_footprint(tz, tx, ty, tile_job_info, zoom=None):
+    """Tile range of the tiles at zoom level zoom (default: base level) under a tile, or None"""
+    if zoom is None:
+        zoom = tile_job_info.tmaxz
+    d = zoom - tz
+    return intersect_tile_ranges(
+        (tx << d, ty << d, ((tx + 1) << d) - 1, ((ty + 1) << d) - 1), tile_job_info.tminmax[zoom])
+
+
+def shard_overview_root_tiles(tile_job_info):
+    """
+    Returns the highest overview tiles whose base tiles are all in the shard of the run: these
+    tiles, and all the overview tiles below them, can be built without the other shards.
+    """
+    root_tiles = []
+    tiles = overview_root_tiles(tile_job_info.tminz, tile_job_info)
+    while tiles:
+        next_tiles = []
+        for tz, tx, ty in tiles:
+            footprint = overview_tile_footprint(tz, tx, ty, tile_job_info)
+            nb_shard_tiles = sum(
+                tile_range_size(intersect_tile_ranges(footprint, shard_range))
+                for shard_range in tile_job_info.shard_ranges)
+            if nb_shard_tiles == tile_range_size(footprint):
+                root_tiles.append((tz, tx, ty))
+            elif nb_shard_tiles and tz + 1 < tile_job_info.tmaxz:
+                next_tiles.extend((tz + 1, x, y)
+                                  for x, y in overview_tile_children(tz, tx, ty, tile_job_info))
+        tiles = next_tiles
+    return root_tiles
+
+
+def count_base_tiles(tile_job_info):
+    if tile_job_info.options.overviews_only:
+        return 0
+    if tile_job_info.shard_ranges is not None:
+        return sum(tile_range_size(r) for r in tile_job_info.shard_ranges)
+    tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tile_job_info.tmaxz]
+    return (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
+
+
+def count_overview_tiles(tile_job_info):
+    tile_number = 0
     for tz in range(tile_job_info.tmaxz - 1, tile_job_info.tminz - 1, -1):
         tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
-        tcount += (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
+        tile_number += (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
+
+    return tile_number
+
+
+def create_overview_tiles(tile_job_info, output_folder, options, pool=None, tile_writer=None):
+    """
+    Generation of the overview tiles (higher in the pyramid) based on existing tiles
+
+    The pyramid is built by subtrees (create_overview_subtree()). When the run is restricted to a
+    shard, only the subtrees whose base tiles are all in the shard are built. If a multiprocessing
+    pool is given, the subtrees are split until there are enough of them to keep all the workers
+    busy, then the roots of the split subtrees are built from their children, a zoom level at a
+    time. With a tile container, tile_writer is flushed before each of these steps, so that the
+    tiles written by the other processes can be read back.
+    """
+    # A single zoom level has no overview tiles
+    if tile_job_info.tminz >= tile_job_info.tmaxz:
+        return
 
-    ti = 0
+    if tile_job_info.shard_ranges is None:
+        root_tiles = overview_root_tiles(tile_job_info.tminz, tile_job_info)
+        tcount = count_overview_tiles(tile_job_info)
+    else:
+        root_tiles = shard_overview_root_tiles(tile_job_info)
+        tcount = sum(tile_range_size(overview_tile_footprint(tz, tx, ty, tile_job_info, zoom))
+                     for tz, tx, ty in root_tiles
+                     for zoom in range(tz, tile_job_info.tmaxz))
 
     if tcount == 0:
         return
@@ -1044,98 +2614,52 @@ def create_overview_tiles(tile_job_info, output_folder, options):
     if not options.quiet:
         print("Generating Overview Tiles:")
 
-    progress_bar = ProgressBar(tcount)
-    progress_bar.start()
-
-    for tz in range(tile_job_info.tmaxz - 1, tile_job_info.tminz - 1, -1):
-        tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
-        for ty in range(tmaxy, tminy - 1, -1):
-            for tx in range(tminx, tmaxx + 1):
-
-                ti += 1
-                tilefilename = os.path.join(output_folder,
-                                            str(tz),
-                                            str(tx),
-                                            "%s.%s" % (ty, tile_job_info.tile_extension))
-
-                if options.verbose:
-                    print(ti, '/', tcount, tilefilename)
+    progress_bar = None
+    if not options.verbose and not options.quiet:
+        progress_bar = ProgressBar(tcount)
+        progress_bar.start()
 
-                if options.resume and os.path.exists(tilefilename):
-                    if options.verbose:
-                        print("Tile generation skipped because of --resume")
-                    else:
-                        progress_bar.log_progress()
-                    continue
-
-                # Create directories for the tile
-                if not os.path.exists(os.path.dirname(tilefilename)):
-                    os.makedirs(os.path.dirname(tilefilename))
-
-                dsquery = mem_driver.Create('', 2 * tile_job_info.tile_size,
-                                            2 * tile_job_info.tile_size, tilebands)
-                # TODO: fill the null value
-                dstile = mem_driver.Create('', tile_job_info.tile_size, tile_job_info.tile_size,
-                                           tilebands)
-
-                # TODO: Implement more clever walking on the tiles with cache functionality
-                # probably walk should start with reading of four tiles from top left corner
-                # Hilbert curve
-
-                children = []
-                # Read the tiles and write them to query window
-                for y in range(2 * ty, 2 * ty + 2):
-                    for x in range(2 * tx, 2 * tx + 2):
-                        minx, miny, maxx, maxy = tile_job_info.tminmax[tz + 1]
-                        if x >= minx and x <= maxx and y >= miny and y <= maxy:
-                            dsquerytile = gdal.Open(
-                                os.path.join(output_folder, str(tz + 1), str(x),
-                                             "%s.%s" % (y, tile_job_info.tile_extension)),
-                                gdal.GA_ReadOnly)
-                            if (ty == 0 and y == 1) or (ty != 0 and (y % (2 * ty)) != 0):
-                                tileposy = 0
-                            else:
-                                tileposy = tile_job_info.tile_size
-                            if tx:
-                                tileposx = x % (2 * tx) * tile_job_info.tile_size
-                            elif tx == 0 and x == 1:
-                                tileposx = tile_job_info.tile_size
-                            else:
-                                tileposx = 0
-                            dsquery.WriteRaster(
-                                tileposx, tileposy, tile_job_info.tile_size,
-                                tile_job_info.tile_size,
-                                dsquerytile.ReadRaster(0, 0,
-                                                       tile_job_info.tile_size,
-                                                       tile_job_info.tile_size),
-                                band_list=list(range(1, tilebands + 1)))
-                            children.append([x, y, tz + 1])
-
-                scale_query_to_tile(dsquery, dstile, tile_driver, options,
-                                    tilefilename=tilefilename)
-                # Write a copy of tile to png/jpg
-                if options.resampling != 'antialias':
-                    # Write a copy of tile to png/jpg
-                    out_driver.CreateCopy(tilefilename, dstile, strict=0)
-
-                if options.verbose:
-                    print("\tbuild from zoom", tz + 1,
-                          " tiles:", (2 * tx, 2 * ty), (2 * tx + 1, 2 * ty),
-                          (2 * tx, 2 * ty + 1), (2 * tx + 1, 2 * ty + 1))
-
-                # Create a KML file for this tile.
-                if tile_job_info.kml:
-                    with open(os.path.join(
-                        output_folder,
-                        '%d/%d/%d.kml' % (tz, tx, ty)
-                    ), 'wb') as f:
-                        f.write(generate_kml(
-                            tx, ty, tz, tile_job_info.tile_extension, tile_job_info.tile_size,
-                            get_tile_swne(tile_job_info, options), options, children
-                        ).encode('utf-8'))
+    if not tile_job_info.container:
+        columns = set()
+        for tz, tx, ty in root_tiles:
+            for zoom in range(tz, tile_job_info.tmaxz):
+                tminx, _, tmaxx, _ = overview_tile_footprint(tz, tx, ty, tile_job_info, zoom)
+                columns.add((zoom, tminx, tmaxx))
+        for zoom, tminx, tmaxx in sorted(columns):
+            create_tile_columns(output_folder, zoom, tminx, tmaxx)
+
+    steps = [[(root_tile, tile_job_info.tmaxz) for root_tile in root_tiles]]
+    if pool:
+        nb_processes = options.nb_processes or 1
+        while len(steps[0]) < 4 * nb_processes:
+            subtrees = []
+            parents = []
+            for (tz, tx, ty), max_tz in steps[0]:
+                if tz + 1 < max_tz:
+                    subtrees.extend(((tz + 1, x, y), max_tz)
+                                    for x, y in overview_tile_children(tz, tx, ty, tile_job_info))
+                    parents.append(((tz, tx, ty), tz + 1))
+                else:
+                    subtrees.append(((tz, tx, ty), max_tz))
+            if not parents:
+                break
+            steps[0:1] = [subtrees, parents]
+
+    for subtrees in steps:
+        if tile_writer:
+            tile_writer.flush()
+        if pool:
+            results = pool.imap_unordered(
+                partial(create_overview_subtree, output_folder=output_folder,
+                        tile_job_info=tile_job_info, options=options),
+                subtrees)
+        else:
+            results = (create_overview_subtree(subtree, output_folder, tile_job_info, options)
+                       for subtree in subtrees)
 
-                if not options.verbose and not options.quiet:
-                    progress_bar.log_progress()
+        for nb_tiles in results:
+            if progress_bar:
+                progress_bar.log_progress(nb_tiles)
 
 
 def optparse_init():
@@ -1172,6 +2696,31 @@ def optparse_init():
                  dest="nb_processes",
                  type='int',
                  help="Number of processes to use for tiling")
+    p.add_option("--container", dest="container",
+                 type='choice', choices=container_list,
+                 help=("Write all the tiles into a single file container (%s) instead of a "
+                       "directory tree. The output argument is then the name of the "
+                       "file" % ",".join(container_list)))
+    p.add_option("--metatile", dest="metatile", type='int', metavar="N",
+                 help=("Read blocks of NxN base tiles from the source at once, and slice them "
+                       "into tiles in memory - default 1"))
+    p.add_option("-x", "--exclude", dest="exclude_transparent", action="store_true",
+                 help="Exclude transparent tiles from result tileset")
+    p.add_option("--deduplicate", dest="deduplicate", action="store_true",
+                 help=("Store identical tiles only once: as hardlinks in the tile tree, or as a "
+                       "single blob in a MBTiles container"))
+    p.add_option("--tile-range", dest="tile_range", metavar="TMINX,TMINY,TMAXX,TMAXY",
+                 help=("Only generate the base tiles of this range (TMS numbering), and the "
+                       "overview tiles that only depend on them"))
+    p.add_option("--shard", dest="shard", metavar="K/N",
+                 help=("Only generate the base tiles of part K (0 to N-1) of N parts with the "
+                       "same number of tiles, and the overview tiles that only depend on them"))
+    p.add_option("--overviews-only", dest="overviews_only", action="store_true",
+                 help=("Do not generate the base tiles, only the overview tiles from the existing "
+                       "base tiles"))
+    p.add_option("--profile-report", dest="profile_report", metavar="FILE",
+                 help=("Write the time spent in each stage of the tile generation, per zoom "
+                       "level, and the slowest tiles to FILE as JSON"))
 
     # KML options
     g = OptionGroup(p, "KML (Google Earth) options",
@@ -1204,7 +2753,8 @@ def optparse_init():
     p.set_defaults(verbose=False, profile="mercator", kml=False, url='',
                    webviewer='all', copyright='', resampling='average', resume=False,
                    googlekey='INSERT_YOUR_KEY_HERE', bingkey='INSERT_YOUR_KEY_HERE',
-                   processes=1)
+                   processes=1, exclude_transparent=False, deduplicate=False,
+                   metatile=1, overviews_only=False)
 
     return p
 
@@ -1227,6 +2777,8 @@ def process_args(argv):
 
     if len(args) == 2:
         output_folder = args[1]
+    elif options.container:
+        output_folder = os.path.splitext(os.path.basename(input_file))[0] + '.' + options.container
     else:
         output_folder = os.path.basename(input_file)
 
@@ -1256,9 +2808,45 @@ def options_post_processing(options, input_file, output_folder):
             exit_with_error("'average' resampling algorithm is not available.",
                             "Please use -r 'near' argument or upgrade to newer version of GDAL.")
 
-    elif options.resampling == 'antialias' and not numpy_available:
+    elif options.resampling == 'antialias' and not pil_available:
         exit_with_error("'antialias' resampling algorithm is not available.",
-                        "Install PIL (Python Imaging Library) and numpy.")
+                        "Install PIL (Python Imaging Library).")
+
+    if options.container:
+        if options.container == 'mbtiles' and options.profile != 'mercator':
+            exit_with_error("The MBTiles container is only available with the 'mercator' profile.",
+                            "Use --container=gpkg for the other profiles.")
+        if options.kml:
+            exit_with_error("KML generation is not available with --container.")
+        if options.deduplicate and options.container != 'mbtiles':
+            exit_with_error("--deduplicate is only available with the mbtiles container.")
+
+    if options.metatile < 1:
+        exit_with_error("--metatile must be a positive integer.")
+
+    if options.tile_range and options.shard:
+        exit_with_error("--tile-range and --shard cannot be used together.")
+    if (options.tile_range or options.shard) and options.container:
+        exit_with_error("--tile-range and --shard are not available with --container.")
+    if options.overviews_only and options.container:
+        exit_with_error("--overviews-only is not available with --container.")
+
+    if options.tile_range:
+        try:
+            options.tile_range = tuple(int(v) for v in options.tile_range.split(','))
+        except ValueError:
+            options.tile_range = ()
+        if (len(options.tile_range) != 4 or options.tile_range[0] > options.tile_range[2] or
+                options.tile_range[1] > options.tile_range[3]):
+            exit_with_error("--tile-range must be given as TMINX,TMINY,TMAXX,TMAXY.")
+
+    if options.shard:
+        try:
+            options.shard = tuple(int(v) for v in options.shard.split('/'))
+        except ValueError:
+            options.shard = ()
+        if len(options.shard) != 2 or not 0 <= options.shard[0] < options.shard[1]:
+            exit_with_error("--shard must be given as K/N, with 0 <= K < N.")
 
     try:
         os.path.basename(input_file).encode('ascii')
@@ -1316,11 +2904,92 @@ class TileDetail(object):
         return "TileDetail %s\n%s\n%s\n" % (self.tx, self.ty, self.tz)
 
 
+class MetaTileDetail(object):
+    """
+    Plain object to hold a block of base tiles read from the source at once (--metatile option)
+
+    rx, ry, rxsize, rysize is the source window of the block, read into a bxsize x bysize
+    buffer. positions holds the offset of the query window of each tile in this buffer (None for
+    tiles with nothing to read). bxsize is 0 when the tiles have to be read separately.
+    """
+    tiles = []
+    positions = []
+    rx = 0
+    ry = 0
+    rxsize = 0
+    rysize = 0
+    bxsize = 0
+    bysize = 0
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            if hasattr(self, key):
+                setattr(self, key, kwargs[key])
+
+    def __unicode__(self):
+        return "MetaTileDetail %s\n" % (self.tiles)
+
+    def __str__(self):
+        return "MetaTileDetail %s\n" % (self.tiles)
+
+    def __repr__(self):
+        return "MetaTileDetail %s\n" % (self.tiles)
+
+
+def create_metatile_detail(tile_details):
+    """
+    Merges the query windows of a block of neighbouring base tiles into a single window.
+
+    Each tile fills (part of) a querysize x querysize cell of the metatile buffer. The block can
+    only be read at once if these parts are contiguous, which is the case unless the query
+    windows are shrunk for the tiles at the border of the source, and if the source windows of
+    the tiles are a linear mapping of their buffer windows.
+    """
+    querysize = tile_details[0].querysize
+    left_tx = min(t.tx for t in tile_details)
+    top_ty = max(t.ty for t in tile_details)
+
+    windows = []
+    for t in tile_details:
+        if t.rxsize != 0 and t.rysize != 0 and t.wxsize != 0 and t.wysize != 0:
+            windows.append((t, (t.tx - left_tx) * querysize + t.wx,
+                            (top_ty - t.ty) * querysize + t.wy))
+    if not windows:
+        return MetaTileDetail(tiles=tile_details, positions=[None] * len(tile_details))
+
+    rx = min(t.rx for t, _, _ in windows)
+    ry = min(t.ry for t, _, _ in windows)
+    rxsize = max(t.rx + t.rxsize for t, _, _ in windows) - rx
+    rysize = max(t.ry + t.rysize for t, _, _ in windows) - ry
+    bx = min(x for _, x, _ in windows)
+    by = min(y for _, _, y in windows)
+    bxsize = max(x + t.wxsize for t, x, _ in windows) - bx
+    bysize = max(y + t.wysize for t, _, y in windows) - by
+
+    # The windows do not overlap: they cover the whole buffer only if they are contiguous
+    if sum(t.wxsize * t.wysize for t, _, _ in windows) != bxsize * bysize:
+        return MetaTileDetail(tiles=tile_details, positions=[None] * len(tile_details))
+
+    # The source window of each tile is rounded separately: a single read only samples the
+    # same pixels if they all map to the buffer with the same scale and offset
+    for t, x, y in windows:
+        if ((t.rx - rx) * bxsize != (x - bx) * rxsize or
+                (t.ry - ry) * bysize != (y - by) * rysize or
+                t.rxsize * bxsize != t.wxsize * rxsize or
+                t.rysize * bysize != t.wysize * rysize):
+            return MetaTileDetail(tiles=tile_details, positions=[None] * len(tile_details))
+
+    positions = dict(((t.tx, t.ty), (x - bx, y - by)) for t, x, y in windows)
+    return MetaTileDetail(
+        tiles=tile_details, positions=[positions.get((t.tx, t.ty)) for t in tile_details],
+        rx=rx, ry=ry, rxsize=rxsize, rysize=rysize, bxsize=bxsize, bysize=bysize)
+
+
 class TileJobInfo(object):
     """
     Plain object to hold tile job configuration for a dataset
     """
-    src_file = ""
+    src_file = ""  # VRT definition of the source, as given to gdal.Open()
     nb_data_bands = 0
     output_file_path = ""
     tile_extension = ""
@@ -1335,6 +3004,8 @@ class TileJobInfo(object):
     ominy = 0
     is_epsg_4326 = False
     options = None
+    container = None
+    shard_ranges = None
 
     def __init__(self, **kwargs):
         for key in kwargs:
@@ -1342,13 +3013,13 @@ class TileJobInfo(object):
                 setattr(self, key, kwargs[key])
 
     def __unicode__(self):
-        return "TileJobInfo %s\n" % (self.src_file)
+        return "TileJobInfo %s\n" % (self.output_file_path)
 
     def __str__(self):
-        return "TileJobInfo %s\n" % (self.src_file)
+        return "TileJobInfo %s\n" % (self.output_file_path)
 
     def __repr__(self):
-        return "TileJobInfo %s\n" % (self.src_file)
+        return "TileJobInfo %s\n" % (self.output_file_path)
 
 
 class Gdal2TilesError(Exception):
@@ -1383,13 +3054,14 @@ class GDAL2Tiles(object):
 
         self.isepsg4326 = None
         self.in_srs_wkt = None
+        self.container = None
 
         # Tile format
         self.tilesize = 256
         self.tiledriver = 'PNG'
         self.tileext = 'png'
-        self.tmp_dir = tempfile.mkdtemp()
-        self.tmp_vrt_filename = os.path.join(self.tmp_dir, str(uuid4()) + '.vrt')
+        # VRT definition of the (warped) input, opened directly by the tile workers
+        self.input_vrt = None
 
         # Should we read bigger window of the input raster and scale it down?
         # Note: Modified later by open_input()
@@ -1529,8 +3201,7 @@ class GDAL2Tiles(object):
         if not self.warped_input_dataset:
             self.warped_input_dataset = input_dataset
 
-        self.warped_input_dataset.GetDriver().CreateCopy(self.tmp_vrt_filename,
-                                                         self.warped_input_dataset)
+        self.input_vrt = vrt_string_of_dataset(self.warped_input_dataset)
 
         # Get alpha band (either directly or from NODATA value)
         self.alphaband = self.warped_input_dataset.GetRasterBand(1).GetMaskBand()
@@ -1541,7 +3212,7 @@ class GDAL2Tiles(object):
         srs4326 = osr.SpatialReference()
         srs4326.ImportFromEPSG(4326)
         if self.out_srs and srs4326.ExportToProj4() == self.out_srs.ExportToProj4():
-            self.kml = True
+            self.kml = not self.options.container
             self.isepsg4326 = True
             if self.options.verbose:
                 print("KML autotest OK!")
@@ -1703,8 +3374,14 @@ class GDAL2Tiles(object):
         """
         Generation of main metadata files and HTML viewers (metadata related to particular
         tiles are generated during the tile processing).
+
+        With a tile container, only the metadata stored in the container is generated.
         """
 
+        if self.options.container:
+            self.generate_container()
+            return
+
         if not os.path.exists(self.output_folder):
             os.makedirs(self.output_folder)
 
@@ -1789,12 +3466,36 @@ class GDAL2Tiles(object):
                             self.options, children
                         ).encode('utf-8'))
 
+    def generate_container(self):
+        """Creation of the tile container, with its metadata, in place of the output folder"""
+
+        if self.options.profile == 'mercator':
+            south, west = self.mercator.MetersToLatLon(self.ominx, self.ominy)
+            north, east = self.mercator.MetersToLatLon(self.omaxx, self.omaxy)
+            south, west = max(-85.05112878, south), max(-180.0, west)
+            north, east = min(85.05112878, north), min(180.0, east)
+            self.swne = (south, west, north, east)
+        else:
+            self.swne = (self.ominy, self.ominx, self.omaxy, self.omaxx)
+
+        output_dir = os.path.dirname(self.output_folder)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        self.container = create_tile_container(self.options.container, self.output_folder,
+                                               self.options.deduplicate)
+        self.container.create(self)
+
     def generate_base_tiles(self):
         """
         Generation of the base tiles (the lowest in the pyramid) directly from the input raster
+
+        Returns the TileJobInfo of the dataset and a generator of the TileDetail of each base tile.
+        The tile details are computed lazily, so that they can be fed to the workers as they are
+        produced without holding them all in memory.
         """
 
-        if not self.options.quiet:
+        if not self.options.quiet and not self.options.overviews_only:
             print("Generating Base Tiles:")
 
         if self.options.verbose:
@@ -1803,103 +3504,12 @@ class GDAL2Tiles(object):
             print("----------------------------------------")
             print('')
 
-        # Set the bounds
-        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
-
-        ds = self.warped_input_dataset
-        tilebands = self.dataBandsCount + 1
-        querysize = self.querysize
-
         if self.options.verbose:
             print("dataBandsCount: ", self.dataBandsCount)
-            print("tilebands: ", tilebands)
-
-        tcount = (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
-        ti = 0
-
-        tile_details = []
-
-        tz = self.tmaxz
-        for ty in range(tmaxy, tminy - 1, -1):
-            for tx in range(tminx, tmaxx + 1):
-
-                ti += 1
-                tilefilename = os.path.join(
-                    self.output_folder, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
-                if self.options.verbose:
-                    print(ti, '/', tcount, tilefilename)
-
-                if self.options.resume and os.path.exists(tilefilename):
-                    if self.options.verbose:
-                        print("Tile generation skipped because of --resume")
-                    continue
-
-                # Create directories for the tile
-                if not os.path.exists(os.path.dirname(tilefilename)):
-                    os.makedirs(os.path.dirname(tilefilename))
-
-                if self.options.profile == 'mercator':
-                    # Tile bounds in EPSG:3857
-                    b = self.mercator.TileBounds(tx, ty, tz)
-                elif self.options.profile == 'geodetic':
-                    b = self.geodetic.TileBounds(tx, ty, tz)
-
-                # Don't scale up by nearest neighbour, better change the querysize
-                # to the native resolution (and return smaller query tile) for scaling
-
-                if self.options.profile in ('mercator', 'geodetic'):
-                    rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1])
-
-                    # Pixel size in the raster covering query geo extent
-                    nativesize = wb[0] + wb[2]
-                    if self.options.verbose:
-                        print("\tNative Extent (querysize", nativesize, "): ", rb, wb)
-
-                    # Tile bounds in raster coordinates for ReadRaster query
-                    rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1], querysize=querysize)
-
-                    rx, ry, rxsize, rysize = rb
-                    wx, wy, wxsize, wysize = wb
-
-                else:     # 'raster' profile:
-
-                    tsize = int(self.tsize[tz])   # tilesize in raster coordinates for actual zoom
-                    xsize = self.warped_input_dataset.RasterXSize     # size of the raster in pixels
-                    ysize = self.warped_input_dataset.RasterYSize
-                    if tz >= self.nativezoom:
-                        querysize = self.tilesize
-
-                    rx = (tx) * tsize
-                    rxsize = 0
-                    if tx == tmaxx:
-                        rxsize = xsize % tsize
-                    if rxsize == 0:
-                        rxsize = tsize
-
-                    rysize = 0
-                    if ty == tmaxy:
-                        rysize = ysize % tsize
-                    if rysize == 0:
-                        rysize = tsize
-                    ry = ysize - (ty * tsize) - rysize
-
-                    wx, wy = 0, 0
-                    wxsize = int(rxsize / float(tsize) * self.tilesize)
-                    wysize = int(rysize / float(tsize) * self.tilesize)
-                    if wysize != self.tilesize:
-                        wy = self.tilesize - wysize
-
-                # Read the source raster if anything is going inside the tile as per the computed
-                # geo_query
-                tile_details.append(
-                    TileDetail(
-                        tx=tx, ty=ty, tz=tz, rx=rx, ry=ry, rxsize=rxsize, rysize=rysize, wx=wx,
-                        wy=wy, wxsize=wxsize, wysize=wysize, querysize=querysize,
-                    )
-                )
+            print("tilebands: ", self.dataBandsCount + 1)
 
         conf = TileJobInfo(
-            src_file=self.tmp_vrt_filename,
+            src_file=self.input_vrt,
             nb_data_bands=self.dataBandsCount,
             output_file_path=self.output_folder,
             tile_extension=self.tileext,
@@ -1914,9 +3524,147 @@ class GDAL2Tiles(object):
             ominy=self.ominy,
             is_epsg_4326=self.isepsg4326,
             options=self.options,
+            container=self.container,
+            shard_ranges=self.shard_ranges(),
         )
 
-        return conf, tile_details
+        if not self.container and not self.options.overviews_only:
+            for tminx, _, tmaxx, _ in self.base_tile_ranges(conf):
+                create_tile_columns(self.output_folder, self.tmaxz, tminx, tmaxx)
+
+        if self.options.metatile > 1:
+            return conf, self.base_metatile_details(self.base_tile_ranges(conf))
+        return conf, self.base_tile_details(self.base_tile_ranges(conf))
+
+    def shard_ranges(self):
+        """
+        Returns the base tile ranges the run is restricted to by --tile-range or --shard, or None
+        """
+        if self.options.tile_range:
+            tile_range = intersect_tile_ranges(self.options.tile_range, self.tminmax[self.tmaxz])
+            if tile_range is None:
+                exit_with_error("--tile-range does not intersect the base tiles %d,%d,%d,%d." %
+                                tuple(self.tminmax[self.tmaxz]))
+            return [tile_range]
+        if self.options.shard:
+            shard, nb_shards = self.options.shard
+            return shard_tile_ranges(self.tminmax[self.tmaxz], shard, nb_shards)
+        return None
+
+    def base_tile_ranges(self, tile_job_info):
+        """Returns the ranges of the base tiles to generate"""
+        if self.options.overviews_only:
+            return []
+        if tile_job_info.shard_ranges is not None:
+            return tile_job_info.shard_ranges
+        return [self.tminmax[self.tmaxz]]
+
+    def base_tile_details(self, tile_ranges):
+        """Generator of the TileDetail of each base tile, in the order they should be processed"""
+
+        tcount = sum(tile_range_size(r) for r in tile_ranges)
+        ti = 0
+
+        tz = self.tmaxz
+        for tminx, tminy, tmaxx, tmaxy in tile_ranges:
+            for ty in range(tmaxy, tminy - 1, -1):
+                for tx in range(tminx, tmaxx + 1):
+
+                    ti += 1
+                    if self.options.verbose:
+                        print(ti, '/', tcount, os.path.join(
+                            self.output_folder, str(tz), str(tx), "%s.%s" % (ty, self.tileext)))
+
+                    yield self.base_tile_detail(tx, ty)
+
+    def base_metatile_details(self, tile_ranges):
+        """
+        Generator of the MetaTileDetail of each block of metatile x metatile base tiles, in the
+        order they should be processed
+        """
+
+        n = self.options.metatile
+
+        for tminx, tminy, tmaxx, tmaxy in tile_ranges:
+            for mty in range(tmaxy // n, tminy // n - 1, -1):
+                for mtx in range(tminx // n, tmaxx // n + 1):
+                    tile_details = []
+                    for ty in range(min(tmaxy, mty * n + n - 1), max(tminy, mty * n) - 1, -1):
+                        for tx in range(max(tminx, mtx * n), min(tmaxx, mtx * n + n - 1) + 1):
+                            if self.options.verbose:
+                                print(os.path.join(self.output_folder, str(self.tmaxz), str(tx),
+                                                   "%s.%s" % (ty, self.tileext)))
+                            tile_details.append(self.base_tile_detail(tx, ty))
+
+                    yield create_metatile_detail(tile_details)
+
+    def base_tile_detail(self, tx, ty):
+        """Returns the TileDetail of the base tile tx, ty"""
+
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+
+        ds = self.warped_input_dataset
+        querysize = self.querysize
+
+        tz = self.tmaxz
+
+        if self.options.profile == 'mercator':
+            # Tile bounds in EPSG:3857
+            b = self.mercator.TileBounds(tx, ty, tz)
+        elif self.options.profile == 'geodetic':
+            b = self.geodetic.TileBounds(tx, ty, tz)
+
+        # Don't scale up by nearest neighbour, better change the querysize
+        # to the native resolution (and return smaller query tile) for scaling
+
+        if self.options.profile in ('mercator', 'geodetic'):
+            rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1])
+
+            # Pixel size in the raster covering query geo extent
+            nativesize = wb[0] + wb[2]
+            if self.options.verbose:
+                print("\tNative Extent (querysize", nativesize, "): ", rb, wb)
+
+            # Tile bounds in raster coordinates for ReadRaster query
+            rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1], querysize=querysize)
+
+            rx, ry, rxsize, rysize = rb
+            wx, wy, wxsize, wysize = wb
+
+        else:     # 'raster' profile:
+
+            tsize = int(self.tsize[tz])   # tilesize in raster coordinates for actual zoom
+            xsize = self.warped_input_dataset.RasterXSize     # size of the raster in pixels
+            ysize = self.warped_input_dataset.RasterYSize
+            if tz >= self.nativezoom:
+                querysize = self.tilesize
+
+            rx = (tx) * tsize
+            rxsize = 0
+            if tx == tmaxx:
+                rxsize = xsize % tsize
+            if rxsize == 0:
+                rxsize = tsize
+
+            rysize = 0
+            if ty == tmaxy:
+                rysize = ysize % tsize
+            if rysize == 0:
+                rysize = tsize
+            ry = ysize - (ty * tsize) - rysize
+
+            wx, wy = 0, 0
+            wxsize = int(rxsize / float(tsize) * self.tilesize)
+            wysize = int(rysize / float(tsize) * self.tilesize)
+            if wysize != self.tilesize:
+                wy = self.tilesize - wysize
+
+        # Read the source raster if anything is going inside the tile as per the computed
+        # geo_query
+        return TileDetail(
+            tx=tx, ty=ty, tz=tz, rx=rx, ry=ry, rxsize=rxsize, rysize=rysize, wx=wx,
+            wy=wy, wxsize=wxsize, wysize=wysize, querysize=querysize,
+        )
 
     def geo_query(self, ds, ulx, uly, lrx, lry, querysize=0):
         """
@@ -2763,28 +4511,12 @@ class GDAL2Tiles(object):
         return s
 
 
-def worker_tile_details(input_file, output_folder, options, send_pipe=None):
-    try:
-        gdal2tiles = GDAL2Tiles(input_file, output_folder, options)
-        gdal2tiles.open_input()
-        gdal2tiles.generate_metadata()
-        tile_job_info, tile_details = gdal2tiles.generate_base_tiles()
-        return_data = (tile_job_info, tile_details)
-        if send_pipe:
-            send_pipe.send(return_data)
-
-        return return_data
-    except Exception as e:
-        print("worker_tile_details failed ", str(e))
-
-
-def progress_printer_thread(queue, nb_jobs):
-    pb = ProgressBar(nb_jobs)
-    pb.start()
-    for _ in range(nb_jobs):
-        queue.get()
-        pb.log_progress()
-        queue.task_done()
+def worker_tile_details(input_file, output_folder, options):
+    gdal2tiles = GDAL2Tiles(input_file, output_folder, options)
+    gdal2tiles.open_input()
+    gdal2tiles.generate_metadata()
+    tile_job_info, tile_details = gdal2tiles.generate_base_tiles()
+    return tile_job_info, tile_details
 
 
 class ProgressBar(object):
@@ -2853,73 +4585,148 @@ def get_tile_swne(tile_job_info, options):
     return tile_swne
 
 
+class PhaseTimer(object):
+    """Wall-clock times of the phases of a run, for the --profile-report option"""
+
+    def __init__(self, options):
+        if options.profile_report:
+            # Logs left by an interrupted run
+            for filename in profile_log_files(options.profile_report):
+                os.unlink(filename)
+        self.times = {}
+        self.start = self.last = default_timer()
+
+    def end_phase(self, phase):
+        """Records the time since the end of the previous phase as the time of phase"""
+        now = default_timer()
+        self.times[phase] = now - self.last
+        self.last = now
+
+    def phase_times(self):
+        times = dict(self.times)
+        times['total'] = self.last - self.start
+        return times
+
+
 def single_threaded_tiling(input_file, output_folder, options):
     """
     Keep a single threaded version that stays clear of multiprocessing, for platforms that would not
     support it
     """
+    phase_timer = PhaseTimer(options)
+
     if options.verbose:
         print("Begin tiles details calc")
     conf, tile_details = worker_tile_details(input_file, output_folder, options)
 
     if options.verbose:
         print("Tiles details calc complete.")
+    phase_timer.end_phase('setup')
 
-    if not options.verbose and not options.quiet:
-        progress_bar = ProgressBar(len(tile_details))
+    manifest = None
+    if not conf.container:
+        manifest = TileManifest(output_folder, conf.tminmax, conf.tminz, conf.tmaxz)
+        manifest.create(options.resume, shared=conf.shard_ranges is not None)
+
+    init_tile_worker(conf, manifest=manifest)
+    tile_writer = _tile_worker_handles.get('tile_writer')
+
+    progress_bar = None
+    nb_tiles = count_base_tiles(conf)
+    if nb_tiles and not options.verbose and not options.quiet:
+        progress_bar = ProgressBar(nb_tiles)
         progress_bar.start()
 
+    create_base = create_base_metatile if options.metatile > 1 else create_base_tile
     for tile_detail in tile_details:
-        create_base_tile(conf, tile_detail)
+        nb_tiles_done = create_base(conf, tile_detail)
+
+        if progress_bar:
+            progress_bar.log_progress(nb_tiles_done)
+    phase_timer.end_phase('base_tiles')
 
-        if not options.verbose and not options.quiet:
-            progress_bar.log_progress()
+    create_overview_tiles(conf, output_folder, options, tile_writer=tile_writer)
+    phase_timer.end_phase('overview_tiles')
 
-    create_overview_tiles(conf, output_folder, options)
+    if tile_writer:
+        tile_writer.close()
+    # The manifest of a shard is kept for the --overviews-only run over the merged shards
+    if manifest and conf.shard_ranges is None:
+        manifest.remove()
+    release_tile_worker_handles()
 
-    shutil.rmtree(os.path.dirname(conf.src_file))
+    if options.profile_report:
+        write_profile_report(options.profile_report, phase_timer.phase_times())
 
 
 def multi_threaded_tiling(input_file, output_folder, options):
     nb_processes = options.nb_processes or 1
-    (conf_receiver, conf_sender) = Pipe(False)
+    phase_timer = PhaseTimer(options)
 
     if options.verbose:
         print("Begin tiles details calc")
-    p = Process(target=worker_tile_details,
-                args=[input_file, output_folder, options],
-                kwargs={"send_pipe": conf_sender})
-    p.start()
-    # Make sure to consume the queue before joining. If the payload is too big, it won't be put in
-    # one go in the queue and therefore the sending process will never finish, waiting for space in
-    # the queue to send data
-    conf, tile_details = conf_receiver.recv()
-    p.join()
+    # The tile details are generated lazily in this process, while the pool consumes them
+    conf, tile_details = worker_tile_details(input_file, output_folder, options)
+    nb_tiles = count_base_tiles(conf)
     if options.verbose:
         print("Tiles details calc complete.")
-    # Have to create the Queue through a multiprocessing.Manager to get a Queue Proxy,
-    # otherwise you can't pass it as a param in the method invoked by the pool...
-    manager = Manager()
-    queue = manager.Queue()
-    pool = Pool(processes=nb_processes)
+    phase_timer.end_phase('setup')
+    # With a tile container, the encoded tiles are sent to a single writer process
+    tile_writer = None
+    tile_queue = None
+    if conf.container:
+        tile_writer = TileWriterProcess(conf.container)
+        tile_writer.start()
+        tile_queue = tile_writer.tile_queue
+
+    # With a tile tree, the workers record the tiles they complete in the manifest
+    manifest = None
+    if not conf.container:
+        manifest = TileManifest(output_folder, conf.tminmax, conf.tminz, conf.tmaxz)
+        manifest.create(options.resume, shared=conf.shard_ranges is not None)
+
+    # Each worker opens the source dataset and the drivers once, in init_tile_worker()
+    pool = Pool(processes=nb_processes, initializer=init_tile_worker,
+                initargs=(conf, tile_queue, manifest))
     # TODO: gbataille - check the confs for which each element is an array... one useless level?
     # TODO: gbataille - assign an ID to each job for print in verbose mode "ReadRaster Extent ..."
-    # TODO: gbataille - check memory footprint and time on big image. are they opened x times
-    for tile_detail in tile_details:
-        pool.apply_async(create_base_tile, (conf, tile_detail), {"queue": queue})
 
-    if not options.verbose and not options.quiet:
-        p = Process(target=progress_printer_thread, args=[queue, len(tile_details)])
-        p.start()
+    progress_bar = None
+    if nb_tiles and not options.verbose and not options.quiet:
+        progress_bar = ProgressBar(nb_tiles)
+        progress_bar.start()
+
+    # imap_unordered() pulls the tile details from the generator as the workers need them, in
+    # chunks, so that tiling starts right away and memory does not grow with the number of tiles.
+    # The results (numbers of tiles done) come back by chunk too, and feed the progress bar.
+    if options.metatile > 1:
+        create_base = create_base_metatile
+        nb_jobs = nb_tiles // (options.metatile * options.metatile)
+    else:
+        create_base = create_base_tile
+        nb_jobs = nb_tiles
+    chunksize = max(1, min(128, nb_jobs // nb_processes))
+    for nb_tiles_done in pool.imap_unordered(partial(create_base, conf), tile_details,
+                                             chunksize=chunksize):
+        if progress_bar:
+            progress_bar.log_progress(nb_tiles_done)
+    phase_timer.end_phase('base_tiles')
+
+    create_overview_tiles(conf, output_folder, options, pool=pool, tile_writer=tile_writer)
+    phase_timer.end_phase('overview_tiles')
 
     pool.close()
-    pool.join()     # Jobs finished
-    if not options.verbose and not options.quiet:
-        p.join()        # Traces done
+    # The workers flush their TileProfiler logs when they exit
+    pool.join()
 
-    create_overview_tiles(conf, output_folder, options)
+    if tile_writer:
+        tile_writer.close()
+    # The manifest of a shard is kept for the --overviews-only run over the merged shards
+    if manifest and conf.shard_ranges is None:
+        manifest.remove()
 
-    shutil.rmtree(os.path.dirname(conf.src_file))
+    if options.profile_report:
+        write_profile_report(options.profile_report, phase_timer.phase_times())
 
 
 def main():
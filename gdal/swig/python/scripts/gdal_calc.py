@@ -43,16 +43,25 @@
 # gdal_calc.py -A input.tif --outfile=result.tif --calc="A*(A>0)" --NoDataValue=0
 ################################################################
 
+import collections
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser, Values
 import os
 import os.path
 import sys
+import threading
+from xml.sax.saxutils import escape
 
 import numpy
 
 from osgeo import gdal
 from osgeo import gdalnumeric
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 
 # create alphabetic list for storing input layers
 AlphaList = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M",
@@ -61,6 +70,12 @@ AlphaList = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M",
 # set up some default nodatavalues for each datatype
 DefaultNDVLookup = {'Byte': 255, 'UInt16': 65535, 'Int16': -32767, 'UInt32': 4294967293, 'Int32': -2147483647, 'Float32': 3.402823466E+38, 'Float64': 1.7976931348623158E+308}
 
+# engines available to evaluate the calculation
+Engines = ['numpy', 'numexpr']
+
+# default memory budget in megabytes for the windows being processed
+DefaultMemoryBudget = 16
+
 
 def DoesDriverHandleExtension(drv, ext):
     exts = drv.GetMetadataItem(gdal.DMD_EXTENSIONS)
@@ -110,6 +125,150 @@ def GetOutputDriverFor(filename):
         print("Several drivers matching %s extension. Using %s" % (ext, drv_list[0]))
     return drv_list[0]
 
+
+def GetPerOutputList(value, count, name, single_value_allowed=True):
+    """ Return a list of count values, one per output file, from either a list of them
+    or a single value applying to all the output files. """
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    if len(value) == 1 and single_value_allowed:
+        return list(value) * count
+    if len(value) != count:
+        raise Exception("Error! %d %s values given for %d output files." % (len(value), name, count))
+    return list(value)
+
+
+# Python pixel function of the bands of VRT outputs, evaluating the calculation
+# on the arrays of the sources when the band is read
+VRTPixelFunctionCode = """
+import numpy
+from numpy import *
+
+def calc(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+%(inputs)s
+    _result = numpy.asarray(%(calc)s)
+    # convert like GDAL does when writing to a band: round and clamp to integer types
+    if out_ar.dtype.kind in 'iu':
+        if _result.dtype.kind == 'f':
+            _result = numpy.floor(_result + 0.5)
+        _info = numpy.iinfo(out_ar.dtype)
+        _result = numpy.clip(_result, _info.min, _info.max)
+    out_ar[:] = _result
+    _nodata = numpy.zeros(out_ar.shape, dtype=bool)
+%(nodata)s
+    out_ar[_nodata] = float(%(out_ndv)r)
+"""
+
+
+def GetCalcVRT(filename, calc, files, filenames, bands, alpha_list, ndvs, allBandsIndex, allBandsCount,
+               transfer_type, out_type, out_ndv):
+    """ Return the XML of a VRT whose bands derive from the input files with a Python
+    pixel function evaluating calc. """
+    inputs = ''.join(['    %s = in_ar[%d]\n' % (alpha, i) for i, alpha in enumerate(alpha_list)])
+    nodata = ''.join(['    _nodata |= (%s == float(%r))\n' % (alpha, repr(float(ndv)))
+                      for alpha, ndv in zip(alpha_list, ndvs) if ndv is not None])
+    code = VRTPixelFunctionCode % {'inputs': inputs.rstrip('\n'), 'calc': calc,
+                                   'nodata': nodata.rstrip('\n') or '    pass', 'out_ndv': repr(float(out_ndv))}
+
+    vrt_xml = """<VRTDataset rasterXSize="%d" rasterYSize="%d">\n""" % (files[0].RasterXSize, files[0].RasterYSize)
+    if files[0].GetProjection():
+        vrt_xml += """  <SRS>%s</SRS>\n""" % escape(files[0].GetProjection())
+    vrt_xml += """  <GeoTransform>%s</GeoTransform>\n""" % ', '.join([repr(x) for x in files[0].GetGeoTransform()])
+
+    for bandNo in range(1, allBandsCount + 1):
+        vrt_xml += """  <VRTRasterBand dataType="%s" band="%d" subClass="VRTDerivedRasterBand">
+    <NoDataValue>%r</NoDataValue>
+    <PixelFunctionType>calc</PixelFunctionType>
+    <PixelFunctionLanguage>Python</PixelFunctionLanguage>
+    <PixelFunctionCode><![CDATA[%s]]></PixelFunctionCode>
+    <SourceTransferType>%s</SourceTransferType>\n""" % (out_type, bandNo, float(out_ndv), code, transfer_type)
+
+        for i, name in enumerate(filenames):
+            # only plain local paths are made relative to the VRT, not virtual
+            # file systems or subdataset names such as NETCDF:"f.nc":var
+            relative = '0'
+            if not os.path.isabs(name) and not name.startswith('/vsi') and ':' not in name and \
+                    not filename.startswith('/vsi') and os.path.exists(name):
+                relative = '1'
+                name = os.path.relpath(name, os.path.dirname(filename))
+            if allBandsIndex is not None and allBandsIndex == i:
+                band = bandNo
+            else:
+                band = bands[i]
+            vrt_xml += """    <SimpleSource>
+      <SourceFilename relativeToVRT="%s">%s</SourceFilename>
+      <SourceBand>%d</SourceBand>
+    </SimpleSource>\n""" % (relative, escape(name), band)
+
+        vrt_xml += """  </VRTRasterBand>\n"""
+
+    vrt_xml += """</VRTDataset>\n"""
+    return vrt_xml
+
+
+def GetCodeNames(code):
+    """ Return the names referenced by a compiled expression, including the ones of
+    nested code objects such as comprehensions. """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names.update(GetCodeNames(const))
+    return names
+
+
+def GetBandNumericType(band):
+    """ Return the numpy type BandReadAsArray() uses for the values of a band. """
+    typecode = gdalnumeric.GDALTypeCodeToNumericTypeCode(band.DataType)
+    if typecode is None:
+        return numpy.float32
+    if band.DataType == gdal.GDT_Byte and band.GetMetadataItem('PIXELTYPE', 'IMAGE_STRUCTURE') == 'SIGNEDBYTE':
+        return numpy.int8
+    return typecode
+
+
+def CanHoldValue(dtype, value):
+    """ Return whether value can be stored exactly in an array of type dtype. """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in 'iu':
+        info = numpy.iinfo(dtype)
+        return float(value).is_integer() and info.min <= value <= info.max
+    if dtype.kind in 'fc':
+        with numpy.errstate(over='ignore'):
+            return numpy.isnan(value) or dtype.type(value) == value
+    return False
+
+
+def GetChunkWindows(xsize, ysize, blockxsize, blockysize, maxpixels):
+    """ Return the (xoff, yoff, xsize, ysize) windows covering a raster in row-major
+    order. Whole rows of blocks are grouped while they fit within maxpixels, otherwise
+    a row of blocks is split into runs of whole blocks. """
+    blockxsize = max(1, min(blockxsize, xsize))
+    blockysize = max(1, min(blockysize, ysize))
+    if xsize * blockysize <= maxpixels:
+        winxsize = xsize
+        winysize = (maxpixels // (xsize * blockysize)) * blockysize
+    else:
+        winxsize = max(1, maxpixels // (blockxsize * blockysize)) * blockxsize
+        winysize = blockysize
+
+    windows = []
+    for yoff in range(0, ysize, winysize):
+        for xoff in range(0, xsize, winxsize):
+            windows.append((xoff, yoff, min(winxsize, xsize - xoff), min(winysize, ysize - yoff)))
+    return windows
+
+
+def ImapBounded(pool, func, iterable, maxpending):
+    """ Like pool.imap(), but with at most maxpending tasks submitted ahead of the
+    result being consumed, so that the memory held by pending results stays bounded. """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= maxpending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
 ################################################################
 
 
@@ -119,17 +278,51 @@ def doit(opts, args):
     if opts.debug:
         print("gdal_calc.py starting calculation %s" % (opts.calc))
 
-    # set up global namespace for eval with all functions of gdalnumeric
-    global_namespace = dict([(key, getattr(gdalnumeric, key))
-                             for key in dir(gdalnumeric) if not key.startswith('__')])
-
     if not opts.calc:
         raise Exception("No calculation provided.")
     elif not opts.outF:
         raise Exception("No output file provided.")
 
+    # one calculation per output file, each output having its own type and
+    # nodata value
+    myOutFiles = opts.outF
+    if not isinstance(myOutFiles, (list, tuple)):
+        myOutFiles = [myOutFiles]
+    nOutputs = len(myOutFiles)
+    myCalcs = GetPerOutputList(opts.calc, nOutputs, 'calculation', single_value_allowed=False)
+    myOutTypeOptions = GetPerOutputList(opts.type, nOutputs, 'type')
+    myOutNDVOptions = GetPerOutputList(opts.NoDataValue, nOutputs, 'NoDataValue')
+
+    # pick the engine evaluating the calculation
+    myEngine = opts.engine
+    if myEngine is None:
+        myEngine = 'numpy'
+    if myEngine not in Engines:
+        raise Exception("Error! Unknown engine %s, must be one of %s." % (myEngine, Engines))
+    if myEngine == 'numexpr' and numexpr is None:
+        print("numexpr is not available, using the numpy engine")
+        myEngine = 'numpy'
+
+    # compile the calculations once, and set up global namespace for eval with
+    # the functions of gdalnumeric they refer to
+    myCodes = [None] * nOutputs
+    global_namespace = {}
+    if myEngine == 'numpy':
+        for j, myCalc in enumerate(myCalcs):
+            try:
+                myCodes[j] = compile(myCalc, '<calc>', 'eval')
+            except SyntaxError:
+                print("compilation of calculation %s failed" % (myCalc))
+                raise
+            global_namespace.update([(key, getattr(gdalnumeric, key))
+                                     for key in GetCodeNames(myCodes[j])
+                                     if not key.startswith('__') and hasattr(gdalnumeric, key)])
+
+    # guess the format of each output file from its extension
     if opts.format is None:
-        opts.format = GetOutputDriverFor(opts.outF)
+        myOutFormats = [GetOutputDriverFor(myOutF) for myOutF in myOutFiles]
+    else:
+        myOutFormats = [opts.format] * nOutputs
 
     ################################################################
     # fetch details of input layers
@@ -137,6 +330,7 @@ def doit(opts, args):
 
     # set up some lists to store data for each band
     myFiles = []
+    myFileNames = []
     myBands = []
     myAlphaList = []
     myDataType = []
@@ -158,6 +352,7 @@ def doit(opts, args):
                 raise IOError("No such file or directory: '%s'" % myF)
 
             myFiles.append(myFile)
+            myFileNames.append(myF)
             myBands.append(myBand)
             myAlphaList.append(myI)
             myDataType.append(gdal.GetDataTypeName(myFile.GetRasterBand(myBand).DataType))
@@ -187,60 +382,114 @@ def doit(opts, args):
             allBandsIndex = None
 
     ################################################################
-    # set up output file
+    # write virtual output files
     ################################################################
 
-    # open output file exists
-    if os.path.isfile(opts.outF) and not opts.overwrite:
-        if allBandsIndex is not None:
-            raise Exception("Error! allBands option was given but Output file exists, must use --overwrite option!")
-        if opts.debug:
-            print("Output file %s exists - filling in results into file" % (opts.outF))
-        myOut = gdal.Open(opts.outF, gdal.GA_Update)
-        if [myOut.RasterXSize, myOut.RasterYSize] != DimensionsCheck:
-            raise Exception("Error! Output exists, but is the wrong size.  Use the --overwrite option to automatically overwrite the existing file")
-        myOutB = myOut.GetRasterBand(1)
-        myOutNDV = myOutB.GetNoDataValue()
-        myOutType = gdal.GetDataTypeName(myOutB.DataType)
+    # VRT outputs are not computed: their bands derive from the input files
+    # with a Python pixel function evaluating the calculation when read
+    myVRTOutputs = [j for j in range(nOutputs) if myOutFormats[j].upper() == 'VRT']
+    if myVRTOutputs:
+        myTransferType = gdal.GetDataTypeName(max(myDataTypeNum))
+        for j in myVRTOutputs:
+            myOutF, myCalc, myOutTypeOption, myOutNDVOption = myOutFiles[j], myCalcs[j], myOutTypeOptions[j], myOutNDVOptions[j]
+            if os.path.isfile(myOutF) and not opts.overwrite:
+                raise Exception("Error! Output file %s exists, must use --overwrite option!" % (myOutF))
+            if not myOutTypeOption:
+                myOutType = myTransferType
+            else:
+                myOutType = myOutTypeOption
+            if myOutNDVOption is not None:
+                myOutNDV = myOutNDVOption
+            else:
+                myOutNDV = DefaultNDVLookup[myOutType]
 
-    else:
-        # remove existing file and regenerate
-        if os.path.isfile(opts.outF):
-            os.remove(opts.outF)
-        # create a new file
-        if opts.debug:
-            print("Generating output file %s" % (opts.outF))
+            if opts.debug:
+                print("Generating virtual output file %s, type: %s" % (myOutF, myOutType))
+
+            vrt_xml = GetCalcVRT(myOutF, myCalc, myFiles, myFileNames, myBands, myAlphaList, myNDV,
+                                 allBandsIndex, allBandsCount, myTransferType, myOutType, myOutNDV)
+            f = gdal.VSIFOpenL(myOutF, 'wb')
+            if f is None:
+                raise IOError("Cannot create %s" % myOutF)
+            gdal.VSIFWriteL(vrt_xml, 1, len(vrt_xml), f)
+            gdal.VSIFCloseL(f)
+
+        # only compute the other output files
+        myComputed = [j for j in range(nOutputs) if j not in myVRTOutputs]
+        if not myComputed:
+            return
+        myOutFiles = [myOutFiles[j] for j in myComputed]
+        myCalcs = [myCalcs[j] for j in myComputed]
+        myCodes = [myCodes[j] for j in myComputed]
+        myOutTypeOptions = [myOutTypeOptions[j] for j in myComputed]
+        myOutNDVOptions = [myOutNDVOptions[j] for j in myComputed]
+        myOutFormats = [myOutFormats[j] for j in myComputed]
+        nOutputs = len(myComputed)
 
-        # find data type to use
-        if not opts.type:
-            # use the largest type of the input files
-            myOutType = gdal.GetDataTypeName(max(myDataTypeNum))
-        else:
-            myOutType = opts.type
+    ################################################################
+    # set up output files
+    ################################################################
 
-        # create file
-        myOutDrv = gdal.GetDriverByName(opts.format)
-        myOut = myOutDrv.Create(
-            opts.outF, DimensionsCheck[0], DimensionsCheck[1], allBandsCount,
-            gdal.GetDataTypeByName(myOutType), opts.creation_options)
+    myOuts = []
+    myOutNDVs = []
+    myOutTypes = []
+    for myOutF, myOutFormat, myOutTypeOption, myOutNDVOption in zip(myOutFiles, myOutFormats, myOutTypeOptions, myOutNDVOptions):
 
-        # set output geo info based on first input layer
-        myOut.SetGeoTransform(myFiles[0].GetGeoTransform())
-        myOut.SetProjection(myFiles[0].GetProjection())
+        # open output file exists
+        if os.path.isfile(myOutF) and not opts.overwrite:
+            if allBandsIndex is not None:
+                raise Exception("Error! allBands option was given but Output file exists, must use --overwrite option!")
+            if opts.debug:
+                print("Output file %s exists - filling in results into file" % (myOutF))
+            myOut = gdal.Open(myOutF, gdal.GA_Update)
+            if [myOut.RasterXSize, myOut.RasterYSize] != DimensionsCheck:
+                raise Exception("Error! Output exists, but is the wrong size.  Use the --overwrite option to automatically overwrite the existing file")
+            myOutB = myOut.GetRasterBand(1)
+            myOutNDV = myOutB.GetNoDataValue()
+            myOutType = gdal.GetDataTypeName(myOutB.DataType)
 
-        if opts.NoDataValue is not None:
-            myOutNDV = opts.NoDataValue
         else:
-            myOutNDV = DefaultNDVLookup[myOutType]
+            # remove existing file and regenerate
+            if os.path.isfile(myOutF):
+                os.remove(myOutF)
+            # create a new file
+            if opts.debug:
+                print("Generating output file %s" % (myOutF))
 
-        for i in range(1, allBandsCount + 1):
-            myOutB = myOut.GetRasterBand(i)
-            myOutB.SetNoDataValue(myOutNDV)
-            # write to band
-            myOutB = None
+            # find data type to use
+            if not myOutTypeOption:
+                # use the largest type of the input files
+                myOutType = gdal.GetDataTypeName(max(myDataTypeNum))
+            else:
+                myOutType = myOutTypeOption
 
-    if opts.debug:
-        print("output file: %s, dimensions: %s, %s, type: %s" % (opts.outF, myOut.RasterXSize, myOut.RasterYSize, myOutType))
+            # create file
+            myOutDrv = gdal.GetDriverByName(myOutFormat)
+            myOut = myOutDrv.Create(
+                myOutF, DimensionsCheck[0], DimensionsCheck[1], allBandsCount,
+                gdal.GetDataTypeByName(myOutType), opts.creation_options)
+
+            # set output geo info based on first input layer
+            myOut.SetGeoTransform(myFiles[0].GetGeoTransform())
+            myOut.SetProjection(myFiles[0].GetProjection())
+
+            if myOutNDVOption is not None:
+                myOutNDV = myOutNDVOption
+            else:
+                myOutNDV = DefaultNDVLookup[myOutType]
+
+            for i in range(1, allBandsCount + 1):
+                myOutB = myOut.GetRasterBand(i)
+                myOutB.SetNoDataValue(myOutNDV)
+                # write to band
+                myOutB = None
+
+        if opts.debug:
+            print("output file: %s, dimensions: %s, %s, type: %s" % (myOutF, myOut.RasterXSize, myOut.RasterYSize, myOutType))
+
+        myOuts.append(myOut)
+        myOutNDVs.append(myOutNDV)
+        myOutTypes.append(myOutType)
 
     ################################################################
     # find block size to chop grids into bite-sized chunks
@@ -248,113 +497,202 @@ def doit(opts, args):
 
     # use the block size of the first layer to read efficiently
     myBlockSize = myFiles[0].GetRasterBand(myBands[0]).GetBlockSize()
-    # store these numbers in variables that may change later
-    nXValid = myBlockSize[0]
-    nYValid = myBlockSize[1]
-    # find total x and y blocks to be read
-    nXBlocks = (int)((DimensionsCheck[0] + myBlockSize[0] - 1) / myBlockSize[0])
-    nYBlocks = (int)((DimensionsCheck[1] + myBlockSize[1] - 1) / myBlockSize[1])
-    myBufSize = myBlockSize[0] * myBlockSize[1]
 
-    if opts.debug:
-        print("using blocksize %s x %s" % (myBlockSize[0], myBlockSize[1]))
+    # number of threads evaluating windows in parallel
+    if opts.threads is None:
+        nThreads = 1
+    else:
+        nThreads = opts.threads
+    if nThreads < 1:
+        raise Exception("Error! Number of threads must be at least 1.")
+    # windows held in memory at the same time: the ones queued for the threads
+    # and the one being written
+    nWindowsInFlight = 1
+    if nThreads > 1:
+        nWindowsInFlight = nThreads + 2
+
+    # estimate the memory needed per pixel: one buffer per input layer (holding
+    # all the bands of the allBands layer), one result per band of each output
+    # (float64 at worst), a float64 temporary for the calculations and the
+    # nodata masks
+    myPixelBytes = sum([gdal.GetDataTypeSize(t) // 8 for t in myDataTypeNum])
+    if allBandsIndex is not None:
+        myPixelBytes += (allBandsCount - 1) * gdal.GetDataTypeSize(myDataTypeNum[allBandsIndex]) // 8
+    myPixelBytes += nOutputs * allBandsCount * 8 + 8 + 3
+    if opts.memory is None:
+        myMemory = DefaultMemoryBudget
+    else:
+        myMemory = opts.memory
+    if myMemory <= 0:
+        raise Exception("Error! Memory budget must be a positive number of megabytes.")
+    myMaxPixels = int(myMemory * 1024 * 1024 / myPixelBytes / nWindowsInFlight)
 
-    # variables for displaying progress
-    ProgressCt = -1
-    ProgressMk = -1
-    ProgressEnd = nXBlocks * nYBlocks * allBandsCount
+    # group whole blocks into windows, walking the raster row by row
+    myWindows = GetChunkWindows(DimensionsCheck[0], DimensionsCheck[1],
+                                myBlockSize[0], myBlockSize[1], myMaxPixels)
+
+    if opts.debug:
+        print("using blocksize %s x %s, %d windows within %s MB, %d threads" % (myBlockSize[0], myBlockSize[1], len(myWindows), myMemory, nThreads))
 
     ################################################################
-    # start looping through each band in allBandsCount
+    # calculation of one window of data
     ################################################################
 
-    for bandNo in range(1, allBandsCount + 1):
+    # dataset handles of the input layers, and buffers reused from one window to
+    # the next, private to each thread
+    myThreadData = threading.local()
+    myMaxWindowPixels = max([window[2] * window[3] for window in myWindows])
+    myInputTypes = [GetBandNumericType(myFile.GetRasterBand(myBand)) for myFile, myBand in zip(myFiles, myBands)]
+    # the allBands layer is read with all its bands at once in a 3-D buffer
+    myInputBandCounts = [1] * len(myFiles)
+    if allBandsIndex is not None:
+        myInputBandCounts[allBandsIndex] = allBandsCount
+
+    def CalcWindow(window):
+        myX, myY, nXValid, nYValid = window
+        nWindowPixels = nXValid * nYValid
+
+        if not hasattr(myThreadData, 'buffers'):
+            if nThreads > 1:
+                myThreadData.files = [gdal.Open(myF, gdal.GA_ReadOnly) for myF in myFileNames]
+            else:
+                myThreadData.files = myFiles
+            myThreadData.buffers = [numpy.empty(myBandCount * myMaxWindowPixels, dtype=myType)
+                                    for myType, myBandCount in zip(myInputTypes, myInputBandCounts)]
+            myThreadData.masks = [numpy.empty(myMaxWindowPixels, dtype=bool) for i in range(3)]
+        myWindowFiles = myThreadData.files
+
+        # views of the buffers with the shape of this window
+        myBuffers = [myBuffer[:nWindowPixels].reshape(nYValid, nXValid) for myBuffer in myThreadData.buffers]
+        if allBandsIndex is not None:
+            myBuffers[allBandsIndex] = myThreadData.buffers[allBandsIndex][:allBandsCount * nWindowPixels].reshape(allBandsCount, nYValid, nXValid)
+        myCommonNDVs, myBandNDVs, myScratchNDVs = [myMask[:nWindowPixels].reshape(nYValid, nXValid) for myMask in myThreadData.masks]
+
+        # mark where nodata occurs in the layers shared by all output bands
+        hasCommonNDVs = False
+
+        # make local namespace for calculation
+        local_namespace = {}
+
+        # fetch data for each input layer that does not change with the band
+        for i, Alpha in enumerate(myAlphaList):
+            if allBandsIndex is not None and allBandsIndex == i:
+                continue
+
+            myval = gdalnumeric.BandReadAsArray(myWindowFiles[i].GetRasterBand(myBands[i]),
+                                                xoff=myX, yoff=myY,
+                                                win_xsize=nXValid, win_ysize=nYValid,
+                                                buf_obj=myBuffers[i])
+
+            # fill in nodata values
+            if myNDV[i] is not None:
+                if hasCommonNDVs:
+                    numpy.equal(myval, myNDV[i], out=myScratchNDVs)
+                    numpy.logical_or(myCommonNDVs, myScratchNDVs, out=myCommonNDVs)
+                else:
+                    numpy.equal(myval, myNDV[i], out=myCommonNDVs)
+                    hasCommonNDVs = True
+
+            # add an array of values for this window to the eval namespace
+            local_namespace[Alpha] = myval
+            myval = None
+
+        # read all the bands of the allBands layer in one go, so that
+        # pixel-interleaved files are decoded once and not once per band
+        if allBandsIndex is not None:
+            gdalnumeric.DatasetReadAsArray(myWindowFiles[allBandsIndex], myX, myY, nXValid, nYValid,
+                                           buf_obj=myBuffers[allBandsIndex])
+
+        # calculate each band in allBandsCount, for each output
+        myResults = [[] for j in range(nOutputs)]
+        for bandNo in range(1, allBandsCount + 1):
+            myNDVs = None
+            if hasCommonNDVs:
+                myNDVs = myCommonNDVs
+
+            # populate the lettered array of the allBands layer for this band
+            if allBandsIndex is not None:
+                myval = myBuffers[allBandsIndex][bandNo - 1]
+                if myNDV[allBandsIndex] is not None:
+                    numpy.equal(myval, myNDV[allBandsIndex], out=myBandNDVs)
+                    if hasCommonNDVs:
+                        numpy.logical_or(myBandNDVs, myCommonNDVs, out=myBandNDVs)
+                    myNDVs = myBandNDVs
+                local_namespace[myAlphaList[allBandsIndex]] = myval
+                myval = None
+
+            # try the calculations on the array windows
+            for j in range(nOutputs):
+                try:
+                    if myEngine == 'numexpr':
+                        myResult = numexpr.evaluate(myCalcs[j], local_dict=local_namespace, global_dict={})
+                    else:
+                        myResult = eval(myCodes[j], global_namespace, local_namespace)
+                except:
+                    print("evaluation of calculation %s failed" % (myCalcs[j]))
+                    raise
 
-        ################################################################
-        # start looping through blocks of data
-        ################################################################
+                # the result must have the shape of the window, be able to hold the
+                # nodata value, and not share memory with the buffers read again for
+                # the next band or window
+                myResult = numpy.asarray(myResult)
+                myResultType = myResult.dtype
+                if myNDVs is not None and not CanHoldValue(myResultType, myOutNDVs[j]):
+                    if CanHoldValue(numpy.int64, myOutNDVs[j]):
+                        myResultType = numpy.result_type(myResultType, numpy.int64)
+                    else:
+                        myResultType = numpy.result_type(myResultType, numpy.float64)
+                if myResult.shape != (nYValid, nXValid) or myResult.dtype != myResultType or \
+                   not myResult.flags.writeable or \
+                   any([numpy.may_share_memory(myResult, myBuffer) for myBuffer in myBuffers]):
+                    myFullResult = numpy.empty((nYValid, nXValid), dtype=myResultType)
+                    myFullResult[...] = myResult
+                    myResult = myFullResult
+
+                # Propagate nodata values in place
+                if myNDVs is not None:
+                    numpy.putmask(myResult, myNDVs, myOutNDVs[j])
 
-        # loop through X-lines
-        for X in range(0, nXBlocks):
+                myResults[j].append(myResult)
 
-            # in the rare (impossible?) case that the blocks don't fit perfectly
-            # change the block size of the final piece
-            if X == nXBlocks - 1:
-                nXValid = DimensionsCheck[0] - X * myBlockSize[0]
-                myBufSize = nXValid * nYValid
+        return window, myResults
 
-            # find X offset
-            myX = X * myBlockSize[0]
+    ################################################################
+    # start looping through windows of data
+    ################################################################
+
+    # windows are evaluated by a pool of threads, and written in order by
+    # this thread only
+    myPool = None
+    if nThreads > 1:
+        myPool = ThreadPool(nThreads)
+        myCalculatedWindows = ImapBounded(myPool, CalcWindow, myWindows, nThreads + 1)
+    else:
+        myCalculatedWindows = (CalcWindow(window) for window in myWindows)
 
-            # reset buffer size for start of Y loop
-            nYValid = myBlockSize[1]
-            myBufSize = nXValid * nYValid
+    # variables for displaying progress
+    ProgressCt = -1
+    ProgressMk = -1
+    ProgressEnd = len(myWindows) * allBandsCount
 
-            # loop through Y lines
-            for Y in range(0, nYBlocks):
+    try:
+        for (myX, myY, nXValid, nYValid), myResults in myCalculatedWindows:
+            for bandNo in range(1, allBandsCount + 1):
                 ProgressCt += 1
                 if 10 * ProgressCt / ProgressEnd % 10 != ProgressMk and not opts.quiet:
                     ProgressMk = 10 * ProgressCt / ProgressEnd % 10
-                    from sys import version_info
-                    if version_info >= (3, 0, 0):
-                        exec('print("%d.." % (10*ProgressMk), end=" ")')
-                    else:
-                        exec('print 10*ProgressMk, "..",')
-
-                # change the block size of the final piece
-                if Y == nYBlocks - 1:
-                    nYValid = DimensionsCheck[1] - Y * myBlockSize[1]
-                    myBufSize = nXValid * nYValid
-
-                # find Y offset
-                myY = Y * myBlockSize[1]
-
-                # create empty buffer to mark where nodata occurs
-                myNDVs = None
-
-                # make local namespace for calculation
-                local_namespace = {}
-
-                # fetch data for each input layer
-                for i, Alpha in enumerate(myAlphaList):
-
-                    # populate lettered arrays with values
-                    if allBandsIndex is not None and allBandsIndex == i:
-                        myBandNo = bandNo
-                    else:
-                        myBandNo = myBands[i]
-                    myval = gdalnumeric.BandReadAsArray(myFiles[i].GetRasterBand(myBandNo),
-                                                        xoff=myX, yoff=myY,
-                                                        win_xsize=nXValid, win_ysize=nYValid)
-
-                    # fill in nodata values
-                    if myNDV[i] is not None:
-                        if myNDVs is None:
-                            myNDVs = numpy.zeros(myBufSize)
-                            myNDVs.shape = (nYValid, nXValid)
-                        myNDVs = 1 * numpy.logical_or(myNDVs == 1, myval == myNDV[i])
-
-                    # add an array of values for this block to the eval namespace
-                    local_namespace[Alpha] = myval
-                    myval = None
-
-                # try the calculation on the array blocks
-                try:
-                    myResult = eval(opts.calc, global_namespace, local_namespace)
-                except:
-                    print("evaluation of calculation %s failed" % (opts.calc))
-                    raise
-
-                # Propagate nodata values (set nodata cells to zero
-                # then add nodata value to these cells).
-                if myNDVs is not None:
-                    myResult = ((1 * (myNDVs == 0)) * myResult) + (myOutNDV * myNDVs)
-                elif not isinstance(myResult, numpy.ndarray):
-                    myResult = numpy.ones((nYValid, nXValid)) * myResult
-
-                # write data block to the output file
-                myOutB = myOut.GetRasterBand(bandNo)
-                gdalnumeric.BandWriteArray(myOutB, myResult, xoff=myX, yoff=myY)
+                    sys.stdout.write('%d.. ' % (10 * ProgressMk))
+                    sys.stdout.flush()
+
+                # write data window to the output files
+                for j, myOut in enumerate(myOuts):
+                    myOutB = myOut.GetRasterBand(bandNo)
+                    gdalnumeric.BandWriteArray(myOutB, myResults[j][bandNo - 1], xoff=myX, yoff=myY)
+            myResults = None
+    finally:
+        if myPool is not None:
+            myPool.terminate()
+            myPool.join()
 
     if not opts.quiet:
         print("100 - Done")
@@ -362,14 +700,24 @@ def doit(opts, args):
 ################################################################
 
 
-def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_options=None, allBands='', overwrite=False, debug=False, quiet=False, **input_files):
+def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_options=None, allBands='', overwrite=False, debug=False, quiet=False, memory=None, threads=None, engine=None, **input_files):
     """ Perform raster calculations with numpy syntax.
     Use any basic arithmetic supported by numpy arrays such as +-*\ along with logical
     operators such as >. Note that all files must have the same dimensions, but no projection checking is performed.
 
+    Several calculations can be evaluated in one pass over the input files by passing
+    lists for calc and outfile. NoDataValue and type can then also be lists, with one
+    value for each output file.
+
+    With format="VRT", the output files are virtual rasters computing the calculations
+    with a Python pixel function when they are read.
+
     Keyword arguments:
         [A-Z]: input files
         [A_band - Z_band]: band to use for respective input file
+        memory: memory budget in megabytes for the windows being processed (default 16)
+        threads: number of threads evaluating windows in parallel (default 1)
+        engine: engine evaluating the calculation, 'numpy' (default) or 'numexpr'
 
     Examples:
     add two files together:
@@ -380,6 +728,10 @@ def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_optio
 
     set values of zero and below to null:
         Calc(calc="A*(A>0)", A="input.tif", A_Band=2, outfile="result.tif", NoDataValue=0)
+
+    compute two indices with one read of the inputs:
+        Calc(calc=["(A-B)/(A+B)", "(B-C)/(B+C)"], A="nir.tif", B="red.tif", C="green.tif",
+             outfile=["ndvi.tif", "ndwi.tif"], type="Float32")
     """
     opts = Values()
     opts.input_files = input_files
@@ -393,6 +745,9 @@ def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_optio
     opts.overwrite = overwrite
     opts.debug = debug
     opts.quiet = quiet
+    opts.memory = memory
+    opts.threads = threads
+    opts.engine = engine
 
     doit(opts, None)
 
@@ -410,16 +765,16 @@ def main():
     parser = OptionParser(usage)
 
     # define options
-    parser.add_option("--calc", dest="calc", help="calculation in gdalnumeric syntax using +-/* or any numpy array functions (i.e. log10())", metavar="expression")
+    parser.add_option("--calc", dest="calc", action="append", help="calculation in gdalnumeric syntax using +-/* or any numpy array functions (i.e. log10()), repeat it together with --outfile to compute several outputs in one pass", metavar="expression")
     # limit the input file options to the ones in the argument list
     given_args = set([a[1] for a in sys.argv if a[1:2] in AlphaList] + ['A'])
     for myAlpha in given_args:
         parser.add_option("-%s" % myAlpha, action="callback", callback=store_input_file, type=str, help="input gdal raster file, you can use any letter (A-Z)", metavar='filename')
         parser.add_option("--%s_band" % myAlpha, action="callback", callback=store_input_file, type=int, help="number of raster band for file %s (default 1)" % myAlpha, metavar='n')
 
-    parser.add_option("--outfile", dest="outF", help="output file to generate or fill", metavar="filename")
-    parser.add_option("--NoDataValue", dest="NoDataValue", type=float, help="output nodata value (default datatype specific value)", metavar="value")
-    parser.add_option("--type", dest="type", help="output datatype, must be one of %s" % list(DefaultNDVLookup.keys()), metavar="datatype")
+    parser.add_option("--outfile", dest="outF", action="append", help="output file to generate or fill, one for each --calc", metavar="filename")
+    parser.add_option("--NoDataValue", dest="NoDataValue", type=float, action="append", help="output nodata value (default datatype specific value), either once or once for each output", metavar="value")
+    parser.add_option("--type", dest="type", action="append", help="output datatype, must be one of %s, either once or once for each output" % list(DefaultNDVLookup.keys()), metavar="datatype")
     parser.add_option("--format", dest="format", help="GDAL format for output file", metavar="gdal_format")
     parser.add_option(
         "--creation-option", "--co", dest="creation_options", default=[], action="append",
@@ -430,6 +785,9 @@ def main():
     parser.add_option("--overwrite", dest="overwrite", action="store_true", help="overwrite output file if it already exists")
     parser.add_option("--debug", dest="debug", action="store_true", help="print debugging information")
     parser.add_option("--quiet", dest="quiet", action="store_true", help="suppress progress messages")
+    parser.add_option("--memory", dest="memory", type=float, help="memory budget in megabytes for the windows being processed (default %d)" % DefaultMemoryBudget, metavar="MB")
+    parser.add_option("--engine", dest="engine", type="choice", choices=Engines, help="engine evaluating the calculation, one of %s (default numpy)" % Engines, metavar="engine")
+    parser.add_option("--threads", dest="threads", type=int, help="number of threads evaluating windows in parallel (default 1)", metavar="N")
 
     (opts, args) = parser.parse_args()
     if not hasattr(opts, "input_files"):
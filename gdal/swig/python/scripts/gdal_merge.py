@@ -30,9 +30,12 @@
 # building the stack.
 # anssi.pekkarinen@fao.org
 
+import collections
 import math
+from multiprocessing.pool import ThreadPool
 import os.path
 import sys
+import threading
 import time
 
 from osgeo import gdal
@@ -43,6 +46,12 @@ __version__ = '$id$'[5:-1]
 verbose = 0
 quiet = 0
 
+# default memory, in megabytes, used for the window copied at once
+default_max_mem = 64
+
+# maximum number of source files kept open by each thread of -j
+max_open_datasets = 32
+
 
 def DoesDriverHandleExtension(drv, ext):
     exts = drv.GetMetadataItem(gdal.DMD_EXTENSIONS)
@@ -94,42 +103,147 @@ def GetOutputDriverFor(filename):
 
 
 # =============================================================================
+def block_edges(off, size, block_size):
+    """
+    Return the offsets splitting [off, off + size) at the boundaries of
+    blocks of block_size pixels, including off and off + size.
+    """
+    edges = [off]
+    edge = (off // block_size + 1) * block_size
+    while edge < off + size:
+        edges.append(edge)
+        edge = edge + block_size
+    edges.append(off + size)
+    return edges
+
+# =============================================================================
+
+
+def block_aligned_windows(xoff, yoff, xsize, ysize,
+                          block_xsize, block_ysize, max_pixels):
+    """
+    Split a window in windows aligned on the block grid of a raster.
+
+    Whole rows of blocks are grouped while they hold at most max_pixels
+    pixels, otherwise each row of blocks is split in runs of blocks.  At
+    least one block is always in a window.
+
+    Returns a list of (xoff, yoff, xsize, ysize) windows in row-major order.
+    """
+    x_edges = block_edges(xoff, xsize, block_xsize)
+    y_edges = block_edges(yoff, ysize, block_ysize)
+
+    if xsize * block_ysize <= max_pixels:
+        x_step = len(x_edges) - 1
+        y_step = max(1, max_pixels // (xsize * block_ysize))
+    else:
+        x_step = max(1, max_pixels // (block_xsize * block_ysize))
+        y_step = 1
+
+    windows = []
+    for j in range(0, len(y_edges) - 1, y_step):
+        y0 = y_edges[j]
+        y1 = y_edges[min(j + y_step, len(y_edges) - 1)]
+        for i in range(0, len(x_edges) - 1, x_step):
+            x0 = x_edges[i]
+            x1 = x_edges[min(i + x_step, len(x_edges) - 1)]
+            windows.append((x0, y0, x1 - x0, y1 - y0))
+    return windows
+
+# =============================================================================
+
+
+def get_mask_band(s_band):
+    """
+    Return the band masking the invalid pixels of s_band, or None if all
+    pixels are valid.
+    """
+    # Works only in binary mode and doesn't take into account
+    # intermediate transparency values for compositing.
+    if s_band.GetMaskFlags() != gdal.GMF_ALL_VALID:
+        return s_band.GetMaskBand()
+    if s_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
+        return s_band
+    return None
+
+# =============================================================================
+
+
+def source_window(s_xoff, s_yoff, s_xsize, s_ysize,
+                  t_xoff, t_yoff, t_xsize, t_ysize,
+                  tw_xoff, tw_yoff, tw_xsize, tw_ysize):
+    """
+    Return the source window matching the tw_* part of a target window,
+    when the s_* source window is copied into the t_* target window.
+
+    The window is fractional if the source and target resolutions differ.
+    """
+    if s_xsize == t_xsize:
+        sw_xoff = s_xoff + tw_xoff - t_xoff
+        sw_xsize = tw_xsize
+    else:
+        sw_xoff = s_xoff + (tw_xoff - t_xoff) * s_xsize / float(t_xsize)
+        sw_xsize = tw_xsize * s_xsize / float(t_xsize)
+    if s_ysize == t_ysize:
+        sw_yoff = s_yoff + tw_yoff - t_yoff
+        sw_ysize = tw_ysize
+    else:
+        sw_yoff = s_yoff + (tw_yoff - t_yoff) * s_ysize / float(t_ysize)
+        sw_ysize = tw_ysize * s_ysize / float(t_ysize)
+    return (sw_xoff, sw_yoff, sw_xsize, sw_ysize)
+
+# =============================================================================
+
+
 def raster_copy(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                 t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
-                nodata=None):
+                nodata=None, max_mem=None):
 
     if verbose != 0:
         print('Copy %d,%d,%d,%d to %d,%d,%d,%d.'
               % (s_xoff, s_yoff, s_xsize, s_ysize,
                  t_xoff, t_yoff, t_xsize, t_ysize))
 
-    if nodata is not None:
-        return raster_copy_with_nodata(
-            s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
-            t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
-            nodata)
-
-    s_band = s_fh.GetRasterBand(s_band_n)
-    m_band = None
-    # Works only in binary mode and doesn't take into account
-    # intermediate transparency values for compositing.
-    if s_band.GetMaskFlags() != gdal.GMF_ALL_VALID:
-        m_band = s_band.GetMaskBand()
-    elif s_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
-        m_band = s_band
-    if m_band is not None:
-        return raster_copy_with_mask(
-            s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
-            t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
-            m_band)
-
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
-    data = s_band.ReadRaster(s_xoff, s_yoff, s_xsize, s_ysize,
-                             t_xsize, t_ysize, t_band.DataType)
-    t_band.WriteRaster(t_xoff, t_yoff, t_xsize, t_ysize,
-                       data, t_xsize, t_ysize, t_band.DataType)
+    m_band = None
+    if nodata is None:
+        m_band = get_mask_band(s_band)
+
+    # Copy in windows aligned on the blocks of the target band, holding
+    # at most max_mem megabytes of source, mask, target and result data.
+    if max_mem is None:
+        max_mem = default_max_mem
+    pixel_bytes = (gdal.GetDataTypeSize(s_band.DataType) +
+                   2 * gdal.GetDataTypeSize(t_band.DataType)) // 8 + 2
+    max_pixels = int(max_mem * 1024 * 1024 / pixel_bytes)
+    (block_xsize, block_ysize) = t_band.GetBlockSize()
+
+    for (tw_xoff, tw_yoff, tw_xsize, tw_ysize) in block_aligned_windows(
+            t_xoff, t_yoff, t_xsize, t_ysize,
+            block_xsize, block_ysize, max_pixels):
+
+        (sw_xoff, sw_yoff, sw_xsize, sw_ysize) = source_window(
+            s_xoff, s_yoff, s_xsize, s_ysize,
+            t_xoff, t_yoff, t_xsize, t_ysize,
+            tw_xoff, tw_yoff, tw_xsize, tw_ysize)
+
+        if nodata is not None:
+            raster_copy_with_nodata(
+                s_fh, sw_xoff, sw_yoff, sw_xsize, sw_ysize, s_band_n,
+                t_fh, tw_xoff, tw_yoff, tw_xsize, tw_ysize, t_band_n,
+                nodata)
+        elif m_band is not None:
+            raster_copy_with_mask(
+                s_fh, sw_xoff, sw_yoff, sw_xsize, sw_ysize, s_band_n,
+                t_fh, tw_xoff, tw_yoff, tw_xsize, tw_ysize, t_band_n,
+                m_band)
+        else:
+            data = s_band.ReadRaster(sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                     tw_xsize, tw_ysize, t_band.DataType)
+            t_band.WriteRaster(tw_xoff, tw_yoff, tw_xsize, tw_ysize,
+                               data, tw_xsize, tw_ysize, t_band.DataType)
 
     return 0
 
@@ -267,23 +381,16 @@ class file_info(object):
         print('UL:(%f,%f)   LR:(%f,%f)'
               % (self.ulx, self.uly, self.lrx, self.lry))
 
-    def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None):
+    def copy_windows(self, t_fh):
         """
-        Copy this files image into target file.
-
-        This method will compute the overlap area of the file_info objects
-        file, and the target gdal.Dataset object, and copy the image data
-        for the common window area.  It is assumed that the files are in
-        a compatible projection ... no checking or warping is done.  However,
-        if the destination file is a different resolution, or different
-        image pixel type, the appropriate resampling and conversions will
-        be done (using normal GDAL promotion/demotion rules).
+        Compute the overlap area of this file and a target file.
 
         t_fh -- gdal.Dataset object for the file into which some or all
         of this file may be copied.
 
-        Returns 1 on success (or if nothing needs to be copied), and zero one
-        failure.
+        Returns a (sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff,
+        tw_xsize, tw_ysize) tuple of the source and target windows in pixel
+        coordinates, or None if the files do not overlap.
         """
         t_geotransform = t_fh.GetGeoTransform()
         t_ulx = t_geotransform[0]
@@ -303,11 +410,11 @@ class file_info(object):
 
         # do they even intersect?
         if tgw_ulx >= tgw_lrx:
-            return 1
+            return None
         if t_geotransform[5] < 0 and tgw_uly <= tgw_lry:
-            return 1
+            return None
         if t_geotransform[5] > 0 and tgw_uly >= tgw_lry:
-            return 1
+            return None
 
         # compute target window in pixel coordinates.
         tw_xoff = int((tgw_ulx - t_geotransform[0]) / t_geotransform[1] + 0.1)
@@ -318,7 +425,7 @@ class file_info(object):
             - tw_yoff
 
         if tw_xsize < 1 or tw_ysize < 1:
-            return 1
+            return None
 
         # Compute source window in pixel coordinates.
         sw_xoff = int((tgw_ulx - self.geotransform[0]) / self.geotransform[1])
@@ -329,23 +436,316 @@ class file_info(object):
                        self.geotransform[5] + 0.5) - sw_yoff
 
         if sw_xsize < 1 or sw_ysize < 1:
+            return None
+
+        return (sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                tw_xoff, tw_yoff, tw_xsize, tw_ysize)
+
+    def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None,
+                  max_mem=None):
+        """
+        Copy this files image into target file.
+
+        This method will compute the overlap area of the file_info objects
+        file, and the target gdal.Dataset object, and copy the image data
+        for the common window area.  It is assumed that the files are in
+        a compatible projection ... no checking or warping is done.  However,
+        if the destination file is a different resolution, or different
+        image pixel type, the appropriate resampling and conversions will
+        be done (using normal GDAL promotion/demotion rules).
+
+        t_fh -- gdal.Dataset object for the file into which some or all
+        of this file may be copied.
+
+        max_mem -- memory, in megabytes, used for the window copied at once.
+        The overlap area is copied in windows aligned on the blocks of the
+        target band.  Defaults to default_max_mem.
+
+        Returns 1 on success (or if nothing needs to be copied), and zero one
+        failure.
+        """
+        windows = self.copy_windows(t_fh)
+        if windows is None:
             return 1
+        (sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+         tw_xoff, tw_yoff, tw_xsize, tw_ysize) = windows
 
         # Open the source file, and copy the selected region.
         s_fh = gdal.Open(self.filename)
 
         return raster_copy(s_fh, sw_xoff, sw_yoff, sw_xsize, sw_ysize, s_band,
                            t_fh, tw_xoff, tw_yoff, tw_xsize, tw_ysize, t_band,
-                           nodata_arg)
+                           nodata_arg, max_mem)
+
+
+# =============================================================================
+class extent_index(object):
+    """
+    A grid index of rectangles in pixel coordinates of the output file.
+
+    Each rectangle is registered in the cells of a regular grid that it
+    overlaps, so that the rectangles intersecting a window are found by
+    looking at the few cells covered by the window.
+    """
+
+    def __init__(self, cell_xsize, cell_ysize):
+        self.cell_xsize = cell_xsize
+        self.cell_ysize = cell_ysize
+        self.cells = {}
+        self.extents = {}
+
+    def cell_range(self, xoff, yoff, xsize, ysize):
+        return (xoff // self.cell_xsize, yoff // self.cell_ysize,
+                (xoff + xsize - 1) // self.cell_xsize,
+                (yoff + ysize - 1) // self.cell_ysize)
+
+    def insert(self, key, xoff, yoff, xsize, ysize):
+        """
+        Register key for the xoff, yoff, xsize, ysize rectangle.
+        """
+        self.extents[key] = (xoff, yoff, xoff + xsize, yoff + ysize)
+        (cx0, cy0, cx1, cy1) = self.cell_range(xoff, yoff, xsize, ysize)
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                self.cells.setdefault((cx, cy), []).append(key)
 
+    def query(self, xoff, yoff, xsize, ysize):
+        """
+        Return the sorted keys of the rectangles intersecting a window.
+        """
+        keys = set()
+        (cx0, cy0, cx1, cy1) = self.cell_range(xoff, yoff, xsize, ysize)
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                keys.update(self.cells.get((cx, cy), ()))
+
+        result = []
+        for key in sorted(keys):
+            (x0, y0, x1, y1) = self.extents[key]
+            if x0 < xoff + xsize and xoff < x1 and \
+               y0 < yoff + ysize and yoff < y1:
+                result.append(key)
+        return result
 
 # =============================================================================
+
+
+def merge_tiles(t_fh, file_infos, bands, separate=0, nodata_arg=None,
+                init_values=None, jobs=1, max_mem=None):
+    """
+    Merge the source files into the target file tile by tile.
+
+    The target file is split into tiles aligned on its blocks.  For each
+    tile, the overlapping files are found with an extent_index and copied
+    into in-memory buffers in the order of file_infos, so that later files
+    are copied over earlier ones.  Each tile is then written once.  Tiles
+    are merged by a pool of jobs threads, and written in order by the
+    calling thread.
+
+    t_fh -- gdal.Dataset object for the target file.
+
+    file_infos -- list of file_info objects for the source files.
+
+    bands -- number of target bands to merge into.
+
+    separate -- place each source band into a separate target band.
+
+    nodata_arg -- source pixel value to ignore.
+
+    init_values -- list of the values the target bands start from, or None
+    to start from their current content.
+
+    jobs -- number of threads merging tiles.
+
+    max_mem -- memory, in megabytes, used for the tiles being processed.
+    Defaults to default_max_mem.
+    """
+    import numpy
+    from osgeo import gdal_array
+
+    # Target bands fed by each source file, in command line order.
+    file_bands = []
+    t_band = 0
+    for fi in file_infos:
+        if separate == 0:
+            file_bands.append([(band, band + 1) for band in range(bands)])
+        else:
+            file_bands.append([(t_band + band, band + 1)
+                               for band in range(fi.bands)])
+            t_band = t_band + fi.bands
+
+    # Tiles are merged in a type able to hold the values of the target
+    # band and of all its source bands, and converted once when written.
+    buf_types = []
+    for band in range(bands):
+        types = set([t_fh.GetRasterBand(band + 1).DataType])
+        for (k, fi) in enumerate(file_infos):
+            if [b for b in file_bands[k] if b[0] == band]:
+                types.add(fi.band_type)
+        buf_types.append(numpy.result_type(
+            *[gdal_array.GDALTypeCodeToNumericTypeCode(t) for t in types]))
+
+    if max_mem is None:
+        max_mem = default_max_mem
+    # Tiles in flight: one without threads, a small queue per thread otherwise.
+    max_pending = 1
+    if jobs > 1:
+        max_pending = 2 * jobs
+    pixel_bytes = sum([t.itemsize for t in buf_types]) + \
+        max([t.itemsize for t in buf_types]) + 2
+    max_pixels = int(max_mem * 1024 * 1024 / (pixel_bytes * max_pending))
+    (block_xsize, block_ysize) = t_fh.GetRasterBand(1).GetBlockSize()
+    tiles = block_aligned_windows(0, 0, t_fh.RasterXSize, t_fh.RasterYSize,
+                                  block_xsize, block_ysize, max_pixels)
+
+    copy_windows = [fi.copy_windows(t_fh) for fi in file_infos]
+    index = extent_index(tiles[0][2], tiles[0][3])
+    for (k, windows) in enumerate(copy_windows):
+        if windows is not None:
+            index.insert(k, *windows[4:])
+
+    # Each thread keeps the source datasets it used last open, up to
+    # max_open_datasets of them.
+    local = threading.local()
+
+    def merge_tile(tile, buffers, keys):
+        (xoff, yoff, xsize, ysize) = tile
+        if not hasattr(local, 'datasets'):
+            local.datasets = collections.OrderedDict()
+
+        for k in keys:
+            (s_xoff, s_yoff, s_xsize, s_ysize,
+             t_xoff, t_yoff, t_xsize, t_ysize) = copy_windows[k]
+
+            # Part of the tile covered by this file.
+            x0 = max(xoff, t_xoff)
+            y0 = max(yoff, t_yoff)
+            x1 = min(xoff + xsize, t_xoff + t_xsize)
+            y1 = min(yoff + ysize, t_yoff + t_ysize)
+            (sw_xoff, sw_yoff, sw_xsize, sw_ysize) = source_window(
+                s_xoff, s_yoff, s_xsize, s_ysize,
+                t_xoff, t_yoff, t_xsize, t_ysize,
+                x0, y0, x1 - x0, y1 - y0)
+
+            s_fh = local.datasets.pop(k, None)
+            if s_fh is None:
+                s_fh = gdal.Open(file_infos[k].filename)
+                if len(local.datasets) >= max_open_datasets:
+                    local.datasets.popitem(last=False)
+            local.datasets[k] = s_fh
+
+            for (band, s_band_n) in file_bands[k]:
+                s_band = s_fh.GetRasterBand(s_band_n)
+                data = s_band.ReadAsArray(sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                          x1 - x0, y1 - y0)
+                dst = buffers[band][y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff]
+
+                m_band = None
+                if nodata_arg is not None:
+                    valid = numpy.not_equal(data, nodata_arg)
+                else:
+                    m_band = get_mask_band(s_band)
+                    if m_band is not None:
+                        valid = numpy.not_equal(
+                            m_band.ReadAsArray(sw_xoff, sw_yoff,
+                                               sw_xsize, sw_ysize,
+                                               x1 - x0, y1 - y0), 0)
+
+                if nodata_arg is None and m_band is None:
+                    dst[...] = data
+                else:
+                    numpy.copyto(dst, data, casting='unsafe', where=valid)
+
+        return (tile, buffers)
+
+    def init_buffer(band, xsize, ysize):
+        # Same value as GDALRasterBand::Fill() would write.
+        value = init_values[band]
+        t_type = gdal_array.GDALTypeCodeToNumericTypeCode(
+            t_fh.GetRasterBand(band + 1).DataType)
+        if numpy.issubdtype(t_type, numpy.integer):
+            info = numpy.iinfo(t_type)
+            value = min(max(math.floor(value + 0.5), info.min), info.max)
+        buf = numpy.empty((ysize, xsize), buf_types[band])
+        buf.fill(value)
+        return buf
+
+    def write_tile(tile, buffers):
+        for band in range(bands):
+            t_fh.GetRasterBand(band + 1).WriteArray(buffers[band],
+                                                    tile[0], tile[1])
+
+    # Number of tiles done, skipped tiles being reported along with the
+    # next tile written.
+    tiles_done = [0]
+
+    def report(count):
+        if count > tiles_done[0]:
+            tiles_done[0] = count
+            if quiet == 0 and verbose == 0:
+                progress(count / float(len(tiles)))
+
+    pool = None
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+    pending = collections.deque()
+
+    for (i, tile) in enumerate(tiles):
+        keys = index.query(*tile)
+        if not keys and init_values is None:
+            if not pending:
+                report(i + 1)
+            continue
+
+        if verbose != 0:
+            print('Merge %d files into %d,%d,%d,%d.'
+                  % ((len(keys),) + tile))
+
+        (xoff, yoff, xsize, ysize) = tile
+        buffers = []
+        for band in range(bands):
+            if init_values is None:
+                buf = t_fh.GetRasterBand(band + 1).ReadAsArray(
+                    xoff, yoff, xsize, ysize).astype(buf_types[band])
+            else:
+                buf = init_buffer(band, xsize, ysize)
+            buffers.append(buf)
+
+        if pool is None:
+            write_tile(*merge_tile(tile, buffers, keys))
+            report(i + 1)
+            continue
+
+        pending.append((i, pool.apply_async(merge_tile,
+                                            (tile, buffers, keys))))
+        if len(pending) >= max_pending:
+            (j, result) = pending.popleft()
+            write_tile(*result.get())
+            report(j + 1)
+
+    while pending:
+        (j, result) = pending.popleft()
+        write_tile(*result.get())
+        report(j + 1)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    report(len(tiles))
+
+    return 1
+
+# =============================================================================
+
+
 def Usage():
     print('Usage: gdal_merge.py [-o out_filename] [-of out_format] [-co NAME=VALUE]*')
     print('                     [-ps pixelsize_x pixelsize_y] [-tap] [-separate] [-q] [-v] [-pct]')
     print('                     [-ul_lr ulx uly lrx lry] [-init "value [value...]"]')
     print('                     [-n nodata_value] [-a_nodata output_nodata_value]')
-    print('                     [-ot datatype] [-createonly] input_files')
+    print('                     [-ot datatype] [-createonly] [-wm memory_in_mb]')
+    print('                     [-j num_threads] input_files')
     print('                     [--help-general]')
     print('')
 
@@ -374,6 +774,8 @@ def main(argv=None):
     pre_init = []
     band_type = None
     createonly = 0
+    max_mem = None
+    jobs = None
     bTargetAlignedPixels = False
     start_time = time.time()
 
@@ -432,6 +834,20 @@ def main(argv=None):
             i = i + 1
             a_nodata = float(argv[i])
 
+        elif arg == '-wm':
+            i = i + 1
+            max_mem = float(argv[i])
+            if max_mem <= 0:
+                print('Invalid memory amount: %s' % argv[i])
+                sys.exit(1)
+
+        elif arg == '-j':
+            i = i + 1
+            jobs = int(argv[i])
+            if jobs < 1:
+                print('Invalid number of jobs: %s' % argv[i])
+                sys.exit(1)
+
         elif arg == '-f' or arg == '-of':
             i = i + 1
             frmt = argv[i]
@@ -560,13 +976,18 @@ def main(argv=None):
             t_fh.GetRasterBand(i + 1).SetNoDataValue(a_nodata)
 
     # Do we need to pre-initialize the whole mosaic file to some value?
+    init_values = None
     if pre_init is not None:
         if t_fh.RasterCount <= len(pre_init):
-            for i in range(t_fh.RasterCount):
-                t_fh.GetRasterBand(i + 1).Fill(pre_init[i])
+            init_values = pre_init[:t_fh.RasterCount]
         elif len(pre_init) == 1:
-            for i in range(t_fh.RasterCount):
-                t_fh.GetRasterBand(i + 1).Fill(pre_init[0])
+            init_values = pre_init * t_fh.RasterCount
+
+    # With -j, the merged bands are initialized along with their tiles.
+    if init_values is not None:
+        for i in range(t_fh.RasterCount):
+            if jobs is None or createonly != 0 or i >= bands:
+                t_fh.GetRasterBand(i + 1).Fill(init_values[i])
 
     # Copy data from source files into output file.
     t_band = 1
@@ -575,29 +996,39 @@ def main(argv=None):
         progress(0.0)
     fi_processed = 0
 
-    for fi in file_infos:
-        if createonly != 0:
-            continue
-
+    if jobs is not None and createonly == 0:
         if verbose != 0:
+            for (k, fi) in enumerate(file_infos):
+                print("")
+                print("File %5d of %5d." % (k + 1, len(file_infos)))
+                fi.report()
             print("")
-            print("Processing file %5d of %5d, %6.3f%% completed in %d minutes."
-                  % (fi_processed + 1, len(file_infos),
-                     fi_processed * 100.0 / len(file_infos),
-                     int(round((time.time() - start_time) / 60.0))))
-            fi.report()
-
-        if separate == 0:
-            for band in range(1, bands + 1):
-                fi.copy_into(t_fh, band, band, nodata)
-        else:
-            for band in range(1, fi.bands + 1):
-                fi.copy_into(t_fh, band, t_band, nodata)
-                t_band = t_band + 1
+        merge_tiles(t_fh, file_infos, bands, separate, nodata,
+                    init_values, jobs, max_mem)
+    else:
+        for fi in file_infos:
+            if createonly != 0:
+                continue
+
+            if verbose != 0:
+                print("")
+                print("Processing file %5d of %5d, %6.3f%% completed in %d minutes."
+                      % (fi_processed + 1, len(file_infos),
+                         fi_processed * 100.0 / len(file_infos),
+                         int(round((time.time() - start_time) / 60.0))))
+                fi.report()
+
+            if separate == 0:
+                for band in range(1, bands + 1):
+                    fi.copy_into(t_fh, band, band, nodata, max_mem)
+            else:
+                for band in range(1, fi.bands + 1):
+                    fi.copy_into(t_fh, band, t_band, nodata, max_mem)
+                    t_band = t_band + 1
 
-        fi_processed = fi_processed + 1
-        if quiet == 0 and verbose == 0:
-            progress(fi_processed / float(len(file_infos)))
+            fi_processed = fi_processed + 1
+            if quiet == 0 and verbose == 0:
+                progress(fi_processed / float(len(file_infos)))
 
     # Force file to be closed.
     t_fh = None